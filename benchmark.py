@@ -0,0 +1,1112 @@
+"""Timing benchmarks for the hot paths of wellfareSpecPlot.py
+
+Usage:
+    python benchmark.py parse [file ...]
+    python benchmark.py broaden [--structures N ...] [--peaks N] [--points N] [--max-memory 64M]
+                                [--tolerance 1e-6]
+    python benchmark.py fft [--peaks N ...] [--points N]
+    python benchmark.py uvvis [--transitions N ...] [--resolution eV]
+    python benchmark.py export [--structures N ...] [--points N]
+    python benchmark.py startup [--limit ms]
+    python benchmark.py sticks [--panels N] [--bands N] [--format pdf]
+    python benchmark.py follow [file] [--copies N] [--append KB]
+    python benchmark.py sweep [--structures N] [--temperatures N]
+    python benchmark.py prune [--structures N] [--min-weight W] [--min-strength F]
+    python benchmark.py grid [--structures N] [--tolerances 1e-2 1e-3] [--hwhm NM]
+    python benchmark.py ragged [--structures N ...] [--peaks N] [--points N] [--max-memory 8M]
+    python benchmark.py columns [--structures N] [--peaks N]
+    python benchmark.py generate DIR [--program orca|orca6|g09|g16] [--conformers N] [--roots N] [--size 2G]
+    python benchmark.py suite [--json FILE] [--synthetic-size 64M] [--against CHECKOUT]
+    python benchmark.py compare BASE.json NEW.json [--threshold 0.1]
+    python benchmark.py render [--figures N] [--peaks N] [--format png] [--workers N ...]
+
+Without files, the bundled *_td.out / *_opt.out outputs are used. The
+broadening benchmark runs on random ensembles.
+"""
+
+import sys
+import os.path
+import glob
+import time
+import argparse
+import tracemalloc
+import functools
+import contextlib
+import tempfile
+import subprocess
+import json
+import platform
+
+import numpy as np
+
+import wellfareSpecPlot as wsp
+import plot_uvvis
+
+
+class CountingFile(object):
+    "Wraps a text file and counts the characters handed out"
+
+    def __init__(self, f, counter):
+        self.f = f
+        self.counter = counter
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.f)
+        self.counter[1] += len(line)
+        return line
+
+    def read(self, size=-1):
+        text = self.f.read(size)
+        self.counter[1] += len(text)
+        return text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def close(self):
+        self.f.close()
+
+
+def legacyExtractExcitations(filename, opener=open):
+    """
+    The multi-pass parser wellfareSpecPlot used before the single-pass
+    ExcitationParser, kept as the reference for timings and results.
+    Program detection does not depend on the verbosity here.
+    """
+    bands = []
+    oscstr = []
+    ecdstr = []
+    gibbsfree = 0.0
+    f = opener(filename, 'r')
+    program = "N/A"
+    for line in f:
+        if line.find("Entering Gaussian System, Link 0=g09") != -1:
+            program = "g09"
+            break
+        elif line.find("* O   R   C   A *") != -1:
+            program = "orca"
+            break
+    f.close()
+    excit = []
+    if program == "g09":
+        f = opener(filename, 'r')
+        for line in f:
+            if line.find("Excitation energies and oscillator strengths:") != -1:
+                del excit[:]
+                while True:
+                    readBuffer = f.__next__()
+                    if readBuffer.find("Excited State") != -1:
+                        excit.append(readBuffer)
+                    elif readBuffer.find("Leave Link") != -1 or readBuffer.find("SavETr") != -1 or readBuffer.find("Orbital") != -1:
+                        break
+        for i in excit:
+            readBuffer = i.split()
+            bands.append(float(readBuffer[6]))
+            oscstr.append(float(readBuffer[8][2:]))
+        f.close()
+        f = opener(filename, 'r')
+        for line in f:
+            if line.find("R(velocity)    E-M Angle") != -1:
+                del excit[:]
+                while True:
+                    readBuffer = f.__next__()
+                    if readBuffer.find("del") != -1:
+                        break
+                    else:
+                        excit.append(readBuffer)
+        for i in excit:
+            readBuffer = i.split()
+            ecdstr.append(float(readBuffer[4]))
+        f.close()
+        f = opener(filename, 'r')
+        for line in f:
+            if line.find("Sum of electronic and thermal Free Energies") != -1:
+                gibbsfree = float(line.split()[7])
+        f.close()
+    if program == "orca":
+        f = opener(filename, 'r')
+        for line in f:
+            if line.find(" ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS") != -1:
+                del excit[:]
+                for i in range(0, 4):
+                    readBuffer = f.__next__()
+                while True:
+                    readBuffer = f.__next__()
+                    if readBuffer and readBuffer.strip():
+                        excit.append(readBuffer)
+                    else:
+                        break
+        for i in excit:
+            readBuffer = i.split()
+            bands.append(float(readBuffer[2]))
+            oscstr.append(float(readBuffer[3]))
+        f.close()
+        f = opener(filename)
+        for line in f:
+            if line.strip() == 'CD SPECTRUM':
+                del excit[:]
+                for _ in range(5):
+                    line = next(f)
+                while line.strip():
+                    tokens = line.split()
+                    ecdstr.append(float(tokens[3]))
+                    line = next(f)
+        f.close()
+        f = opener(filename, 'r')
+        for line in f:
+            if line.find("Final Gibbs free enthalpy") != -1:
+                gibbsfree = float(line.split()[5])
+        f.close()
+    return bands, oscstr, gibbsfree, ecdstr
+
+
+def bestOf(function, repeat):
+    "Return the fastest of repeat calls of function (in s) and its last result"
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - begin)
+    return best, result
+
+
+def charactersRead(function, filename):
+    "Count how many characters function reads from filename and how often it opens it"
+    counter = [0, 0]
+
+    def opener(name, *args):
+        counter[0] += 1
+        return CountingFile(open(name, *args), counter)
+
+    function(filename, opener)
+    return counter
+
+
+def singlePass(filename, opener=open):
+    parser = wsp.ExcitationParser()
+    with opener(filename, 'r') as f:
+        for chunk in iter(lambda: f.read(wsp.readsize), ''):
+            parser.feed(chunk)
+    parser.close()
+    return parser.result()
+
+
+def benchParse(files, repeat):
+    print("{:<16} {:>9} {:>16} {:>16} {:>8} {:>8} {:>8}  {}".format(
+        "file", "size/kB", "legacy ms (I/O)", "1-pass ms (I/O)", "speedup", "rev. ms", "speedup", "same"))
+    for filename in files:
+        size = os.path.getsize(filename)
+        t_old, r_old = bestOf(lambda: legacyExtractExcitations(filename), repeat)
+        t_new, r_new = bestOf(lambda: singlePass(filename), repeat)
+        t_rev, r_rev = bestOf(lambda: wsp.extractExcitations(filename, reverse=True), repeat)
+        opens_old, read_old = charactersRead(legacyExtractExcitations, filename)
+        opens_new, read_new = charactersRead(singlePass, filename)
+        print("{:<16} {:>9.1f} {:>8.2f} ({}x{:.1f}) {:>8.2f} ({}x{:.1f}) {:>8.2f} {:>8.2f} {:>8.2f}  {}".format(
+            os.path.basename(filename), size / 1024.0,
+            t_old * 1e3, opens_old, read_old / float(size),
+            t_new * 1e3, opens_new, read_new / float(size),
+            t_old / t_new, t_rev * 1e3, t_old / t_rev, r_old == r_new == r_rev))
+
+
+def randomEnsemble(structures, peaks, seed=0):
+    "Random band positions (nm), oscillator and ECD strengths and weights for an ensemble"
+    rng = np.random.RandomState(seed)
+    bands = [list(rng.uniform(150.0, 450.0, peaks)) for _ in range(structures)]
+    strengths = [list(rng.uniform(0.0, 0.5, peaks)) for _ in range(structures)]
+    ecds = [list(rng.uniform(-0.1, 0.1, peaks)) for _ in range(structures)]
+    weights = rng.uniform(0.0, 1.0, structures)
+    return bands, strengths, ecds, weights / np.sum(weights)
+
+
+def legacyBroaden(x, bands, strengths, ecds, weights, stdev, gamma, function):
+    "The per-peak loops wellfareSpecPlot used before broaden()"
+    curves = []
+    for values in (strengths, ecds):
+        individual = []
+        composite = 0
+        for i in range(0, len(bands)):
+            individual.append(0)
+            for count, peak in enumerate(bands[i]):
+                if function == "lorentzian":
+                    thispeak = weights[i] * wsp.lorentzBand(x, peak, values[i][count], stdev, gamma)
+                else:
+                    thispeak = weights[i] * wsp.gaussBand(x, peak, values[i][count], stdev)
+                composite += thispeak
+                individual[i] += thispeak
+        curves.append((composite, individual))
+    return curves
+
+
+def peakMemory(function):
+    "Peak memory (in bytes) traced while calling function"
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchBroaden(sizes, peaks, points, function, repeat, maxmemory=None, tolerance=None, stdev=3099.6, gamma=7.5):
+    print("{:>10} {:>6} {:>7} {:>10} {:>10} {:>8} {:>8}  {}".format(
+        "structures", "peaks", "points", "loops ms", "vector ms", "speedup", "peak MB", "max. rel. diff."))
+    if tolerance is not None:
+        print("(bands truncated at {:.0e} of their height, relative error bound in brackets)".format(tolerance))
+    x = np.linspace(100.0, 500.0, points)
+    for structures in sizes:
+        bands, strengths, ecds, weights = randomEnsemble(structures, peaks)
+        bandarray = wsp.padLists(bands)
+        stdevs = np.full(bandarray.shape, stdev)
+        gammas = np.full(bandarray.shape, gamma)
+        t_old, r_old = bestOf(lambda: legacyBroaden(x, bands, strengths, ecds, weights, stdev, gamma, function),
+                              repeat)
+        vectorised = lambda: wsp.broaden(x, bandarray, [wsp.padLists(strengths, 0.0), wsp.padLists(ecds, 0.0)],
+                                         stdevs, gammas, weights, function, maxmemory, tolerance)
+        t_new, r_new = bestOf(vectorised, repeat)
+        memory = peakMemory(vectorised)
+        diff = max(np.max(np.abs(r_new[0][k] - r_old[k][0])) / np.max(np.abs(r_old[k][0])) for k in range(2))
+        row = "{:>10} {:>6} {:>7} {:>10.2f} {:>10.2f} {:>8.2f} {:>8.1f}  {:.1e}".format(
+            structures, peaks, points, t_old * 1e3, t_new * 1e3, t_old / t_new, memory / 2.0 ** 20, diff)
+        if tolerance is not None:
+            bound = wsp.windowError([wsp.padLists(strengths, 0.0), wsp.padLists(ecds, 0.0)], stdevs, weights, tolerance)
+            row += " ({:.1e})".format(max(bound[k] / np.max(np.abs(r_old[k][0])) for k in range(2)))
+        print(row)
+
+
+def benchFFT(peaklist, points, function, repeat, stdev=3099.6, gamma=7.5):
+    "Direct summation vs. FFT convolution for one increasingly dense line spectrum"
+    print("{:>7} {:>7} {:>10} {:>10} {:>8}  {}".format("peaks", "points", "direct ms", "fft ms", "speedup",
+                                                       "max. error / max. height"))
+    x = np.linspace(100.0, 500.0, points)
+    crossover = None
+    for peaks in peaklist:
+        bands, strengths, ecds, weights = randomEnsemble(1, peaks)
+        bandarray = wsp.padLists(bands)
+        stdevs = np.full(bandarray.shape, stdev)
+        gammas = np.full(bandarray.shape, gamma)
+        values = [wsp.padLists(strengths, 0.0), wsp.padLists(ecds, 0.0)]
+        t_direct, r_direct = bestOf(lambda: wsp.broaden(x, bandarray, values, stdevs, gammas, weights, function),
+                                    repeat)
+        t_fft, r_fft = bestOf(lambda: wsp.broaden(x, bandarray, values, stdevs, gammas, weights, function,
+                                                  engine="fft"), repeat)
+        error = max(np.max(np.abs(r_fft[0][k] - r_direct[0][k])) / np.max(np.abs(r_direct[0][k])) for k in range(2))
+        print("{:>7} {:>7} {:>10.2f} {:>10.2f} {:>8.2f}  {:.1e}".format(peaks, points, t_direct * 1e3, t_fft * 1e3,
+                                                                       t_direct / t_fft, error))
+        if crossover is None and t_fft < t_direct:
+            crossover = peaks
+    if crossover is not None:
+        print("FFT convolution is faster from {} peaks on".format(crossover))
+
+
+def legacySpectra(etenergies, etoscs, low=0.5, high=10.0, resolution=0.01, smear=0.04):
+    "The double loop plot_uvvis.spectra used before it was vectorised"
+    maxSlices = int((high - low) / resolution) + 1
+    spectraEV = []
+    spectraNM = []
+    spectraIntensity = []
+    for i in range(0, maxSlices):
+        energy = float(i * resolution + low)
+        wavenumber = energy / 1.23981e-4
+        intensity = 0.0
+        for trans in range(0, len(etenergies)):
+            this_smear = smear / 0.2 * (-0.046 * etoscs[trans] + 0.20)
+            deltaE = etenergies[trans] * 1.23981e-4 - energy
+            intensity = intensity + etoscs[trans] * this_smear**2 / (deltaE**2 + this_smear**2)
+        spectraEV.append(energy)
+        spectraNM.append(float(1.0e7 / wavenumber))
+        spectraIntensity.append(intensity)
+    return spectraEV, spectraNM, spectraIntensity
+
+
+def benchUVVis(transitions, resolution, repeat):
+    print("{:>11} {:>7} {:>10} {:>10} {:>8}  {}".format("transitions", "slices", "loops ms", "numpy ms", "speedup",
+                                                        "max. rel. diff."))
+    rng = np.random.RandomState(0)
+    for count in transitions:
+        # Excitation energies in cm-1 between ~1 and 9 eV
+        etenergies = list(rng.uniform(8000.0, 72000.0, count))
+        etoscs = list(rng.uniform(0.0, 1.0, count))
+        t_old, r_old = bestOf(lambda: legacySpectra(etenergies, etoscs, resolution=resolution), repeat)
+        t_new, r_new = bestOf(lambda: plot_uvvis.spectra(etenergies, etoscs, resolution=resolution), repeat)
+        diff = np.max(np.abs(r_new[2] - r_old[2])) / max(np.max(np.abs(r_old[2])), 1e-300)
+        print("{:>11} {:>7} {:>10.2f} {:>10.2f} {:>8.2f}  {:.1e}".format(count, len(r_old[0]), t_old * 1e3,
+                                                                        t_new * 1e3, t_old / t_new, diff))
+
+
+def legacyWriteCSV(filename, x, names, composite, individual, composite_ecd, individual_ecd):
+    "The original row by row csv writer"
+    f = open(filename, 'wt')
+    for title, total, curves, form in (("UV-Vis Data\n", composite, individual, "{:4.2f}"),
+                                       ("\nECD Data\n", composite_ecd, individual_ecd, "{: 4.2f}")):
+        f.write(title)
+        row = "wavelength, composite"
+        for i in range(0, len(names)):
+            row += ", {}".format(names[i])
+        row += "\n"
+        f.write(row)
+        for i in range(0, len(x)):
+            row = ("{:3.2f}, " + form).format(x[i], total[i])
+            for j in range(0, len(names)):
+                row += (", " + form).format(curves[j][i])
+            row += "\n"
+            f.write(row)
+    f.close()
+
+
+def benchExport(sizes, points, repeat):
+    print("{:>10} {:>7} {:>10} {:>10} {:>8} {:>10} {:>9} {:>9}  {}".format(
+        "structures", "points", "legacy ms", "csv ms", "speedup", "npz ms", "csv MB", "npz MB", "identical"))
+    rng = np.random.RandomState(0)
+    directory = tempfile.mkdtemp()
+    for count in sizes:
+        x = np.linspace(100.0, 1000.0, points)
+        individual = rng.uniform(0.0, 1e4, (count, points))
+        individual_ecd = rng.uniform(-1e3, 1e3, (count, points))
+        names = ["conformer{}.out".format(i) for i in range(count)]
+        spectra = (x, names, individual.sum(axis=0), individual, individual_ecd.sum(axis=0), individual_ecd)
+        old, new, npz = [os.path.join(directory, name) for name in ("old.csv", "new.csv", "new.npz")]
+        t_old, _ = bestOf(lambda: legacyWriteCSV(old, *spectra), repeat)
+        t_new, _ = bestOf(lambda: wsp.writeCSV(new, *spectra), repeat)
+        t_npz, _ = bestOf(lambda: wsp.writeSpectra(npz, *spectra, weights=np.full(count, 1.0 / count)), repeat)
+        with open(old) as f_old, open(new) as f_new:
+            identical = f_old.read() == f_new.read()
+        print("{:>10} {:>7} {:>10.1f} {:>10.1f} {:>8.2f} {:>10.1f} {:>9.2f} {:>9.2f}  {}".format(
+            count, points, t_old * 1e3, t_new * 1e3, t_old / t_new, t_npz * 1e3, os.path.getsize(new) / 2.0 ** 20,
+            os.path.getsize(npz) / 2.0 ** 20, identical))
+        for name in (old, new, npz):
+            os.remove(name)
+    os.rmdir(directory)
+
+
+def benchRender(figures, peaks, points, extension, workers=()):
+    """
+    Figures per second for new figures with tight bounding boxes vs. a
+    reused BatchRenderer figure, and for batches rendered by a pool of
+    workers (checked to give the same files)
+    """
+    plt = wsp.pyplot()
+    directory = tempfile.mkdtemp()
+    x = np.linspace(100.0, 600.0, points)
+    spectra = []
+    for i in range(figures):
+        bands, strengths, ecds, _ = randomEnsemble(1, peaks, seed=i)
+        (composite, _), (individual, _) = wsp.broaden(x, bands, [strengths, ecds], np.full((1, peaks), 3099.6))
+        spectra.append((composite, individual, bands, strengths, "conformer{}.out".format(i)))
+
+    def fresh():
+        for i, (composite, individual, bands, strengths, name) in enumerate(spectra):
+            fig = wsp.plotUVVis(x, composite, individual, [name], bands, strengths, [0.0], [1.0], 1)
+            fig.savefig(os.path.join(directory, "fresh{}.{}".format(i, extension)), bbox_inches='tight')
+            plt.close(fig)
+
+    def reused():
+        renderer = wsp.BatchRenderer("uvvis")
+        for i, (composite, individual, bands, strengths, name) in enumerate(spectra):
+            renderer.render(os.path.join(directory, "batch{}.{}".format(i, extension)), x, composite, bands[0],
+                            strengths[0], name)
+        renderer.close()
+
+    t_fresh, _ = bestOf(fresh, 1)
+    t_reused, _ = bestOf(reused, 1)
+    print("{:>8} {:>6} {:>7} {:>13} {:>14} {:>8}".format("figures", "peaks", "format", "new figures/s",
+                                                          "reused figs/s", "speedup"))
+    print("{:>8} {:>6} {:>7} {:>13.1f} {:>14.1f} {:>8.2f}".format(figures, peaks, extension, figures / t_fresh,
+                                                                  figures / t_reused, t_fresh / t_reused))
+    tasks = [("uvvis", os.path.join(directory, "batch{}.{}".format(i, extension)), x, composite, bands[0],
+              strengths[0], name) for i, (composite, individual, bands, strengths, name) in enumerate(spectra)]
+    with open(tasks[-1][1], 'rb') as f:
+        serial = f.read()
+    for count in workers:
+        t_pool, _ = bestOf(lambda: wsp.renderJobs(wsp.batchJobs(tasks, count), count), 1)
+        with open(tasks[-1][1], 'rb') as f:
+            identical = f.read() == serial
+        print("{:>8} workers: {:>7.1f} figures/s, {:.2f}x the reused figure, same files: {}".format(
+            count, figures / t_pool, t_reused / t_pool, identical))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+def benchSticks(panels, bands, extension, repeat):
+    "One vlines call per line vs. one per panel: time to build and save the figure, number of artists"
+    plt = wsp.pyplot()
+    rng = np.random.RandomState(0)
+    positions = rng.uniform(150.0, 450.0, (panels, bands))
+    ecds = rng.uniform(-0.1, 0.1, (panels, bands))
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "sticks." + extension)
+
+    def figure(vectorised):
+        fig, ay = plt.subplots(nrows=panels, sharex=True)
+        for p in range(panels):
+            ay[p].plot(positions[p], ecds[p] * 1e3, ',')
+            if vectorised:
+                ay[p].vlines(positions[p], 0.0, wsp.stickHeights(ecds[p], ay[p].get_ylim(), signed=True))
+            else:
+                stretchfactor = 1 / max(ecds[p])
+                for j in range(bands):
+                    if ecds[p][j] > 0.0:
+                        ay[p].vlines(positions[p][j], 0.0, 0.9 * ay[p].get_ylim()[1] * stretchfactor * ecds[p][j])
+                    if ecds[p][j] < 0.0:
+                        ay[p].vlines(positions[p][j], 0.0, -0.9 * ay[p].get_ylim()[0] * stretchfactor * ecds[p][j])
+        artists = sum(len(a.collections) for a in ay)
+        fig.savefig(filename)
+        plt.close(fig)
+        return artists
+
+    t_old, n_old = bestOf(lambda: figure(False), repeat)
+    t_new, n_new = bestOf(lambda: figure(True), repeat)
+    print("{:>7} {:>6} {:>7} {:>12} {:>12} {:>8} {:>14}".format("panels", "bands", "format", "per line ms",
+                                                                "per panel ms", "speedup", "collections"))
+    print("{:>7} {:>6} {:>7} {:>12.1f} {:>12.1f} {:>8.2f} {:>14}".format(
+        panels, bands, extension, t_old * 1e3, t_new * 1e3, t_old / t_new, "{} -> {}".format(n_old, n_new)))
+    os.remove(filename)
+    os.rmdir(directory)
+
+
+def benchFollow(filename, copies, append, repeat):
+    """
+    Cost of checking a growing output for new spectra: reading it again from
+    the start vs. an ExcitationFollower that only reads the appended bytes
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    directory = tempfile.mkdtemp()
+    growing = os.path.join(directory, "running.out")
+    with open(growing, 'wb') as f:
+        f.write(data * copies)
+    follower = wsp.ExcitationFollower(growing)
+    follower.poll()
+    tail = data[:append * 1024]
+
+    def reread():
+        with open(growing, 'ab') as f:
+            f.write(tail)
+        return wsp.readExcitations(growing).result()
+
+    def follow():
+        with open(growing, 'ab') as f:
+            f.write(tail)
+        follower.poll()
+        return follower.result()
+
+    t_reread, r_reread = bestOf(reread, repeat)
+    t_follow, r_follow = bestOf(follow, repeat)
+    print("{:>9} {:>10} {:>11} {:>11} {:>9}  {}".format("file MB", "append KB", "reread ms", "follow ms", "speedup",
+                                                        "same result"))
+    print("{:>9.1f} {:>10} {:>11.2f} {:>11.2f} {:>9.1f}  {}".format(
+        len(data) * copies / 2.0 ** 20, append, t_reread * 1e3, t_follow * 1e3, t_reread / t_follow,
+        r_reread == r_follow))
+    os.remove(growing)
+    os.rmdir(directory)
+
+
+def benchSweep(structures, temperatures, peaks, points, repeat):
+    "One broadening per temperature vs. temperatureSweep, which broadens once"
+    bands, strengths, ecds, _ = randomEnsemble(structures, peaks)
+    energies = -1000.0 + np.random.RandomState(1).uniform(0.0, 0.005, structures)
+    x = np.linspace(100.0, 600.0, points)
+    sweep = np.linspace(100.0, 1000.0, temperatures)
+
+    def separate():
+        return np.array([wsp.ensembleSpectra(x, bands, strengths, ecds, wsp.ensembleWeights(energies, t))[0][0]
+                         for t in sweep])
+
+    t_old, r_old = bestOf(separate, repeat)
+    t_new, r_new = bestOf(lambda: wsp.temperatureSweep(x, bands, strengths, ecds, energies, sweep)[1], repeat)
+    print("{:>10} {:>12} {:>12} {:>10} {:>8}  {}".format("structures", "temperatures", "separate ms", "sweep ms",
+                                                         "speedup", "max. rel. diff."))
+    print("{:>10} {:>12} {:>12.1f} {:>10.1f} {:>8.1f}  {:.1e}".format(
+        structures, temperatures, t_old * 1e3, t_new * 1e3, t_old / t_new,
+        np.max(np.abs(r_new - r_old)) / np.max(np.abs(r_old))))
+
+
+def benchPrune(structures, peaks, points, minweight, minstrength, repeat):
+    "Full broadening vs. pruneEnsemble first: time, actual error and the reported bound"
+    bands, strengths, ecds, _ = randomEnsemble(structures, peaks)
+    # Most conformers a few kcal/mol up, i.e. with a tiny population
+    energies = np.random.RandomState(1).exponential(0.003, structures)
+    weights = wsp.ensembleWeights(energies)
+    x = np.linspace(100.0, 600.0, points)
+    t_full, full = bestOf(lambda: wsp.ensembleSpectra(x, bands, strengths, ecds, weights)[0], repeat)
+
+    def pruned():
+        keep, b, f, r, bound = wsp.pruneEnsemble(bands, strengths, ecds, weights, 3099.6, minweight, minstrength)
+        return wsp.ensembleSpectra(x, b, f, r, weights[keep])[0], len(keep), bound
+
+    t_pruned, (spectra, kept, bound) = bestOf(pruned, repeat)
+    error = np.max(np.abs(np.array(full) - np.array(spectra)), axis=-1)
+    print("{:>10} {:>6} {:>9} {:>9} {:>8}  {:>19}  {:>19}".format("structures", "kept", "full ms", "pruned ms",
+                                                                  "speedup", "UV error (bound)", "ECD error (bound)"))
+    print("{:>10} {:>6} {:>9.1f} {:>9.1f} {:>8.1f}  {:>8.2e} ({:>8.2e})  {:>8.2e} ({:>8.2e})".format(
+        structures, kept, t_full * 1e3, t_pruned * 1e3, t_full / t_pruned, error[0], bound[0], error[1], bound[1]))
+
+
+def benchGrid(structures, peaks, tolerances, hwhm, repeat):
+    """
+    Uniform grid of plotGrid (2.5 points per nm) vs. adaptiveGrid: points,
+    time including the final broadening and the largest error of linear
+    interpolation against a 50 points per nm reference, relative to the
+    largest value of each spectrum.
+    """
+    bands, strengths, ecds, weights = randomEnsemble(structures, peaks)
+    print("{:>10} {:>10} {:>8} {:>9} {:>10} {:>10}".format("function", "grid", "points", "ms", "UV error",
+                                                            "ECD error"))
+    for function in ("gaussian", "lorentzian"):
+        uniform, start, finish, _ = wsp.plotGrid(bands)
+        dense = np.linspace(start, finish, int((finish - start) * 50) + 1)
+        reference = np.array(wsp.ensembleSpectra(dense, bands, strengths, ecds, weights, hwhm=hwhm,
+                                                 function=function)[0])
+        grids = [("uniform", lambda: uniform)]
+        for tolerance in tolerances:
+            grids.append(("{:g}".format(tolerance), functools.partial(wsp.adaptiveGrid, bands, strengths, ecds, weights,
+                                                                       start, finish, tolerance=tolerance, hwhm=hwhm,
+                                                                       function=function)))
+        for name, grid in grids:
+            def spectra():
+                x = grid()
+                return x, wsp.ensembleSpectra(x, bands, strengths, ecds, weights, hwhm=hwhm, function=function)[0]
+
+            elapsed, (x, values) = bestOf(spectra, repeat)
+            error = [np.max(np.abs(np.interp(dense, x, values[k]) - reference[k])) / np.max(np.abs(reference[k]))
+                     for k in range(2)]
+            print("{:>10} {:>10} {:>8} {:>9.1f} {:>10.2e} {:>10.2e}".format(function, name, len(x), elapsed * 1e3,
+                                                                          error[0], error[1]))
+
+
+def benchRagged(sizes, peaks, points, repeat, maxmemory=8 << 20):
+    """
+    Broadening ensembles whose structures have between peaks / 2 and peaks
+    bands: padded (structures x peaks) arrays vs. RaggedArrays, with
+    per-band widths from the oscillator strengths, in tiles of maxmemory.
+    The ragged path must stay within the spectra plus the tile budget.
+    """
+    print("{:>10} {:>7} {:>10} {:>10} {:>8} {:>10} {:>10}  {}".format(
+        "structures", "bands", "padded ms", "ragged ms", "speedup", "padded MB", "ragged MB", "identical"))
+    x = np.linspace(100.0, 600.0, points)
+    for count in sizes:
+        bands, strengths, ecds, weights = randomEnsemble(count, peaks)
+        lengths = np.random.RandomState(1).randint(peaks // 2, peaks + 1, count)
+        bands, strengths, ecds = [[row[:n] for row, n in zip(rows, lengths)] for rows in (bands, strengths, ecds)]
+        stdevs, gammas = wsp.bandWidths(bands, strengths, rule="strength")
+        values = [wsp.ragged(strengths), wsp.ragged(ecds)]
+        padded = lambda: wsp.broaden(x, wsp.padLists(bands), [values[0].padded(0.0), values[1].padded(0.0)],
+                                     stdevs.padded(1.0), gammas.padded(1.0), weights, maxmemory=maxmemory)
+        csr = lambda: wsp.broaden(x, wsp.ragged(bands), values, stdevs, gammas, weights, maxmemory=maxmemory)
+        t_padded, r_padded = bestOf(padded, repeat)
+        t_ragged, r_ragged = bestOf(csr, repeat)
+        m_ragged = peakMemory(csr)
+        print("{:>10} {:>7} {:>10.1f} {:>10.1f} {:>8.2f} {:>10.1f} {:>10.1f}  {}".format(
+            count, int(np.sum(lengths)), t_padded * 1e3, t_ragged * 1e3, t_padded / t_ragged,
+            peakMemory(padded) / 2.0 ** 20, m_ragged / 2.0 ** 20,
+            np.allclose(r_padded[0], r_ragged[0], rtol=1e-12, atol=0.0)))
+        # The (kinds x structures x points) curves, the composite spectra and the tiles, plus 10% for the
+        # gathered bands and widths
+        spectra = 2 * (count + 1) * points * 8
+        assert m_ragged <= 1.1 * (spectra + maxmemory), "ragged broadening used {:.1f} MB".format(m_ragged / 2.0 ** 20)
+
+
+def benchColumns(structures, peaks, repeat):
+    """
+    Lists of lists (as readEnsemble returns them) vs. the columnar Ensemble:
+    memory, masking by weight and strength, and saving and (memory-mapped)
+    loading of the columns.
+    """
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(peaks // 2, peaks + 1, structures)
+    names = ["conformer{}.out".format(i) for i in range(structures)]
+    energies = -1000.0 - rng.exponential(0.003, structures)
+
+    def lists():
+        return ([rng.uniform(150.0, 450.0, n).tolist() for n in lengths],
+                [rng.uniform(0.0, 0.5, n).tolist() for n in lengths],
+                [rng.uniform(-0.1, 0.1, n).tolist() for n in lengths])
+
+    tracemalloc.start()
+    bands, strengths, ecds = lists()
+    m_lists = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    ensemble = wsp.Ensemble(names, bands, strengths, ecds, energies)
+    m_columns = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    weights = wsp.ensembleWeights(energies)
+
+    def maskLists():
+        keep = [i for i in range(structures) if weights[i] >= 1e-3]
+        return [[b for b, f in zip(bands[i], strengths[i]) if f >= 0.01] for i in keep]
+
+    t_masklists, _ = bestOf(maskLists, repeat)
+    t_maskcolumns, _ = bestOf(lambda: ensemble.select(weights >= 1e-3).strongBands(0.01), repeat)
+    directory = tempfile.mkdtemp()
+    t_save, _ = bestOf(lambda: ensemble.save(directory), repeat)
+    t_load, loaded = bestOf(lambda: wsp.loadEnsemble(directory), repeat)
+    t_row, _ = bestOf(lambda: [loaded.bands[i] for i in range(0, structures, 97)], repeat)
+    identical = all(np.array_equal(loaded.bands[i], bands[i]) for i in range(structures))
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    print("{} structures, {} bands".format(structures, int(np.sum(lengths))))
+    print("memory: {:.1f} MB as lists, {:.1f} MB as columns".format(m_lists / 2.0 ** 20, m_columns / 2.0 ** 20))
+    print("mask by weight and strength: {:.1f} ms as lists, {:.1f} ms as columns".format(t_masklists * 1e3,
+                                                                                       t_maskcolumns * 1e3))
+    print("save: {:.1f} ms ({:.1f} MB), load (mmap): {:.2f} ms, identical: {}".format(t_save * 1e3, size / 2.0 ** 20,
+                                                                                     t_load * 1e3, identical))
+
+
+def importTimes(module):
+    "Import module in a fresh interpreter, return its cumulative import time (in s) and all imported modules"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) * 1e-6
+    return times[module], set(times)
+
+
+def benchStartup(modules, repeat, limit=None):
+    """
+    Import times of the numpy-only entry points. Fails (exit status 1) if
+    one of them imports matplotlib or takes longer than limit ms.
+    """
+    print("{:>18} {:>10} {:>11}".format("module", "import ms", "matplotlib"))
+    failed = False
+    for module in modules:
+        best = min(importTimes(module)[0] for _ in range(repeat))
+        plotting = any(name.split(".")[0] == "matplotlib" for name in importTimes(module)[1])
+        print("{:>18} {:>10.1f} {:>11}".format(module, best * 1e3, "imported" if plotting else "-"))
+        if plotting or (limit is not None and best * 1e3 > limit):
+            failed = True
+    if failed:
+        print("Startup regression")
+        sys.exit(1)
+
+
+def writeSynthetic(filename, program="orca", roots=50, size=0, seed=0):
+    """
+    Write a synthetic ORCA (orca: version 4/5 tables, orca6: version 6
+    tables plus velocity gauge and spin-orbit corrected ones) or Gaussian
+    (g09, g16) output with roots excited states (absorption and
+    CD/rotatory strengths) and a Gibbs free energy, preceded by about size
+    bytes of SCF iterations as in long production outputs. The same seed
+    gives the same file.
+    """
+    rng = np.random.RandomState(seed)
+    wavelengths = np.sort(rng.uniform(120.0, 450.0, roots))[::-1]
+    oscstr = rng.uniform(0.0, 0.3, roots)
+    rotstr = rng.uniform(-50.0, 50.0, roots)
+    gibbs = -1000.0 - rng.uniform(0.0, 0.01)
+    if program.startswith("orca"):
+        filler = "".join("{:5d}  {:18.10f}  {:.2e}  {:.2e}  {:.2e}  {:9.4f}  {:9.4f}\n".format(
+            i, gibbs + 1e-4 / (i + 1), 1e-5, 1e-6, 1e-7, 0.5, 0.1) for i in range(1000))
+        with open(filename, 'w') as f:
+            f.write("                                 * O   R   C   A *\n\n")
+            if program == "orca":
+                f.write("                         Program Version 4.2.1 -  RELEASE  -\n\n")
+                writeFiller(f, filler, size)
+                f.write("Final Gibbs free enthalpy         ...   {:.8f} Eh\n\n".format(gibbs))
+                writeOrcaTables(f, "", "ELECTRIC", wavelengths, oscstr, rotstr)
+            else:
+                f.write("                         Program Version 6.0.0  -   RELEASE  -\n\n")
+                writeFiller(f, filler, size)
+                f.write("Final Gibbs free energy         ...   {:.8f} Eh\n\n".format(gibbs))
+                # The velocity gauge and spin-orbit corrected tables hold other
+                # values, the parser has to prefer the electric dipole ones
+                writeOrcaTables(f, "", "ELECTRIC", wavelengths, oscstr, rotstr, transitions=True)
+                writeOrcaTables(f, "", "VELOCITY", wavelengths, oscstr * 0.9, rotstr * 0.9, transitions=True)
+                writeOrcaTables(f, "SOC CORRECTED ", "ELECTRIC", np.repeat(wavelengths, 3), np.repeat(oscstr, 3) / 3,
+                                np.repeat(rotstr, 3) / 3, transitions=True)
+    else:
+        version = {"g09": "09", "g16": "16"}[program]
+        filler = "".join(" Cycle{:5d}  Pass 1  IDiag  1:\n E= {:.12f}     Delta-E=  -0.000000000001 Rises=F\n".format(
+            i, gibbs + 1e-4 / (i + 1)) for i in range(1000))
+        with open(filename, 'w') as f:
+            f.write(" Entering Gaussian System, Link 0={}\n".format(program))
+            writeFiller(f, filler, size)
+            f.write(" Excitation energies and oscillator strengths:\n\n")
+            for i in range(roots):
+                f.write(" Excited State {:3d}:      Singlet-A      {:.4f} eV  {:.2f} nm  f={:.4f}  <S**2>=0.000\n".format(
+                    i + 1, 1239.84193 / wavelengths[i], wavelengths[i], oscstr[i]))
+                f.write("      10 -> 11         0.70000\n")
+            f.write(" SavETr:  write IOETrn=   770 NScale= 10 NData=  16 NLR=1 NState=   {} LETran=     190.\n".format(
+                roots))
+            f.write(" Rotatory Strengths (R) in cgs (10**-40 erg-esu-cm/Gauss)\n"
+                    "       state          XX          YY          ZZ    R(velocity)    E-M Angle\n")
+            for i in range(roots):
+                f.write("       {:4d}       0.0000      0.0000      0.0000  {:10.4f}       90.00\n".format(
+                    i + 1, rotstr[i]))
+            f.write(" 1/2[<0|del|b>*<b|r|0> + (<0|r|b>*<b|del|0>)*]\n")
+            f.write(" Sum of electronic and thermal Free Energies=        {:.6f}\n".format(gibbs))
+            f.write(" Normal termination of Gaussian {}\n".format(version))
+
+
+def writeOrcaTables(f, prefix, gauge, wavelengths, oscstr, rotstr, transitions=False):
+    """
+    Write an ORCA absorption and CD table to f, in the layout of ORCA 6
+    (transition labels, energies in eV and cm-1) if transitions is set
+    """
+    if transitions:
+        labels = ["  0-1A  ->  {}-1A ".format(i + 1) for i in range(len(wavelengths))]
+        energies = ["{:10.6f}  {:8.1f}".format(1239.84193 / nm, 1e7 / nm) for nm in wavelengths]
+        header = "     Transition      Energy     Energy  Wavelength"
+        units = "                      (eV)      (cm-1)    (nm)"
+    else:
+        labels = ["{:4d}".format(i + 1) for i in range(len(wavelengths))]
+        energies = ["{:7.1f}".format(1e7 / nm) for nm in wavelengths]
+        header = "State   Energy  Wavelength"
+        units = "        (cm-1)    (nm)    "
+    title = "{}ABSORPTION SPECTRUM VIA TRANSITION {} DIPOLE MOMENTS".format(prefix, gauge)
+    f.write("-" * 77 + "\n         " + title + "\n" + "-" * 77 + "\n" + header +
+            "   fosc         T2         TX        TY        TZ  \n" + units +
+            "              (au**2)     (au)      (au)      (au) \n" + "-" * 77 + "\n")
+    for label, energy, nm, value in zip(labels, energies, wavelengths, oscstr):
+        f.write("{}   {}    {:5.1f}   {:.9f}   {:.5f}   0.00000   0.00000   0.00000\n".format(
+            label, energy, nm, value, value / 4))
+    if transitions:
+        title = "{}CD SPECTRUM VIA TRANSITION {} DIPOLE MOMENTS".format(prefix, gauge)
+    else:
+        title = prefix + "CD SPECTRUM"
+    f.write("\n" + "-" * 67 + "\n                             " + title + "\n" + "-" * 67 + "\n" + header +
+            "       R         MX        MY        MZ   \n" + units + "   (1e40*sgs)   (au)      (au)      (au)  \n" +
+            "-" * 67 + "\n")
+    for label, energy, nm, value in zip(labels, energies, wavelengths, rotstr):
+        f.write("{}   {}    {:5.1f}   {:10.5f}   0.00000   0.00000   0.00000\n".format(label, energy, nm, value))
+    f.write("\n")
+
+
+def writeFiller(f, filler, size):
+    "Write about size bytes of the filler text to f"
+    block = filler * max(1, (1 << 20) // len(filler))
+    written = 0
+    while written < size:
+        f.write(block[:size - written])
+        written += len(block[:size - written])
+    if size:
+        f.write("\n")
+
+
+def sizeArgument(text):
+    "Byte sizes such as 2G; plain integers for checkouts without wsp.parseSize"
+    if hasattr(wsp, "parseSize"):
+        return wsp.parseSize(text)
+    return int(text)
+
+
+def quietly(function, stream, *args):
+    "Call function with its prints redirected to stream"
+    with contextlib.redirect_stdout(stream):
+        return function(*args)
+
+
+def suiteCases(workdir, syntheticsize, roots):
+    """
+    The cases of the benchmark suite as {name: function}. Cases whose API
+    does not exist in the checked out wellfareSpecPlot are left out, so
+    older checkouts can be compared on the cases they share.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    cases = {}
+    extract = wsp.extractExcitations
+    if not hasattr(wsp, "ExcitationParser"):
+        # The original extractExcitations reads the verbosity from the global args of the script and only
+        # detects the program (and so only parses anything) with -v 3; its prints go to os.devnull
+        wsp.args = argparse.Namespace(verbosity=3)
+        extract = functools.partial(quietly, wsp.extractExcitations, open(os.devnull, 'w'))
+    bundled = sorted(glob.glob(os.path.join(here, '*_td.out')) + glob.glob(os.path.join(here, '*_opt.out')))
+    cases["parse/bundled"] = lambda: [extract(filename) for filename in bundled]
+    for program in ("orca", "g09"):
+        filename = os.path.join(workdir, "synthetic-{}.out".format(program))
+        writeSynthetic(filename, program, roots, syntheticsize)
+        cases["parse/synthetic-{}".format(program)] = lambda filename=filename: extract(filename)
+
+    for structures, points in ((10, 1000), (100, 1000), (100, 10000)):
+        bands, strengths, ecds, weights = randomEnsemble(structures, 30)
+        x = np.linspace(100.0, 600.0, points)
+        for function in ("gaussian", "lorentzian"):
+            name = "broaden/{}-{}x{}".format(function, structures, points)
+            if hasattr(wsp, "ensembleSpectra"):
+                cases[name] = functools.partial(wsp.ensembleSpectra, x, bands, strengths, ecds, weights,
+                                                function=function)
+            else:
+                cases[name] = functools.partial(legacyBroaden, x, bands, strengths, ecds, weights, 3099.6, 7.5,
+                                                function)
+
+    rng = np.random.RandomState(0)
+    etenergies = list(rng.uniform(8000.0, 72000.0, 300))
+    etoscs = list(rng.uniform(0.0, 1.0, 300))
+    cases["uvvis/spectra-300"] = lambda: plot_uvvis.spectra(etenergies, etoscs)
+
+    if hasattr(wsp, "writeCSV"):
+        x = np.linspace(100.0, 1000.0, 10000)
+        individual = rng.uniform(0.0, 1e4, (100, len(x)))
+        names = ["conformer{}.out".format(i) for i in range(100)]
+        csvfile = os.path.join(workdir, "export.csv")
+        cases["export/csv-100x10000"] = functools.partial(wsp.writeCSV, csvfile, x, names, individual.sum(axis=0),
+                                                          individual, individual.sum(axis=0), individual)
+
+    if hasattr(wsp, "plotUVVis") and hasattr(wsp, "pyplot"):
+        bands, strengths, ecds, weights = randomEnsemble(4, 30)
+        x = np.linspace(100.0, 600.0, 1000)
+        (composite, _), (individual, _) = wsp.ensembleSpectra(x, bands, strengths, ecds, weights)
+
+        def render(extension, x=x):
+            fig = wsp.plotUVVis(x, composite, individual, ["a", "b", "c", "d"], bands, strengths, [0.0, 1.0, 2.0, 3.0],
+                                weights, 4, cutoff=0.0)
+            fig.savefig(os.path.join(workdir, "figure." + extension), bbox_inches='tight')
+            wsp.pyplot().close(fig)
+
+        cases["render/png"] = functools.partial(render, "png")
+        cases["render/pdf"] = functools.partial(render, "pdf")
+    return cases
+
+
+def runSuite(repeat, syntheticsize, roots):
+    "Run all suite cases, returns the results as a dict for JSON"
+    here = os.path.dirname(os.path.abspath(__file__))
+    source = os.path.dirname(os.path.abspath(wsp.__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=source, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ""
+    results = {"meta": {"source": source, "commit": commit, "python": platform.python_version(),
+                        "numpy": np.__version__, "machine": platform.machine(), "repeat": repeat,
+                        "synthetic_size": syntheticsize, "roots": roots, "benchmark": here},
+               "cases": {}}
+    workdir = tempfile.mkdtemp()
+    try:
+        for name, function in sorted(suiteCases(workdir, syntheticsize, roots).items()):
+            times = []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                function()
+                times.append(time.perf_counter() - begin)
+            results["cases"][name] = {"best": min(times), "median": float(np.median(times)), "times": times,
+                                      "peak_memory": peakMemory(function)}
+            print("{:<32} {:>10.2f} ms {:>10.2f} MB".format(name, min(times) * 1e3,
+                                                           results["cases"][name]["peak_memory"] / 2.0 ** 20))
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return results
+
+
+def compareResults(base, new, threshold=0.1):
+    """
+    Print the cases of two suite results side by side. Returns the names of
+    the cases that got slower by more than threshold (as a fraction).
+    """
+    regressions = []
+    print("{:<32} {:>10} {:>10} {:>7}".format("case", "base ms", "new ms", "ratio"))
+    for name in sorted(set(base["cases"]) | set(new["cases"])):
+        if name not in base["cases"] or name not in new["cases"]:
+            print("{:<32} {:>10} {:>10} {:>7}".format(name, "-" if name not in base["cases"] else "",
+                                                     "-" if name not in new["cases"] else "", ""))
+            continue
+        t_base = base["cases"][name]["best"]
+        t_new = new["cases"][name]["best"]
+        flag = ""
+        if t_new > t_base * (1.0 + threshold):
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{:<32} {:>10.2f} {:>10.2f} {:>7.2f}{}".format(name, t_base * 1e3, t_new * 1e3, t_new / t_base, flag))
+    return regressions
+
+
+def suiteOf(checkout, repeat, syntheticsize, roots):
+    "Run the suite against the wellfareSpecPlot/plot_uvvis of another checkout (in a subprocess)"
+    descriptor, filename = tempfile.mkstemp(suffix=".json")
+    os.close(descriptor)
+    script = os.path.abspath(__file__)
+    code = ("import sys, runpy; sys.path.insert(0, {!r}); sys.argv = {!r}; "
+            "runpy.run_path({!r}, run_name='__main__')").format(
+        os.path.abspath(checkout), [script, "-r", str(repeat), "suite", "--json", filename, "--synthetic-size",
+                                    str(syntheticsize), "--roots", str(roots)], script)
+    subprocess.run([sys.executable, "-c", code], cwd=os.path.abspath(checkout), check=True)
+    with open(filename) as f:
+        results = json.load(f)
+    os.remove(filename)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks for wellfareSpecPlot")
+    parser.add_argument("-r", "--repeat", help="repetitions per timing (best is reported)", type=int, default=5)
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    parse = subparsers.add_parser("parse", help="legacy multi-pass vs. single-pass vs. reverse output parsing")
+    parse.add_argument("files", metavar='file', nargs='*', help="QM output file(s)")
+    broadening = subparsers.add_parser("broaden", help="per-peak loops vs. vectorised broadening")
+    broadening.add_argument("--structures", help="ensemble sizes", type=int, nargs='+', default=[1, 10, 100])
+    broadening.add_argument("--peaks", help="peaks per structure", type=int, default=30)
+    broadening.add_argument("--points", help="grid points", type=int, default=1000)
+    broadening.add_argument("-f", "--function", choices=["gaussian", "lorentzian"], default="gaussian")
+    broadening.add_argument("--max-memory", help="memory budget of the vectorised broadening, e.g. 64M",
+                            type=sizeArgument)
+    broadening.add_argument("--tolerance", help="truncate the bands at this fraction of their height", type=float)
+    broadening.add_argument("--stdev", help="Gaussian broadening parameter (nm)", type=float, default=3099.6)
+    broadening.add_argument("--hwhm", help="Lorentzian half width at half height (nm)", type=float, default=7.5)
+    fft = subparsers.add_parser("fft", help="direct summation vs. FFT convolution (crossover)")
+    fft.add_argument("--peaks", help="numbers of lines", type=int, nargs='+',
+                     default=[1, 3, 10, 30, 100, 300, 1000, 3000, 10000])
+    fft.add_argument("--points", help="grid points", type=int, default=2000)
+    fft.add_argument("-f", "--function", choices=["gaussian", "lorentzian"], default="gaussian")
+    fft.add_argument("--stdev", help="Gaussian broadening parameter (nm)", type=float, default=3099.6)
+    fft.add_argument("--hwhm", help="Lorentzian half width at half height (nm)", type=float, default=7.5)
+    uvvis = subparsers.add_parser("uvvis", help="loops vs. numpy in plot_uvvis.spectra")
+    uvvis.add_argument("--transitions", help="numbers of transitions", type=int, nargs='+', default=[10, 100, 300])
+    uvvis.add_argument("--resolution", help="energy resolution (eV)", type=float, default=0.01)
+    export = subparsers.add_parser("export", help="row by row vs. bulk csv writing and .npz output")
+    export.add_argument("--structures", help="ensemble sizes", type=int, nargs='+', default=[1, 10, 100])
+    export.add_argument("--points", help="grid points", type=int, default=10000)
+    startup = subparsers.add_parser("startup", help="import time of the modules without plotting (-X importtime)")
+    startup.add_argument("--modules", nargs='+', default=["wellfareSpecPlot", "plot_uvvis"])
+    startup.add_argument("--limit", help="fail if an import takes longer (in ms)", type=float)
+    render = subparsers.add_parser("render", help="new figure per spectrum vs. reused batch figure")
+    render.add_argument("--figures", help="number of spectra", type=int, default=50)
+    render.add_argument("--peaks", help="bands per spectrum", type=int, default=30)
+    render.add_argument("--points", help="grid points", type=int, default=1000)
+    render.add_argument("--format", help="output file format", choices=["png", "pdf"], default="png")
+    render.add_argument("--workers", help="numbers of rendering processes to try", type=int, nargs='*', default=[2, 4])
+    sticks = subparsers.add_parser("sticks", help="per-line vs. per-panel line spectra (vlines)")
+    sticks.add_argument("--panels", help="number of panels", type=int, default=5)
+    sticks.add_argument("--bands", help="lines per panel", type=int, default=100)
+    sticks.add_argument("--format", help="output file format", choices=["png", "pdf"], default="pdf")
+    follow = subparsers.add_parser("follow", help="reading a growing output again vs. following its tail")
+    follow.add_argument("file", nargs='?', help="QM output to grow (default: 1-ttt_td.out)")
+    follow.add_argument("--copies", help="copies of the output in the growing file", type=int, default=100)
+    follow.add_argument("--append", help="KB appended before every check", type=int, default=64)
+    sweep = subparsers.add_parser("sweep", help="broadening per temperature vs. one temperature sweep")
+    sweep.add_argument("--structures", help="ensemble size", type=int, default=100)
+    sweep.add_argument("--temperatures", help="number of temperatures", type=int, default=50)
+    sweep.add_argument("--peaks", help="peaks per structure", type=int, default=30)
+    sweep.add_argument("--points", help="grid points", type=int, default=1000)
+    prune = subparsers.add_parser("prune", help="full broadening vs. pruning small weights and bands first")
+    prune.add_argument("--structures", help="ensemble size", type=int, default=300)
+    prune.add_argument("--peaks", help="peaks per structure", type=int, default=30)
+    prune.add_argument("--points", help="grid points", type=int, default=1000)
+    prune.add_argument("--min-weight", help="weight threshold", type=float, default=1e-3)
+    prune.add_argument("--min-strength", help="oscillator strength threshold", type=float, default=0.0)
+    grid = subparsers.add_parser("grid", help="uniform vs. adaptive grids: points, time and interpolation error")
+    grid.add_argument("--structures", help="ensemble size", type=int, default=20)
+    grid.add_argument("--peaks", help="peaks per structure", type=int, default=30)
+    grid.add_argument("--tolerances", help="tolerances of the adaptive grids", type=float, nargs='+',
+                      default=[1e-2, 1e-3, 1e-4])
+    grid.add_argument("--hwhm", help="HWHM of the Lorentzians (nm)", type=float, default=7.5)
+    ragged = subparsers.add_parser("ragged", help="padded vs. CSR band arrays for different numbers of bands")
+    ragged.add_argument("--structures", help="ensemble sizes", type=int, nargs='+', default=[10, 100, 1000])
+    ragged.add_argument("--peaks", help="most peaks per structure", type=int, default=30)
+    ragged.add_argument("--points", help="grid points", type=int, default=1000)
+    ragged.add_argument("--max-memory", help="tile budget of the broadening, e.g. 8M", type=sizeArgument,
+                        default=8 << 20)
+    columns = subparsers.add_parser("columns", help="lists of lists vs. the columnar Ensemble")
+    columns.add_argument("--structures", help="ensemble size", type=int, default=10000)
+    columns.add_argument("--peaks", help="most peaks per structure", type=int, default=50)
+    generate = subparsers.add_parser("generate", help="write synthetic ORCA/Gaussian outputs")
+    generate.add_argument("directory", help="where to write them")
+    generate.add_argument("--program", choices=["orca", "orca6", "g09", "g16"], default="orca")
+    generate.add_argument("--conformers", help="number of outputs", type=int, default=10)
+    generate.add_argument("--roots", help="excited states per output", type=int, default=50)
+    generate.add_argument("--size", help="SCF filler per output, e.g. 2G", type=sizeArgument, default=0)
+    suite = subparsers.add_parser("suite", help="time and memory of all hot paths, as JSON")
+    suite.add_argument("--json", help="write the results to this file")
+    suite.add_argument("--synthetic-size", help="size of the synthetic outputs, e.g. 2G", type=sizeArgument,
+                       default=64 << 20)
+    suite.add_argument("--roots", help="excited states of the synthetic outputs", type=int, default=100)
+    suite.add_argument("--against", help="also run the suite on another checkout and compare", metavar="CHECKOUT")
+    suite.add_argument("--threshold", help="slowdown counted as a regression", type=float, default=0.1)
+    compare = subparsers.add_parser("compare", help="compare two suite results and flag regressions")
+    compare.add_argument("base", help="JSON results of the reference")
+    compare.add_argument("new", help="JSON results to check")
+    compare.add_argument("--threshold", help="slowdown counted as a regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    if args.benchmark == "parse":
+        files = args.files or sorted(glob.glob(os.path.join(here, '*_td.out')) +
+                                     glob.glob(os.path.join(here, '*_opt.out')))
+        if not files:
+            print("No output files to parse")
+            sys.exit()
+        benchParse(files, args.repeat)
+
+    elif args.benchmark == "broaden":
+        benchBroaden(args.structures, args.peaks, args.points, args.function, args.repeat, args.max_memory,
+                     args.tolerance, args.stdev, args.hwhm)
+
+    elif args.benchmark == "fft":
+        benchFFT(args.peaks, args.points, args.function, args.repeat, args.stdev, args.hwhm)
+
+    elif args.benchmark == "uvvis":
+        benchUVVis(args.transitions, args.resolution, args.repeat)
+
+    elif args.benchmark == "export":
+        benchExport(args.structures, args.points, args.repeat)
+
+    elif args.benchmark == "startup":
+        benchStartup(args.modules, args.repeat, args.limit)
+
+    elif args.benchmark == "render":
+        benchRender(args.figures, args.peaks, args.points, args.format, args.workers)
+
+    elif args.benchmark == "sticks":
+        benchSticks(args.panels, args.bands, args.format, args.repeat)
+
+    elif args.benchmark == "follow":
+        benchFollow(args.file or os.path.join(here, '1-ttt_td.out'), args.copies, args.append, args.repeat)
+
+    elif args.benchmark == "sweep":
+        benchSweep(args.structures, args.temperatures, args.peaks, args.points, args.repeat)
+
+    elif args.benchmark == "prune":
+        benchPrune(args.structures, args.peaks, args.points, args.min_weight, args.min_strength, args.repeat)
+
+    elif args.benchmark == "grid":
+        benchGrid(args.structures, args.peaks, args.tolerances, args.hwhm, args.repeat)
+
+    elif args.benchmark == "ragged":
+        benchRagged(args.structures, args.peaks, args.points, args.repeat, args.max_memory)
+
+    elif args.benchmark == "columns":
+        benchColumns(args.structures, args.peaks, args.repeat)
+
+    elif args.benchmark == "generate":
+        if not os.path.isdir(args.directory):
+            os.makedirs(args.directory)
+        for i in range(args.conformers):
+            writeSynthetic(os.path.join(args.directory, "conformer{}_{}.out".format(i + 1, args.program)),
+                           args.program, args.roots, args.size, seed=i)
+
+    elif args.benchmark == "suite":
+        results = runSuite(args.repeat, args.synthetic_size, args.roots)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        if args.against:
+            print("\nRunning the suite on {}".format(args.against))
+            base = suiteOf(args.against, args.repeat, args.synthetic_size, args.roots)
+            print("")
+            if compareResults(base, results, args.threshold):
+                sys.exit(1)
+
+    elif args.benchmark == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if compareResults(base, new, args.threshold):
+            sys.exit(1)
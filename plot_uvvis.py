@@ -1,72 +1,39 @@
 """Adapted from J. Grant Hill's PlotBand script, http://www.grant-hill.group.shef.ac.uk/plot-uv.html"""
 
 import sys
-# Check for numpy and matplotlib, try to exit gracefully if not found
-import imp
+# Check for numpy, try to exit gracefully if not found; matplotlib is only
+# imported (and checked) when plotting, so spectra() works without it
 try:
-    imp.find_module('numpy')
-    foundnp = True
+    import numpy as np
 except ImportError:
-    foundnp = False
-try:
-    imp.find_module('matplotlib')
-    foundplot = True
-except ImportError:
-    foundplot = False
-if not foundnp:
     print("Numpy is required. Exiting")
     sys.exit()
-if not foundplot:
-    print("Matplotlib is required. Exiting")
-    sys.exit()
-import numpy as np
-import matplotlib.pyplot as plt
-
-
-# Information on producing spectral curves (Gaussian and Lorentzian)
-# is adapted from:
-# P. J. Stephens, N. Harada, Chirality 22, 229 (2010).
-# Gaussian curves are often a better fit for UV/Vis.
-def gaussBand(x, band, strength, stdev):
-    "Produces a Gaussian curve"
-    bandshape = 1.3062974e8 * (strength / (1e7/stdev)) * np.exp(-(((1.0/x)-(1.0/band))/(1.0/stdev))**2)
-    return bandshape
 
-def lorentzBand(x, band, strength, stdev, gamma):
-    "Produces a Lorentzian curve"
-    bandshape = 1.3062974e8 * (strength / (1e7/stdev)) * ((gamma**2)/((x - band)**2 + gamma**2))
-    return bandshape
+from wellfareSpecPlot import broaden, convertUnits, spectralUnits, SpectralGrid
 
 
 def spectra(etenergies, etoscs, low=0.5, high=10.0, resolution=0.01, smear=0.04):
     """Return arrays of the energies and intensities of a Lorentzian-blurred spectrum"""
 
     maxSlices = int((high - low) / resolution) + 1
-    peaks = len(etenergies)
 
-    spectraEV = []
-    spectraNM = []
-    spectraIntensity = []
+    # A uniform grid in eV, on which the Lorentzians are evaluated directly;
+    # the wavelengths are converted once
+    grid = SpectralGrid(np.arange(maxSlices) * resolution + low, "eV")
 
-    # eV = wavenumbers * 1.23981e-4
-    # nm = 1.0e7 / wavenumbers
+    # (transitions x slices), summed over the transitions in their original order
+    etenergies = np.asarray(etenergies, dtype=float)[:, np.newaxis]
+    etoscs = np.asarray(etoscs, dtype=float)[:, np.newaxis]
+    this_smear = smear / 0.2 * (-0.046 * etoscs + 0.20)
+    deltaE = convertUnits(etenergies, "cm-1", "eV") - grid.axis
+    spectraIntensity = np.sum(etoscs * this_smear**2 / (deltaE**2 + this_smear**2), axis=0)
 
-    for i in range(0, maxSlices):
-        # in eV
-        energy = float(i * resolution + low)
-        wavenumber = energy / 1.23981e-4
-        intensity = 0.0
-        for trans in range(0, len(etenergies)):
-            this_smear = smear / 0.2 * (-0.046 * etoscs[trans] + 0.20)
-            # print this_smear
-            deltaE = etenergies[trans] * 1.23981e-4 - energy
-            intensity = intensity + etoscs[trans] * this_smear**2 / (deltaE**2 + this_smear**2)
+    return grid.axis, grid.nm, spectraIntensity
 
-        spectraEV.append(energy)
-        spectraNM.append(float(1.0e7 / wavenumber))
-        spectraIntensity.append(intensity)
 
-    return spectraEV, spectraNM, spectraIntensity
+def spectraLists(etenergies, etoscs, low=0.5, high=10.0, resolution=0.01, smear=0.04):
+    """Same as spectra(), but returns lists (as spectra() used to)"""
+    return tuple(values.tolist() for values in spectra(etenergies, etoscs, low, high, resolution, smear))
 
 
 if __name__ == '__main__':
@@ -78,10 +45,20 @@ if __name__ == '__main__':
     parser.add_argument('plottype', choices=('jghill', 'ghutchis'), help='')
     parser.add_argument('--pdf-prefix', type=str, default='plot', help='')
     parser.add_argument('--stems', action='store_true', help='')
-    parser.add_argument('--units-input')
-    parser.add_argument('--units-output')
+    parser.add_argument('--units-input', choices=spectralUnits, default='nm',
+                        help='units of the band positions')
+    parser.add_argument('--units-output', choices=spectralUnits, default='nm',
+                        help='units of the x axis of the plot')
+    parser.add_argument('--engine', choices=('direct', 'fft'), default='direct',
+                        help='sum up the bands directly or convolve the line spectrum via FFT')
     args = parser.parse_args()
 
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("Matplotlib is required. Exiting")
+        sys.exit()
+
     # Adjust the following three variables to change which area of the
     # spectrum is plotted and number of points used in plotting the
     # curves
@@ -95,7 +72,7 @@ if __name__ == '__main__':
     # For Lorentzians, gamma is half bandwidth at half peak height
     # (nm)
     gamma = 12.5
-    # Excitation energies in nm
+    # Excitation energies (in --units-input, nm by default)
     bands = [330, 328, 328, 308, 290, 290, 288, 283, 276, 270, 268]
     # Oscillator strengths (dimensionless)
     f = [7.90e-7, 0.00, 7.16e-4, 1.02e-2, 1.38e-6, 2.94e-7, 0.00, 8.86e-4, 1.54e-5, 1.25e-2, 9.31e-3]
@@ -107,38 +84,39 @@ if __name__ == '__main__':
         sys.exit()
 
 
+    labels = {'nm': '$\lambda$ / nm', 'eV': '$E$ / eV', 'cm-1': '$\\tilde{\\nu}$ / cm$^{-1}$'}
+
     if args.plottype == 'jghill':
 
-        x = np.linspace(start, finish, points)
+        # A grid that is uniform in the output units, over the same range
+        low, high = sorted(convertUnits([start, finish], 'nm', args.units_output))
+        x = SpectralGrid(np.linspace(low, high, points), args.units_output)
+        wavelengths = convertUnits(bands, args.units_input, 'nm')
 
-        composite = 0
-        for count, peak in enumerate(bands):
-            if args.bandtype == 'gaussian':
-                thispeak = gaussBand(x, peak, f[count], stdev)
-            elif args.bandtype == 'lorentzian':
-                thispeak = lorentzBand(x, peak, f[count], stdev, gamma)
-            else:
-                sys.exit()
-            composite += thispeak
+        # All bands as a single "structure" for the vectorised broadening
+        composite, _ = broaden(x, [wavelengths], [f], np.full((1, len(bands)), stdev),
+                               np.full((1, len(bands)), gamma), function=args.bandtype, engine=args.engine)
 
 
         fig, ax = plt.subplots()
 
-        ax.plot(x, composite)
+        ax.plot(x.axis, composite)
 
         if args.stems:
-            ax.stem(bands, f, markerfmt='.')
+            ax.stem(convertUnits(wavelengths, 'nm', args.units_output), f, markerfmt='.')
 
-        plt.xlabel('$\lambda$ / nm')
+        plt.xlabel(labels[args.units_output])
         plt.ylabel('$\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
 
     elif args.plottype == 'ghutchis':
 
-        spectraEV, spectraNM, spectraIntensity = spectra(bands, f)
+        spectraEV, spectraNM, spectraIntensity = spectra(convertUnits(bands, args.units_input, 'cm-1'), f)
 
         fig, ax = plt.subplots()
 
-        ax.plot(spectraNM, spectraIntensity)
+        ax.plot(convertUnits(spectraEV, 'eV', args.units_output), spectraIntensity)
+
+        plt.xlabel(labels[args.units_output])
 
     else:
         sys.exit()
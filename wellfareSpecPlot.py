@@ -1,9 +1,60 @@
+"""
+WellFAReSpecPlot: plot UV-Vis and ECD spectra of Boltzmann-weighted ensembles.
+
+Requires numpy, and matplotlib for the plots. Optional: pyarrow (--save
+*.parquet) and h5py (--save *.h5); neither is imported unless used.
+
+Besides the command line, the stages can be used as a library:
+
+    names, bands, strengths, ecds, energies = readEnsemble(files)
+    weights = ensembleWeights(energies, temperature=298.15)
+    x, start, finish, points = plotGrid(bands)
+    (composite, composite_ecd), (individual, individual_ecd) = ensembleSpectra(x, bands, strengths, ecds, weights)
+    writeCSV("spectra.csv", x, names, composite, individual, composite_ecd, individual_ecd)
+    sigstruct, ecd_sigstruct = significantStructures(weights, ecds)
+    plotUVVis(x, composite, individual, names, bands, strengths, energies, weights, sigstruct).savefig("UV.png")
+
+    # Composite spectra (temperatures x points) for a temperature sweep
+    weights, sweep, sweep_ecd = temperatureSweep(x, bands, strengths, ecds, energies, [250.0, 300.0, 350.0])
+
+    # The same data as one array per column (the structures are views), saved and memory-mapped again
+    ensemble = readColumns(files)
+    ensemble.select(ensemble.weights() > 1e-3).strongBands(1e-4).save("screening")
+    ensemble = loadEnsemble("screening")
+    (composite, composite_ecd), (individual, individual_ecd) = ensembleSpectra(
+        x, ensemble.bands, ensemble.strengths, ensemble.ecds, ensemble.weights())
+
+    # Widths per band (here narrower for stronger bands) instead of one for all
+    stdevs, gammas = bandWidths(bands, strengths, rule="strength")
+    (composite, composite_ecd), (individual, individual_ecd) = ensembleSpectra(x, bands, strengths, ecds, weights,
+                                                                               stdevs, gammas)
+
+    # A non-uniform grid, dense only where the spectra are curved
+    x = adaptiveGrid(bands, strengths, ecds, weights, start, finish, tolerance=1e-3)
+
+    # Broadening on a grid that is uniform in eV (or cm-1), the bands stay in nm
+    x = SpectralGrid(np.linspace(2.0, 6.0, 1000), "eV")
+    (composite, composite_ecd), (individual, individual_ecd) = ensembleSpectra(x, bands, strengths, ecds, weights)
+
+    # Outputs of another program version: add an OutputFormat to the parser registry
+    registerFormat(GaussianFormat("g98"))
+"""
 import sys
 import os.path
 import time
 import argparse
 import csv
-from importlib.util import find_spec
+import json
+import re
+import mmap
+import codecs
+import functools
+import multiprocessing
+import struct
+import hashlib
+import tempfile
+import glob
+import tracemalloc
 
 
 def timestamp(s):
@@ -81,149 +132,696 @@ def ProgramError(errortext=''):
 
 
 # Check for numpy, exit immediately if not available
-module_loader = find_spec('numpy')
-found = module_loader is not None
-if not found:
+try:
+    import numpy as np
+except ImportError:
     ProgramError("Module numpy is required")
     ProgramAbort()
-import numpy as np
 
 # # Check for scipy, exit immediately if not available
-# module_loader = find_spec('scipy')
-# found = module_loader is not None
-# if not found:
+# try:
+#     import scipy.optimize
+# except ImportError:
 #     ProgramError("Module scipy is required")
 #     ProgramAbort()
-# import scipy.optimize
 
-# Check for matplotlib, exit immediately if not available
-module_loader = find_spec('matplotlib.pyplot')
-found = module_loader is not None
-if not found:
-    ProgramError("Module matplotlib is required")
-    ProgramAbort()
-import matplotlib as mpl
-mpl.use("Agg")
-import matplotlib.pyplot as plt
+
+def pyplot():
+    """
+    Import matplotlib.pyplot (with the non-interactive Agg backend) on first
+    use. Parsing, broadening and export never need it, so runs without plots
+    don't pay for its startup.
+    """
+    if "matplotlib.pyplot" not in sys.modules:
+        try:
+            import matplotlib as mpl
+        except ImportError:
+            ProgramError("Module matplotlib is required")
+            ProgramAbort()
+        mpl.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 
 
-def extractExcitations(filename):
-    bands = []
-    oscstr = []
-    ecdstr = []
-    gibbsfree = 0.0
+class OutputFormat(object):
+    """
+    Entry of the parser registry: recognises the outputs of one program by a
+    cheap signature search in the header and knows the markers and the
+    layout of their blocks.
+
+    name        the program of the parsed output, stored in the cache
+    description shown with -v 3
+    signature   regex that identifies the program, searched for in the first
+                headersize bytes
+    markers     regex of the lines that may start a block, hold the energy or
+                end the job; a match is only a candidate that is checked by
+                block()/energy()/termination
+    termination text of the line that ends a job normally
+    blocks      [(block, fields)] in order of preference: a field is taken
+                from the first of its blocks that was found
+    lastblocks  [(bytes marker, block)] for searching backwards, block is
+                None for the energy
+    """
+
+    name = "N/A"
+    description = "an unknown file"
+    signature = None
+    markers = None
+    termination = None
+    blocks = []
+    lastblocks = []
+
+    def block(self, line):
+        "Return (block, lines to skip) if line starts a block, else None"
+        return None
+
+    def energy(self, line):
+        "Return the Gibbs free energy if line holds it, else None"
+        return None
+
+    def ends(self, block, line):
+        "Whether line terminates block"
+        return not line.strip()
+
+    def keeps(self, block, line):
+        "Whether line is a row of block"
+        return True
+
+    def values(self, block, rows):
+        "Return {field: values} of a completed block from its rows"
+        return {}
+
+    def choose(self, found):
+        "Return {field: values} of the preferred blocks among found {block: values}"
+        fields = {}
+        for block, _ in reversed(self.blocks):
+            if block in found:
+                fields.update(found[block])
+        return fields
+
+
+class GaussianFormat(OutputFormat):
+    "Gaussian outputs, one registry entry per version (g09, g16, ...)"
+
+    description = "a Gaussian file"
+    markers = re.compile(r"Excitation energies and oscillator strengths:|R\(velocity\)\s+E-M Angle|"
+                         r"Sum of electronic and thermal Free Energies|Normal termination of Gaussian")
+    termination = "Normal termination of Gaussian"
+    blocks = [("excitations", ("bands", "oscstr")), ("rotatory", ("ecdstr",))]
+    lastblocks = [(b"Excitation energies and oscillator strengths:", "excitations"),
+                  (b"R(velocity)", "rotatory"),
+                  (b"Sum of electronic and thermal Free Energies", None)]
+    rotatory = re.compile(r"R\(velocity\)\s+E-M Angle")
+
+    def __init__(self, version):
+        self.name = version
+        self.signature = re.compile(r"Entering Gaussian System, Link 0={}\b".format(version))
+
+    def block(self, line):
+        if line.find("Excitation energies and oscillator strengths:") != -1:
+            return "excitations", 0
+        if self.rotatory.search(line):
+            return "rotatory", 0
+        return None
+
+    def energy(self, line):
+        if line.find("Sum of electronic and thermal Free Energies") != -1:
+            return float(line.split()[7])
+        return None
+
+    def ends(self, block, line):
+        if block == "excitations":
+            return line.find("Leave Link") != -1 or line.find("SavETr") != -1 or line.find("Orbital") != -1
+        return line.find("del") != -1
+
+    def keeps(self, block, line):
+        return block != "excitations" or line.find("Excited State") != -1
+
+    def values(self, block, rows):
+        rows = [row.split() for row in rows]
+        if block == "excitations":
+            return {"bands": [float(row[6]) for row in rows], "oscstr": [float(row[8][2:]) for row in rows]}
+        return {"ecdstr": [float(row[4]) for row in rows]}
+
+
+class OrcaFormat(OutputFormat):
+    """
+    ORCA outputs. Reads the absorption and CD tables of ORCA 4 and 5 (state
+    number, energy in cm-1, wavelength, ...) and the layout of ORCA 6
+    (transition "0-1A -> 1-1A", energy in eV and cm-1, wavelength, ...).
+    The electric dipole tables are preferred over the velocity gauge ones,
+    which are preferred over the spin-orbit corrected ones.
+    """
+
+    name = "orca"
+    description = "an Orca file"
+    signature = re.compile(r"\* O   R   C   A \*")
+    markers = re.compile(r"ABSORPTION SPECTRUM|CD SPECTRUM|Final Gibbs free|ORCA TERMINATED NORMALLY")
+    termination = "ORCA TERMINATED NORMALLY"
+    blocks = [("absorption", ("bands", "oscstr")), ("absorption-velocity", ("bands", "oscstr")),
+              ("soc-absorption", ("bands", "oscstr")),
+              ("cd", ("ecdstr",)), ("cd-velocity", ("ecdstr",)), ("soc-cd", ("ecdstr",))]
+    lastblocks = [(b"ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS", "absorption"),
+                  (b"ABSORPTION SPECTRUM VIA TRANSITION VELOCITY DIPOLE MOMENTS", "absorption-velocity"),
+                  (b"ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS", "soc-absorption"),
+                  (b"CD SPECTRUM", "cd"), (b"CD SPECTRUM", "cd-velocity"), (b"CD SPECTRUM", "soc-cd"),
+                  (b"Final Gibbs free", None)]
+    titles = re.compile(r"^\s*(?:(?:SPIN ORBIT|SOC) CORRECTED (?P<soc>))?(?P<kind>ABSORPTION|CD) SPECTRUM"
+                        r"(?: VIA TRANSITION (?P<gauge>ELECTRIC|VELOCITY) (?:DIPOLE )?MOMENTS)?\s*$")
+
+    def block(self, line):
+        match = self.titles.match(line)
+        if match is None:
+            return None
+        if match.group("kind") == "CD":
+            block = "cd"
+        elif match.group("gauge") is not None:
+            block = "absorption"
+        else:
+            # Combined multipole spectra and the like
+            return None
+        if match.group("soc") is not None:
+            block = "soc-" + block
+        elif match.group("gauge") == "VELOCITY":
+            block += "-velocity"
+        # Dashes, two header lines, dashes
+        return block, 4
+
+    def energy(self, line):
+        if line.find("Final Gibbs free enthalpy") != -1 or line.find("Final Gibbs free energy") != -1:
+            return float(line.split()[5])
+        return None
+
+    def values(self, block, rows):
+        rows = [row.split() for row in rows]
+        if not rows:
+            return {"ecdstr": []} if block.endswith("cd") else {"bands": [], "oscstr": []}
+        # The state labels are followed by the energy in cm-1 (ORCA 6: in eV
+        # and cm-1), then the wavelength and the value
+        first = rows[0]
+        column = next((i for i, field in enumerate(first) if "." in field), 1) + 1
+        if "->" in first:
+            column += 1
+        if block.endswith("cd"):
+            return {"ecdstr": [float(row[column + 1]) for row in rows]}
+        return {"bands": [float(row[column]) for row in rows], "oscstr": [float(row[column + 1]) for row in rows]}
+
+
+# The parser registry, searched in order
+formats = []
+# Size of the header (in bytes) that is searched for the signatures
+headersize = 1 << 14
+# All signatures in one regex, rebuilt by registerFormat()
+signatures = None
+
+
+def registerFormat(format):
+    "Add format (an OutputFormat) to the parser registry"
+    global signatures
+    formats.append(format)
+    signatures = re.compile("|".join("(?:{})".format(f.signature.pattern) for f in formats))
+
+
+def sniffFormat(header):
+    "Return the registered format whose signature comes first in header, or None"
+    match = signatures.search(header)
+    if match is None:
+        return None
+    for format in formats:
+        if format.signature.match(header, match.start()):
+            return format
+
+
+def findFormat(name):
+    "Return the registered format called name, or None"
+    for format in formats:
+        if format.name == name:
+            return format
+    return None
+
+
+registerFormat(GaussianFormat("g16"))
+registerFormat(GaussianFormat("g09"))
+registerFormat(GaussianFormat("g03"))
+registerFormat(OrcaFormat())
+
+
+class ExcitationParser(object):
+    """
+    Single-pass state machine that collects the *last* absorption spectrum,
+    the *last* CD spectrum and the *last* Gibbs free energy of a QM output.
+
+    Text is pushed through feed() in chunks of any size. Until a signature
+    of the parser registry is found the parser searches for those, then it
+    jumps straight to the next marker of that format with one regex search,
+    so only the lines of interest are split off. Only completed blocks
+    replace earlier results, a half-written block at the end of the input is
+    ignored.
+    """
+
+    def __init__(self, format=None):
+        self.format = format
+        self.program = "N/A" if format is None else format.name
+        self.bands = []
+        self.oscstr = []
+        self.ecdstr = []
+        self.gibbsfree = 0.0
+        # The last completed block of each kind
+        self.found = {}
+        # Number of completed blocks
+        self.blocks = 0
+        # Set once the header was read without finding a signature
+        self.unknown = False
+        # Whether the job ended normally after the last block
+        self.terminated = False
+        self._state = None
+        self._skip = 0
+        self._block = []
+        self._pending = ""
+        # Position of _pending in the whole text
+        self._offset = 0
+
+    def feed(self, text):
+        """
+        Advance the state machine over the next chunk of text. Signatures are
+        only searched for in the first headersize characters; without one
+        the text is of an unknown program and the rest is ignored.
+        """
+        if self.unknown:
+            return
+        data = self._pending + text
+        pos = 0
+        while True:
+            if self._state is None:
+                if self.format is None:
+                    match = signatures.search(data, pos, max(pos, headersize - self._offset))
+                    if match is None and self._offset + len(data) >= headersize:
+                        self.unknown = True
+                        self._pending = ""
+                        return
+                else:
+                    match = self.format.markers.search(data, pos)
+                if match is None:
+                    # Only the unfinished last line can still turn into a marker
+                    pos = max(pos, data.rfind("\n", pos) + 1)
+                    break
+                linestart = max(pos, data.rfind("\n", pos, match.start()) + 1)
+                lineend = data.find("\n", match.end())
+                if lineend == -1:
+                    pos = linestart
+                    break
+                pos = lineend + 1
+                self._line(data[linestart:pos])
+            else:
+                lineend = data.find("\n", pos)
+                if lineend == -1:
+                    break
+                line = data[pos:lineend + 1]
+                pos = lineend + 1
+                self._line(line)
+        self._pending = data[pos:]
+        self._offset += pos
+
+    def close(self):
+        "Process a last line that is not terminated by a newline, the text is of an unknown program without a format"
+        if self._pending:
+            line, self._pending = self._pending, ""
+            if self.format is None:
+                if self._offset < headersize:
+                    self._line(line[:headersize - self._offset])
+            elif self._state is not None or self.format.markers.search(line):
+                self._line(line)
+        self.unknown = self.format is None
+
+    def _line(self, line):
+        if self._state is None:
+            if self.format is None:
+                format = sniffFormat(line)
+                if format is not None:
+                    self.format = format
+                    self.program = format.name
+            else:
+                self._start(line)
+        elif self._skip > 0:
+            self._skip -= 1
+        elif self.format.ends(self._state, line):
+            self._finish()
+        elif self.format.keeps(self._state, line):
+            self._block.append(line)
+
+    def _start(self, line):
+        "Start a block or read the energy if line is a marker, return whether it was one"
+        self._block = []
+        block = self.format.block(line)
+        if block is not None:
+            self._state, self._skip = block
+            # Blocks after the end of a job belong to the next one
+            self.terminated = False
+            return True
+        if self.format.termination is not None and line.find(self.format.termination) != -1:
+            self.terminated = True
+            return True
+        energy = self.format.energy(line)
+        if energy is not None:
+            self.gibbsfree = energy
+            return True
+        return False
+
+    def _finish(self):
+        self.found[self._state] = self.format.values(self._state, self._block)
+        self._choose()
+        self.blocks += 1
+        self._state = None
+        self._block = []
+
+    def _choose(self):
+        for field, values in self.format.choose(self.found).items():
+            setattr(self, field, values)
+
+    def result(self):
+        return self.bands, self.oscstr, self.gibbsfree, self.ecdstr
+
+
+# Size of the chunks (in characters) that are handed to the ExcitationParser
+readsize = 1 << 20
+# Size of the chunks (in bytes) that are decoded after a marker when reading backwards
+tailsize = 1 << 16
+
+
+def readExcitations(filename):
+    "Read filename in one pass, returns the ExcitationParser or None if it can't be opened"
     try:
         f = open(filename, 'r')
     except:
         ProgramWarning("Can't open file {}".format(filename))
-        return bands, oscstr, gibbsfree, ecdstr
-    program = "N/A"
-    # Determine which QM program we're dealing with
-    for line in f:
-        if line.find("Entering Gaussian System, Link 0=g09") != -1:
-            if args.verbosity >= 3:
-                print("{} is a Gaussian file".format(filename))
-                program = "g09"
+        return None
+    # Detect the program and read all blocks in one pass through the file
+    parser = ExcitationParser()
+    with f:
+        for chunk in iter(lambda: f.read(readsize), ''):
+            parser.feed(chunk)
+            if parser.unknown:
                 break
-        elif line.find("* O   R   C   A *") != -1:
-            if args.verbosity >= 3:
-                print("{} is an Orca file".format(filename))
-                program = "orca"
+    parser.close()
+    return parser
+
+
+def lastBlock(mm, format, marker, block):
+    """
+    Search backwards through the memory map mm for the last occurrence of
+    marker that starts a complete block of the given kind (None for the
+    energy) and return the parser that read it. Returns None if there is no
+    such block.
+    """
+    end = len(mm)
+    while True:
+        start = mm.rfind(marker, 0, end)
+        if start == -1:
+            return None
+        end = start
+        linestart = mm.rfind(b"\n", 0, start) + 1
+        lineend = mm.find(b"\n", start)
+        if lineend == -1:
+            continue
+        parser = ExcitationParser(format)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        if not parser._start(decoder.decode(mm[linestart:lineend + 1])) or parser._state != block:
+            continue
+        if parser._state is None:
+            # A marker without a block, i.e. the Gibbs free energy
+            return parser
+        pos = lineend + 1
+        while parser.blocks == 0 and pos < len(mm):
+            parser.feed(decoder.decode(mm[pos:pos + tailsize]))
+            pos += tailsize
+        if parser.blocks > 0:
+            return parser
+        # The block is still being written, fall back to the one before
+
+
+def readExcitationsReverse(filename):
+    """
+    Same as readExcitations, but memory-maps the file and searches it
+    backwards from the end for the last block of each kind. Only the header
+    (for the program) and the tail of the file after the markers are read.
+    Blocks whose fields are already filled by a preferred kind are not
+    searched for. Files without a known signature in the header are of an
+    unknown program and are not read any further.
+    """
+    try:
+        f = open(filename, 'rb')
+    except:
+        ProgramWarning("Can't open file {}".format(filename))
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ExcitationParser()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            format = sniffFormat(mm[:headersize].decode("utf-8", "replace"))
+            if format is None:
+                parser = ExcitationParser()
+                parser.unknown = True
+                return parser
+            parser = ExcitationParser(format)
+            filled = set()
+            fields = dict(format.blocks)
+            for marker, block in format.lastblocks:
+                if block is not None and filled.issuperset(fields[block]):
+                    continue
+                last = lastBlock(mm, format, marker, block)
+                if last is None:
+                    continue
+                if block is None:
+                    parser.gibbsfree = last.gibbsfree
+                else:
+                    parser.found[block] = last.found[block]
+                    filled.update(fields[block])
+            parser._choose()
+    return parser
+
+
+class ExcitationFollower(object):
+    """
+    Follows a QM output that is still being written. Every poll() reads only
+    the bytes appended since the last one (from the stored byte offset) and
+    feeds them to one ExcitationParser, whose state carries a partly written
+    block or line over to the next poll. A file that shrinks or is replaced
+    is read again from the start.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.identity = None
+        self.parser = ExcitationParser()
+        # Multi-byte characters may be split between two polls
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+    def poll(self):
+        """
+        Read what was appended since the last poll. Returns True if a block
+        was completed or the job of a complete spectrum ended since then,
+        see finished().
+        """
+        try:
+            f = open(self.filename, 'rb')
+        except (IOError, OSError):
+            return False
+        with f:
+            info = os.fstat(f.fileno())
+            if (info.st_dev, info.st_ino) != self.identity or info.st_size < self.offset:
+                self.reset()
+                self.identity = (info.st_dev, info.st_ino)
+            blocks = self.parser.blocks
+            terminated = self.parser.terminated
+            f.seek(self.offset)
+            for chunk in iter(lambda: f.read(readsize), b''):
+                self.offset += len(chunk)
+                self.parser.feed(self.decoder.decode(chunk))
+        return self.parser.blocks > blocks or (self.parser.terminated > terminated and self.complete())
+
+    def complete(self):
+        "Whether the blocks read so far make up a spectrum (bands, oscillator and rotatory strengths of one length)"
+        bands, oscstr, gibbsfree, ecdstr = self.parser.result()
+        return bands != [] and len(bands) == len(oscstr) == len(ecdstr)
+
+    def finished(self):
+        "Whether the job ended normally after the blocks of a complete spectrum"
+        return self.parser.terminated and self.complete()
+
+    def result(self):
+        return self.parser.result()
+
+
+class ExcitationCache(object):
+    """
+    On-disk cache of parsed outputs. Every file gets one small binary entry
+    holding the program, the Gibbs free energy and the band, oscillator
+    strength and ECD arrays. Entries are keyed by path, size and modification
+    time or, with content=True, by a hash of the file contents. The least
+    recently used entries are evicted once the cache grows beyond maxsize bytes.
+    """
+
+    # Bump the version whenever the parsers change what they return
+    version = 2
+    header = struct.Struct("<4sH8sdIII")
+    magic = b"WFSP"
+
+    def __init__(self, directory=None, maxsize=64 << 20, content=False):
+        if directory is None:
+            directory = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                     "wellfareSpecPlot")
+        self.directory = directory
+        self.maxsize = maxsize
+        self.content = content
+
+    def path(self, filename):
+        "Location of the entry for filename"
+        stat = os.stat(filename)
+        if self.content:
+            digest = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(readsize), b''):
+                    digest.update(chunk)
+            key = "{}:{}:{}".format(self.version, stat.st_size, digest.hexdigest())
+        else:
+            key = "{}:{}:{}:{}".format(self.version, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".wfsp")
+
+    def get(self, filename):
+        "Return an ExcitationParser filled from the cache, or None on a miss"
+        try:
+            entry = self.path(filename)
+            with open(entry, 'rb') as f:
+                data = f.read()
+            os.utime(entry)
+        except OSError:
+            return None
+        if len(data) < self.header.size:
+            return None
+        magic, version, program, gibbsfree, nbands, noscstr, necdstr = self.header.unpack_from(data)
+        if magic != self.magic or version != self.version:
+            return None
+        values = np.frombuffer(data, '<f8', offset=self.header.size)
+        if len(values) != nbands + noscstr + necdstr:
+            return None
+        parser = ExcitationParser()
+        parser.program = program.rstrip(b"\0").decode()
+        parser.format = findFormat(parser.program)
+        parser.gibbsfree = gibbsfree
+        parser.bands = values[:nbands].tolist()
+        parser.oscstr = values[nbands:nbands + noscstr].tolist()
+        parser.ecdstr = values[nbands + noscstr:].tolist()
+        return parser
+
+    def put(self, filename, parser):
+        "Store the results of parser for filename"
+        data = self.header.pack(self.magic, self.version, parser.program.encode(), parser.gibbsfree,
+                                len(parser.bands), len(parser.oscstr), len(parser.ecdstr))
+        data += np.asarray(parser.bands + parser.oscstr + parser.ecdstr, '<f8').tobytes()
+        try:
+            entry = self.path(filename)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write atomically, other processes may be reading the same entry
+            f = tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+            with f:
+                f.write(data)
+            os.replace(f.name, entry)
+        except OSError:
+            pass
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return glob.glob(os.path.join(self.directory, "*.wfsp"))
+
+    def evict(self):
+        "Remove the least recently used entries until the cache fits into maxsize"
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.maxsize:
                 break
-    f.close()
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for entry in self.entries():
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+
+def extractExcitations(filename, verbosity=0, reverse=False, cache=None):
+    """
+    Return the bands (nm), oscillator strengths, Gibbs free energy and ECD
+    strengths of the QM output filename. With reverse=True the file is
+    searched backwards (see readExcitationsReverse); cache is an optional
+    ExcitationCache.
+    """
+    return extractRecord(filename, verbosity, reverse, cache)[:4]
 
-    # Excitations READING SECTION
-    excit = []
-    # Read through Gaussian file, read *last* set of "Excitation energies and oscillator strengths:"
-    if program == "g09":
-        f = open(filename, 'r')
-        for line in f:
-            if line.find("Excitation energies and oscillator strengths:") != -1:
-                del excit[:]
-                while True:
-                    readBuffer = f.__next__()
-                    if readBuffer.find("Excited State") != -1:
-                        excit.append(readBuffer)
-                    elif readBuffer.find("Leave Link") != -1 or readBuffer.find("SavETr") != -1 or readBuffer.find("Orbital") != -1:
-                        break
-        for i in excit:
-            readBuffer = i.split()
-            bands.append(float(readBuffer[6]))
-            oscstr.append(float(readBuffer[8][2:]))
-        f.close()
-        # Read ECD Data from Gaussian file
-        f = open(filename, 'r')
-        for line in f:
-            if line.find("R(velocity)    E-M Angle") != -1:
-                del excit[:]
-                while True:
-                    readBuffer = f.__next__()
-                    if readBuffer.find("del") != -1:
-                        break
-                    else:
-                        excit.append(readBuffer)
-        ecdstr = []
-        for i in excit:
-            readBuffer = i.split()
-            ecdstr.append(float(readBuffer[4]))
-        f.close()
-    # Read through Gaussian file, read *last* Gibbs free energy
-    if program == "g09":
-        gibbsfree = 0.0
-        f = open(filename, 'r')
-        for line in f:
-            if line.find("Sum of electronic and thermal Free Energies") != -1:
-                gibbsfree = float(line.split()[7])
-                # print("Gibbs free energy: {}".format(gibbsfree))
-        f.close()
-    # Read through ORCA file, read *last* set of cartesian coordinates
-    if program == "orca":
-        f = open(filename, 'r')
-        for line in f:
-            if line.find(" ABSORPTION SPECTRUM VIA TRANSITION ELECTRIC DIPOLE MOMENTS") != -1:
-                del excit[:]
-                for i in range(0, 4):
-                    readBuffer = f.__next__()
-                while True:
-                    readBuffer = f.__next__()
-                    # if line is NOT empty: read results
-                    if readBuffer and readBuffer.strip():
-                        excit.append(readBuffer)
-                    else:
-                        break
-        for i in excit:
-            readBuffer = i.split()
-            bands.append(float(readBuffer[2]))
-            oscstr.append(float(readBuffer[3]))
-        f.close()
-        # Read ECD data from ORCA file
-        f = open(filename)
-        for line in f:
-            if line.strip() == 'CD SPECTRUM':
-                del excit[:]
-                for _ in range(5):
-                    line = next(f)
-                while line.strip():
-                    tokens = line.split()
-                    ecdstr.append(float(tokens[3]))
-                    line = next(f)
-        f.close()
-    # Read through ORCA file, read *last* Gibbs free energy
-    if program == "orca":
-        f = open(filename, 'r')
-        for line in f:
-            if line.find("Final Gibbs free enthalpy") != -1:
-                gibbsfree = float(line.split()[5])
-                # print("Gibbs free energy: {}".format(gibbsfree))
-        f.close()
-    # print("Excitations: ", bands, oscstr, gibbsfree)
-    return bands, oscstr, gibbsfree, ecdstr
+
+def extractRecord(filename, verbosity=0, reverse=False, cache=None):
+    'Same as extractExcitations, plus the program that wrote filename ("N/A" if unknown)'
+    parser = None
+    if cache is not None:
+        parser = cache.get(filename)
+        if parser is not None and verbosity >= 3:
+            print("Read {} from the cache".format(filename))
+    if parser is None:
+        if reverse:
+            parser = readExcitationsReverse(filename)
+        else:
+            parser = readExcitations(filename)
+        if parser is None:
+            return [], [], 0.0, [], "N/A"
+        if cache is not None:
+            cache.put(filename, parser)
+    if parser.format is None:
+        if verbosity >= 1:
+            print("{} is of an unknown program (no known signature in its first {} KB)".format(filename,
+                                                                                              headersize >> 10))
+    elif verbosity >= 3:
+        print("{} is {} ({})".format(filename, parser.format.description, parser.program))
+    return parser.result() + (parser.program,)
+
+
+def parseFiles(filenames, extract=extractExcitations, verbosity=0, jobs=1):
+    """
+    Parse all filenames with extract, in a pool of jobs worker processes if
+    jobs > 1. The results are returned in the order of filenames.
+    """
+    worker = functools.partial(extract, verbosity=verbosity)
+    jobs = min(jobs, len(filenames))
+    if jobs <= 1:
+        return [worker(filename) for filename in filenames]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(worker, filenames, chunksize=max(1, len(filenames) // (4 * jobs)))
+    finally:
+        pool.close()
+        pool.join()
 
 
 def findmin(listoflists):
     minima = []
     for i in listoflists:
-        if i != []:
+        if len(i) > 0:
             minima.append(min(i))
     return min(minima)
 
@@ -231,7 +829,7 @@ def findmin(listoflists):
 def findmax(listoflists):
     maxima = []
     for i in listoflists:
-        if i != []:
+        if len(i) > 0:
             maxima.append(max(i))
     return max(maxima)
 
@@ -251,279 +849,1135 @@ def lorentzBand(x, band, strength, stdev, gamma):
     return bandshape
 
 
-if __name__ == '__main__':
+def padLists(listoflists, fill=np.nan):
+    "Turn a list of lists of different lengths into a 2D array, padded with fill"
+    if isinstance(listoflists, RaggedArray):
+        return listoflists.padded(fill)
+    width = max([len(i) for i in listoflists] + [0])
+    padded = np.full((len(listoflists), width), fill)
+    for i, values in enumerate(listoflists):
+        padded[i, :len(values)] = values
+    return padded
 
-    parser = argparse.ArgumentParser(
-        description="WellFAReSpecPlot: Wellington Fast Assessment of Reactions - Spectral Data Plot",
-        epilog="recognised filetypes: g09, orca")
-    parser.add_argument("files", metavar='file', help="input file(s) with spectroscopic data", nargs='+',
-                        default="reactant.log")
-    parser.add_argument("-o", "--outfile", help="save plot to file instead of displaying in gui")
-    parser.add_argument("--csv", help="save to file in csv format")
-    parser.add_argument("-c", "--cutoff", help="cutoff value for inclusion into plots",
-                        default=0.01,
-                        type=float)
-    parser.add_argument("-u", "--upper", help="highest frequency (in nm) for the plot", type=float)
-    parser.add_argument("-l", "--lower", help="lowest frequency (in nm) for the plot", type=float)
-    parser.add_argument("-b", "--broadening", help="line broadening (in nm)", type=float, default=3099.6)
-    parser.add_argument("--hwhm", help="half width at half peak height (only for Lorentzians; in nm)", type=float,
-                        default=7.5)
-    parser.add_argument("--nolines", help="prevent printing of line spectra underneath plots", action='store_true')
-    parser.add_argument("--nonames", help="prevent printing of file names in plots", action='store_true', default=False)
-    parser.add_argument("--nocontr", help="prevent printing of contributions in plots", action='store_true', default=False)
-    parser.add_argument("-t", "--totalonly", help="only print the total plot, not individual subplots", action='store_true')
-    parser.add_argument("--flipecd", help="invert the handedness of the ECD data", action='store_true')
-    parser.add_argument("-f", "--function", help="type of function to fit spectrum", choices=["gaussian", "lorentzian"],
-                        default="gaussian")
-    parser.add_argument("-p", "--points", help="number of points to plot", type=float)
-    parser.add_argument("--colourmap", help="choose colour map for the plot", type=int, choices=[0, 1, 2, 3], default=0)
-    parser.add_argument("-v", "--verbosity", help="increase output verbosity", type=int, choices=[0, 1, 2, 3], default=1)
 
-    args = parser.parse_args()
+class RaggedArray(object):
+    """
+    Rows of different lengths (e.g. the bands of the structures of an
+    ensemble) stored as CSR: all values in one float64 array and the row
+    i in values[offsets[i]:offsets[i + 1]]. Rows are views, nothing is
+    padded.
+    """
 
-    if args.outfile != None:
-        if args.outfile.lower().endswith(('.png', '.ps', '.eps', '.pdf')) == False:
-            ProgramError("Unsupported filetype requested")
-            ProgramAbort()
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
 
-    if args.verbosity >= 2:
-        ProgramHeader()
+    def __len__(self):
+        return len(self.offsets) - 1
 
-    # Create empty lists for energies, bands and osc strengths
-    energies = []
-    bands = []
-    strengths = []
-    ecds = []
-    names = []
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
 
-    # Excitation energies in nm
-    # Oscillator strengths (dimensionless)
-    for i in range(0, len(args.files)):
-        if os.path.isfile(args.files[i]):
-            if args.verbosity >= 2:
-                print("Reading from file {} now.".format(args.files[i]))
-            band, f, energy, ecd = extractExcitations(args.files[i])
-            if band == [] or f == [] or ecd == []:
-                ProgramWarning("No spectral data found in {}".format(args.files[i]))
-            elif energy == []:
-                ProgramWarning("No thermodynamic data (Gibbs free energy) found in this file!")
-            elif len(band) != len(f) or len(band) != len(ecd):
-                ProgramWarning("Inconsistency with # of bands and # of osc strengths/ecd in this file!")
-            else:
-                names.append(args.files[i])
-                bands.append(band)
-                strengths.append(f)
-                ecds.append(ecd)
-                energies = energies + [energy]
-        else:
-            ProgramWarning("The file {} doesn't exist or is not a file".format(args.files[i]))
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
-    if len(energies) > 1:
-        # Convert absolute energies into relative energies
-        originalmin = min(energies)
-        for i in range(0, len(energies)):
-            energies[i] = (energies[i] - originalmin) * 627.5095
-        # Determine Boltzmann factors for all components
-        boltzmann = np.zeros(len(energies))
-        for i in range(0, len(energies)):
-            boltzmann[i] = np.exp((-1.0 * energies[i] / (298.15 * 0.0019872041)))
-    else:
-        if len(energies) == 1:
-            boltzmann = np.ones(len(energies))
+    def lengths(self):
+        "Number of values per row"
+        return np.diff(self.offsets)
+
+    def rows(self):
+        "The row of every value"
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def like(self, values):
+        "Values of the same layout (a scalar is repeated), sharing the offsets"
+        return RaggedArray(np.broadcast_to(np.asarray(values, dtype=float), self.values.shape).copy(), self.offsets)
+
+    def take(self, indices):
+        "The rows indices (in this order) as a new RaggedArray"
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths()[indices]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        positions = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.values[positions], offsets)
+
+    def mask(self, keep):
+        "Only the values where the boolean array keep is set, as a new RaggedArray"
+        keep = np.asarray(keep, dtype=bool)
+        counts = np.concatenate([[0], np.cumsum(keep)])
+        return RaggedArray(self.values[keep], counts[self.offsets])
+
+    def padded(self, fill=np.nan):
+        "(rows x longest row) array padded with fill, as padLists()"
+        lengths = self.lengths()
+        padded = np.full((len(self), max(lengths.max(initial=0), 0)), fill)
+        padded[self.rows(), np.arange(len(self.values)) - np.repeat(self.offsets[:-1], lengths)] = self.values
+        return padded
+
+    def tolist(self):
+        return [self[i].tolist() for i in range(len(self))]
+
+
+def ragged(listoflists):
+    "A list of lists (or a RaggedArray) as a RaggedArray"
+    if isinstance(listoflists, RaggedArray):
+        return listoflists
+    lengths = [len(values) for values in listoflists]
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    values = np.concatenate([np.asarray(values, dtype=float) for values in listoflists] + [np.empty(0)])
+    return RaggedArray(values, offsets)
+
+
+# eV per cm-1
+evpercm = 1.23981e-4
+# Units of spectral axes
+spectralUnits = ("nm", "eV", "cm-1")
+
+
+def convertUnits(values, source, target):
+    "Convert wavelengths (nm), energies (eV) and wavenumbers (cm-1) into each other"
+    values = np.asarray(values, dtype=float)
+    if source == target:
+        return values
+    with np.errstate(divide='ignore'):
+        if source == "nm":
+            wavenumber = 1e7 / values
+        elif source == "eV":
+            wavenumber = values / evpercm
+        elif source == "cm-1":
+            wavenumber = values
         else:
-            ProgramError("No spectral data for plotting")
-            ProgramAbort()
+            raise ValueError("unknown units: {}".format(source))
+        if target == "nm":
+            return 1e7 / wavenumber
+        elif target == "eV":
+            return wavenumber * evpercm
+        elif target == "cm-1":
+            return wavenumber
+    raise ValueError("unknown units: {}".format(target))
 
 
-    # Initialise a stdev array for the peak broadening
-    # A sqrt(2) * standard deviation of 0.4 eV is 3099.6 nm. 0.1 eV is 12398.4 nm. 0.2 eV is 6199.2 nm.
-    stdevs = np.full([len(energies), len(bands[0])], args.broadening)
+class SpectralGrid(object):
+    """
+    A spectral axis in nm, eV or cm-1 with its wavelengths (nm) and
+    reciprocal wavelengths (1/nm) computed once. Gaussian bands are
+    evaluated on the reciprocal wavelengths and Lorentzian bands on the
+    wavelengths, so the broadening needs no conversions per point; a grid
+    that is uniform in eV or cm-1 is uniform for the Gaussians. Slicing
+    returns views of all of them.
+    """
 
-    # For Lorentzians, gamma is half bandwidth at half peak height (nm)
-    gammas = np.full([len(energies), len(bands[0])], args.hwhm)
+    def __init__(self, axis, units="nm"):
+        if units not in spectralUnits:
+            raise ValueError("unknown units: {}".format(units))
+        self.axis = np.asarray(axis, dtype=float)
+        self.units = units
+        with np.errstate(divide='ignore'):
+            if units == "nm":
+                self.nm = self.axis
+                self.reciprocal = 1.0 / self.axis
+            else:
+                self.nm = convertUnits(self.axis, units, "nm")
+                self.reciprocal = convertUnits(self.axis, units, "cm-1") / 1e7
+
+    def __len__(self):
+        return len(self.axis)
+
+    def __getitem__(self, index):
+        part = SpectralGrid.__new__(SpectralGrid)
+        part.units = self.units
+        part.axis = self.axis[index]
+        part.nm = self.nm[index]
+        part.reciprocal = self.reciprocal[index]
+        return part
+
+    def convert(self, units):
+        "The axis in other units"
+        return convertUnits(self.axis, self.units, units)
+
+
+def asGrid(x):
+    "x as a SpectralGrid, plain arrays are wavelengths (nm)"
+    if isinstance(x, SpectralGrid):
+        return x
+    return SpectralGrid(x)
 
 
-    # Find out how many structures actually contribute significantly to the UV-Vis
-    sigstruct = 0
-    if len(names) > 1:
-        for i in range(0, len(bands)):
-            if (boltzmann[i] / np.sum(boltzmann)) > args.cutoff:
-                sigstruct += 1
+def bandShapes(x, bands, stdevs, gammas=None, function="gaussian"):
+    """
+    Band shapes without the strengths on the grid x (nm or a SpectralGrid),
+    (structures x peaks x points) for (structures x peaks x 1) bands (nm),
+    stdevs and gammas. Built in place to keep only one array of that size
+    around.
+    """
+    x = asGrid(x)
+    prefactor = 1.3062974e8 / (1e7 / stdevs)
+    if function == "lorentzian":
+        shapes = np.subtract(x.nm, bands)
+        np.square(shapes, out=shapes)
+        shapes += gammas ** 2
+        np.divide(prefactor * gammas ** 2, shapes, out=shapes)
     else:
-        sigstruct = 1
+        shapes = np.subtract(x.reciprocal, 1.0 / bands)
+        shapes /= 1.0 / stdevs
+        np.square(shapes, out=shapes)
+        np.negative(shapes, out=shapes)
+        np.exp(shapes, out=shapes)
+        shapes *= prefactor
+    return shapes
 
-    # Flip the ECD spectrum (to show the "other" enantiomer)
-    if args.flipecd == True:
-        ecds = np.multiply(ecds, -1.0)
 
-    # Go through all significant structures again and check if they have an ECD spectrum
-    ecd_sigstruct = 0
-    for count, i in enumerate(np.argsort(energies)):
-        if (boltzmann[i] / np.sum(boltzmann)) > args.cutoff and max(np.absolute(ecds[i])) > 0.0:
-            ecd_sigstruct += 1
+def tileSize(nstruct, depth, npoints, maxmemory=None):
+    """
+    Number of structures and grid points per tile so that the temporary
+    (structures x depth x points) arrays of float64 fit into maxmemory bytes.
+    Whole rows of the grid are preferred.
+    """
+    if maxmemory is None:
+        return nstruct, npoints
+    cells = max(1, int(maxmemory) // (8 * depth))
+    if cells >= nstruct * npoints:
+        return nstruct, npoints
+    if cells >= npoints:
+        return cells // npoints, npoints
+    return 1, cells
 
-    # Now that we know the bands, setup plot
-    if args.lower == None:
-        start = np.trunc(max(findmin(bands) - 50.0, 0.0))
+
+# Most distinct band widths that broaden() convolves with engine="fft" (one FFT per width); with more
+# of them (e.g. width rule "strength") summing the bands directly is faster
+fftwidths = 16
+
+
+def distinctWidths(stdevs, gammas=None, function="gaussian"):
+    "Number of distinct band shapes among the (padded or ragged) widths of the bands"
+    stdevs = stdevs.values if isinstance(stdevs, RaggedArray) else np.ravel(stdevs)
+    if function != "lorentzian":
+        return len(np.unique(stdevs[~np.isnan(stdevs)]))
+    gammas = gammas.values if isinstance(gammas, RaggedArray) else np.ravel(gammas)
+    widths = np.stack([stdevs, gammas], axis=-1)
+    return len(np.unique(widths[~np.isnan(widths).any(axis=-1)], axis=0))
+
+
+def broaden(x, bands, strengths, stdevs, gammas=None, weights=None, function="gaussian", maxmemory=None,
+            tolerance=None, engine="direct"):
+    """
+    Broaden the line spectra of an ensemble of structures on the grid x in
+    one vectorised pass. x is a wavelength grid (nm) or a SpectralGrid in
+    any units, the bands are always wavelengths (nm).
+
+    bands, stdevs and gammas (only for Lorentzians) are (structures x peaks)
+    arrays, padded with NaN bands for structures with fewer peaks (see
+    padLists). strengths is a (structures x peaks) array or a stack of them,
+    e.g. (2 x structures x peaks) for UV-Vis and ECD together; the band
+    shapes are evaluated only once for all of them. weights are the
+    (normalised) Boltzmann weights of the structures. All of them can also
+    be RaggedArrays (strengths a list of them) without any padding, see
+    broadenRagged.
+
+    With maxmemory (in bytes) the band shapes are evaluated in tiles of
+    structures and grid points that fit into this budget, and the results
+    are accumulated into the preallocated output arrays.
+
+    With tolerance, every band is only evaluated where it is above tolerance
+    times its height (see broadenWindowed); windowError gives the bound of
+    the resulting error. Its temporaries are a single band window, so
+    maxmemory does not apply.
+
+    engine="fft" convolves binned line spectra with the band shape instead
+    of summing the bands (see broadenFFT), which is faster for very dense
+    line spectra at an error of ~0.1%. With more than fftwidths distinct
+    widths it falls back to the direct summation.
+
+    Returns the composite spectra (... x points) and the weighted spectra of
+    the individual structures (... x structures x points), with the same
+    leading dimensions as strengths.
+    """
+    x = asGrid(x)
+    if engine == "fft" and distinctWidths(stdevs, gammas, function) > fftwidths:
+        engine = "direct"
+    if isinstance(bands, RaggedArray):
+        if engine == "direct" and tolerance is None:
+            return broadenRagged(x, bands, strengths, stdevs, gammas, weights, function, maxmemory)
+        # The other engines work on padded arrays
+        if isinstance(strengths, RaggedArray):
+            strengths = strengths.padded(0.0)
+        else:
+            strengths = [ragged(values).padded(0.0) for values in strengths]
+        stdevs = stdevs.padded(1.0)
+        gammas = gammas.padded(1.0) if gammas is not None else None
+        bands = bands.padded()
+    bands = np.asarray(bands, dtype=float)
+    strengths = np.asarray(strengths, dtype=float)
+    nstruct, npeaks = bands.shape
+    if weights is None:
+        weights = np.ones(nstruct)
+    # Padding peaks get a harmless position and width and no intensity
+    valid = ~np.isnan(bands)
+    bands = np.where(valid, bands, 1.0)
+    stdevs = np.where(valid, stdevs, 1.0)
+    if function == "lorentzian":
+        gammas = np.where(valid, gammas, 1.0)
     else:
-        start = args.lower
-    if args.upper == None:
-        finish = np.trunc(findmax(bands) + 50.0)
+        gammas = stdevs
+    strengths = np.where(valid, strengths, 0.0) * np.asarray(weights, dtype=float)[:, np.newaxis]
+
+    lead = strengths.shape[:-2]
+    stacked = strengths.reshape((-1, nstruct, npeaks))
+    if engine == "fft":
+        individual = broadenFFT(x, bands, stacked, stdevs, gammas, function)
+    elif tolerance is not None:
+        individual = broadenWindowed(x, bands, stacked, stdevs, gammas, function, tolerance)
     else:
-        finish = args.upper
-    if args.points == None:
-        points = int((finish - start) * 2.5)
+        individual = broadenDirect(x, bands, stacked, stdevs, gammas, function, maxmemory)
+    composite = np.sum(individual, axis=-2)
+    return composite.reshape(lead + (len(x),)), individual.reshape(lead + (nstruct, len(x)))
+
+
+def broadenDirect(x, bands, strengths, stdevs, gammas, function, maxmemory=None, out=None, rows=None):
+    """
+    The summation in broaden(): the sum over the peaks of every structure as
+    one batched matrix product, in tiles that fit into maxmemory. strengths
+    are the weighted (kinds x structures x peaks), the other arrays
+    (structures x peaks) without padding. Returns (kinds x structures x points),
+    or writes the curves into the rows (default: all) of out.
+    """
+    nstruct, npeaks = bands.shape
+    if out is None:
+        out = np.empty((strengths.shape[0], nstruct, len(x)))
+    if rows is None:
+        rows = np.arange(nstruct)
+    # Consecutive rows are a view of out that the products are written to directly
+    first = rows[0] if nstruct > 0 and np.all(np.diff(rows) == 1) else None
+    # (structures x kinds x points) views of the strengths and the output for the products
+    stacked = np.moveaxis(strengths, 1, 0)
+    target = np.moveaxis(out, 1, 0)
+    bands = bands[:, :, np.newaxis]
+    stdevs = stdevs[:, :, np.newaxis]
+    gammas = gammas[:, :, np.newaxis]
+    nstep, xstep = tileSize(nstruct, npeaks + stacked.shape[1], len(x), maxmemory)
+    for i in range(0, nstruct, nstep):
+        for j in range(0, len(x), xstep):
+            shapes = bandShapes(x[j:j + xstep], bands[i:i + nstep], stdevs[i:i + nstep], gammas[i:i + nstep],
+                                function)
+            if first is not None:
+                np.matmul(stacked[i:i + nstep], shapes, out=target[first + i:first + i + nstep, :, j:j + xstep])
+            else:
+                target[rows[i:i + nstep], :, j:j + xstep] = np.matmul(stacked[i:i + nstep], shapes)
+            del shapes
+    return out
+
+
+def broadenRagged(x, bands, strengths, stdevs, gammas=None, weights=None, function="gaussian", maxmemory=None):
+    """
+    The direct summation of broaden() for RaggedArray bands, stdevs and
+    gammas and a RaggedArray (or a list of them, e.g. UV-Vis and ECD) of
+    strengths, all with the same offsets. The structures are summed up in
+    groups with the same number of bands, which are dense blocks for
+    broadenDirect(), so nothing is padded. Returns the same as broaden().
+    """
+    x = asGrid(x)
+    nstruct = len(bands)
+    if weights is None:
+        weights = np.ones(nstruct)
+    if isinstance(strengths, RaggedArray):
+        lead = ()
+        strengths = [strengths]
     else:
-        points = args.points
+        lead = (len(strengths),)
+    # (kinds x bands), weighted
+    scale = np.asarray(weights, dtype=float)[bands.rows()]
+    stacked = np.array([ragged(values).values * scale for values in strengths]).reshape((len(strengths), -1))
+    if gammas is None:
+        gammas = stdevs
+    individual = np.zeros((len(stacked), nstruct, len(x)))
+    lengths = bands.lengths()
+    for length in np.unique(lengths[lengths > 0]):
+        group = np.nonzero(lengths == length)[0]
+        # (structures x bands) positions of the values of this group
+        positions = bands.offsets[group][:, np.newaxis] + np.arange(length)
+        # Written straight into the rows of the group, a single group (or a run of structures) is a view
+        broadenDirect(x, bands.values[positions], stacked[:, positions], stdevs.values[positions],
+                      gammas.values[positions], function, maxmemory, individual, group)
+    composite = np.sum(individual, axis=-2)
+    return composite.reshape(lead + (len(x),)), individual.reshape(lead + (nstruct, len(x)))
 
-    x = np.linspace(start, finish, points)
 
-    if args.verbosity >= 2:
-        print("")
-        for i in range(1, len(bands) + 1):
-            print("Data from file no {}: {}".format(i, names[i - 1]))
-            print("Relative Gibbs energy: {:.3f}".format(energies[i - 1]))
-            print("Boltzmann factor: {:.3f}".format(boltzmann[i - 1]))
-            print("Contribution: {:.1f}%".format((boltzmann[i - 1] / np.sum(boltzmann)) * 100))
-            if args.verbosity >= 3:
-                print("  nm     UV-Vis     ECD")
-                for j in range(0, len(bands[i - 1])):
-                    print(" {:.1f}  {:7.5f} {:-10.5f}".format(bands[i - 1][j], strengths[i - 1][j], ecds[i - 1][j]))
-            print("")
-    if args.verbosity >= 1:
-        print("Examined {} file(s)".format(len(args.files)))
-        print("Found spectral data in {} file(s)".format(len(bands)))
-    if args.verbosity >= 2:
-        if args.function == "lorentzian":
-            print("Using Lorentzians with a line broadening of {:.1f} nm and a HWHM of {:.1f} nm for plotting".format(
-                args.broadening, args.hwhm))
+def bandWindows(x, bands, stdevs, gammas=None, function="gaussian", tolerance=1e-6):
+    """
+    Slices lo:hi of the grid x (ascending in nm) outside of which every band has
+    dropped below tolerance times its height. For Gaussians this is a fixed
+    number of widths (in 1/nm), for the long-tailed Lorentzians the cutoff
+    |x - band| = gamma * sqrt(1/tolerance - 1).
+    """
+    if function == "lorentzian":
+        reach = gammas * np.sqrt(1.0 / tolerance - 1.0)
+        lower = bands - reach
+        upper = bands + reach
+    else:
+        reach = np.sqrt(-np.log(tolerance)) / stdevs
+        lower = 1.0 / (1.0 / bands + reach)
+        with np.errstate(divide='ignore'):
+            upper = np.where(1.0 / bands > reach, 1.0 / (1.0 / bands - reach), np.inf)
+    x = asGrid(x).nm
+    return np.searchsorted(x, lower, 'left'), np.searchsorted(x, upper, 'right')
+
+
+def broadenWindowed(x, bands, strengths, stdevs, gammas, function, tolerance):
+    """
+    Truncated-support version of the summation in broaden(): every band is
+    only evaluated on the grid points of its bandWindows() slice, so the
+    cost is proportional to the number of non-negligible points. strengths
+    are the weighted (kinds x structures x peaks), the other arrays
+    (structures x peaks) without padding. Returns (kinds x structures x points).
+    """
+    x = asGrid(x)
+    nkinds, nstruct, npeaks = strengths.shape
+    individual = np.zeros((nkinds, nstruct, len(x)))
+    if len(x) > 1 and np.any(np.diff(x.nm) < 0):
+        # The windows need an ascending grid
+        order = np.argsort(x.nm, kind='stable')
+        individual[:, :, order] = broadenWindowed(x[order], bands, strengths, stdevs, gammas, function, tolerance)
+        return individual
+    lo, hi = bandWindows(x, bands, stdevs, gammas, function, tolerance)
+    for i, j in zip(*np.nonzero((hi > lo) & np.any(strengths != 0.0, axis=0))):
+        start, end = lo[i, j], hi[i, j]
+        shape = bandShapes(x[start:end], bands[i, j], stdevs[i, j], gammas[i, j], function)
+        individual[:, i, start:end] += strengths[:, i, j, np.newaxis] * shape
+    return individual
+
+
+def broadenFFT(x, bands, strengths, stdevs, gammas, function, resolution=32):
+    """
+    Convolution version of the summation in broaden() for dense line
+    spectra. The lines are distributed (linearly, onto the two nearest
+    nodes) over a uniform auxiliary grid on which the band shape only
+    depends on the distance to the line: 1/nm for Gaussians, nm for
+    Lorentzians. They are convolved with the band shape via FFT and
+    interpolated back onto x. resolution is the number of auxiliary grid
+    points per band width (1/stdev for Gaussians, gamma for Lorentzians);
+    the default of 32 keeps the error below ~0.1% of the largest band.
+
+    Lines with different widths are convolved separately, so this pays off
+    for few distinct widths and many lines. strengths are the weighted
+    (kinds x structures x peaks), the other arrays (structures x peaks)
+    without padding. Returns (kinds x structures x points).
+    """
+    x = asGrid(x)
+    nkinds, nstruct, npeaks = strengths.shape
+    individual = np.zeros((nkinds, nstruct, len(x)))
+    rows = individual.reshape((nkinds * nstruct, len(x)))
+    active = np.any(strengths != 0.0, axis=0)
+    if function == "lorentzian":
+        widths = np.stack([stdevs, gammas], axis=-1)[active]
+        target = x.nm
+    else:
+        widths = stdevs[active][:, np.newaxis]
+        target = x.reciprocal
+    for width in np.unique(widths, axis=0):
+        stdev = width[0]
+        if function == "lorentzian":
+            gamma = width[1]
+            group = active & (stdevs == stdev) & (gammas == gamma)
+            step = gamma / resolution
+            positions = bands
+            # The tails reach everywhere, so cover all lines
+            low = min(target.min(), positions[group].min())
+            high = max(target.max(), positions[group].max())
         else:
-            print("Using Gaussians with a line broadening of {:.1f} nm for plotting".format(args.broadening))
-        if args.totalonly == True:
-            print("Only plotting overall UV-Vis plot")
+            group = active & (stdevs == stdev)
+            step = 1.0 / (stdev * resolution)
+            positions = 1.0 / bands
+            # Nothing is further reaching than ~6 widths
+            reach = 6.1 / stdev
+            low = max(target.min(), positions[group].min()) - reach
+            high = min(target.max(), positions[group].max()) + reach
+            group &= (positions >= low) & (positions <= high)
+            if not np.any(group):
+                continue
+        npoints = int(np.ceil((high - low) / step)) + 2
+        if function == "lorentzian":
+            half = npoints - 1
         else:
-            print("Plotting {} structure(s) that contribute to >{:.1f}% to the UV-Vis spectrum".format(sigstruct,
-                                                                                                       args.cutoff * 100))
-        if ecd_sigstruct > 0 and args.totalonly == False:
-            print("Plotting {} contributing structure(s) with ECD data".format(ecd_sigstruct))
-        elif ecd_sigstruct > 0 and args.totalonly == True:
-            print("Only plotting overall ECD plot. {} structures with significant ECD data.".format(ecd_sigstruct))
+            half = int(np.ceil(6.1 * resolution))
+
+        # Line spectra on the auxiliary grid, one row per kind and structure
+        structure, peak = np.nonzero(group)
+        node = (positions[structure, peak] - low) / step
+        lower = np.floor(node).astype(int)
+        fraction = node - lower
+        sticks = np.zeros((nkinds, nstruct, npoints))
+        for k in range(nkinds):
+            values = strengths[k, structure, peak]
+            np.add.at(sticks[k], (structure, lower), values * (1.0 - fraction))
+            np.add.at(sticks[k], (structure, lower + 1), values * fraction)
+
+        # Band shape sampled at all distances that occur on the grid
+        offsets = np.arange(-half, half + 1) * step
+        prefactor = 1.3062974e8 / (1e7 / stdev)
+        if function == "lorentzian":
+            kernel = prefactor * gamma ** 2 / (offsets ** 2 + gamma ** 2)
         else:
-            if args.verbosity >= 3:
-                print("No ECD spectra available or no significant contribution to the spectrum")
-        if ecd_sigstruct > 0 and args.flipecd == True:
-            print("The ECD data has been inverted (to show the other enantiomer)")
+            kernel = prefactor * np.exp(-(offsets * stdev) ** 2)
+        size = 1 << (npoints + 2 * half).bit_length()
+        convolved = np.fft.irfft(np.fft.rfft(sticks.reshape((nkinds * nstruct, npoints)), size) *
+                                 np.fft.rfft(kernel, size), size)[:, half:half + npoints]
 
-        if args.verbosity >= 3 and sigstruct > 1:
-            print("Note that the overall UV-Vis and ECD spectra *always* contain *all* contributions.")
-        print("Plotting data from {} nm to {} nm ({} points)".format(start, finish, points))
-        print("")
+        # Linear interpolation back onto the requested grid, which may extend
+        # beyond the auxiliary one for Gaussians
+        node = (target - low) / step
+        inside = (node >= 0) & (node <= npoints - 1)
+        lower = np.clip(np.floor(node[inside]).astype(int), 0, npoints - 2)
+        fraction = node[inside] - lower
+        rows[:, inside] += convolved[:, lower] * (1.0 - fraction) + convolved[:, lower + 1] * fraction
+    return individual
 
-    # Calculate composite spectrum and individual spectra for all UV-Vis data
-    individual = []
-    composite = 0
-    for i in range(0, len(bands)):
-        individual.append(0)
-        for count, peak in enumerate(bands[i]):
-            if args.function == "lorentzian":
-                thispeak = (boltzmann[i] / np.sum(boltzmann)) * lorentzBand(x, peak, strengths[i][count], stdevs[i][count],
-                                                                            gammas[i][count])
-            else:
-                thispeak = (boltzmann[i] / np.sum(boltzmann)) * gaussBand(x, peak, strengths[i][count], stdevs[i][count])
-            composite += thispeak
-            individual[i] += thispeak
 
-    # Calculate composite spectrum and individual spectra for all ECD data
-    individual_ecd = []
-    composite_ecd = 0
-    for i in range(0, len(bands)):
-        individual_ecd.append(0)
-        for count, peak in enumerate(bands[i]):
-            if args.function == "lorentzian":
-                thispeak = (boltzmann[i] / np.sum(boltzmann)) * lorentzBand(x, peak, ecds[i][count], stdevs[i][count],
-                                                                            gammas[i][count])
-            else:
-                thispeak = (boltzmann[i] / np.sum(boltzmann)) * gaussBand(x, peak, ecds[i][count], stdevs[i][count])
-            composite_ecd += thispeak
-            individual_ecd[i] += thispeak
+def windowError(strengths, stdevs, weights, tolerance):
+    """
+    Upper bound of the absolute error of the composite spectra from
+    truncating every band at tolerance times its height (see bandWindows).
+    strengths is (... x structures x peaks), the result has shape (...).
+    """
+    heights = 1.3062974e8 / (1e7 / np.asarray(stdevs)) * np.abs(strengths) * np.asarray(weights)[:, np.newaxis]
+    return tolerance * np.nansum(heights, axis=(-2, -1))
 
-    # Write .csv file with UV-Vis and (if available) ECD data.
-    if args.csv != None:
-        try:
-            f = open(args.csv, 'wt')
-
-            f.write("UV-Vis Data\n")
-            # write top row for UV-Vis
-            row = "wavelength, composite"
-            for i in range(0, len(energies)):
-                row += ", {}".format(args.files[i])
-            row += "\n"
-            f.write(row)
-
-            # now print data rows
-            for i in range(0, len(x)):
-                row = ("{:3.2f}, {:4.2f}".format(x[i], composite[i]))
-                for j in range(0, len(energies)):
-                    row += ", {:4.2f}".format(individual[j][i])
-                row += "\n"
-                f.write(row)
-
-            # If there is ECD Data, print it
-            if ecd_sigstruct > 0:
-                # print empty row to separate UV-Vis from ECD data
-                f.write("\n")
-                f.write("ECD Data\n")
-                # write top row for ECD
-                row = "wavelength, composite"
-                for i in range(0, len(energies)):
-                    row += ", {}".format(args.files[i])
-                row += "\n"
-                f.write(row)
-
-            # now print data rows
-            for i in range(0, len(x)):
-                row = ("{:3.2f}, {: 4.2f}".format(x[i], composite_ecd[i]))
-                for j in range(0, len(energies)):
-                    row += ", {: 4.2f}".format(individual_ecd[j][i])
-                row += "\n"
-                f.write(row)
-            f.close()
-        except:
-            ProgramWarning("Can't open file {} for writing csv data.".format(args.csv))
-
-    colourmap = plt.cm.gnuplot(np.linspace(0, 1, len(bands)))
-    if args.colourmap == 0:
-        colourmap = plt.cm.gnuplot(np.linspace(0, 1, len(bands)))
-    elif args.colourmap == 1:
-        colourmap = plt.cm.Spectral(np.linspace(0, 1, len(bands)))
-    elif args.colourmap == 2:
-        colourmap = plt.cm.rainbow(np.linspace(0, 1, len(bands)))
-    elif args.colourmap == 3:
-        colourmap = plt.cm.seismic(np.linspace(0, 1, len(bands)))
 
-    if sigstruct == 1:
-        # Setup for one individual plot if there is only one
-        fig, ax = plt.subplots(nrows=1, sharex=True, sharey=False)
+def parseSize(text):
+    "Convert a size such as 512M or 2G (or plain bytes) into bytes"
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = text.strip().upper().rstrip("B")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(float(text))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(text))
+
+
+def ensembleRecords(filenames, verbosity=1, jobs=1, reverse=False, cache=None):
+    """
+    Read the output files of an ensemble and check them. Yields the filename
+    and (bands, oscillator strengths, ECD strengths, energy, program) for
+    every file, or None (after a warning) for files without usable data.
+    """
+    if jobs < 1:
+        jobs = multiprocessing.cpu_count()
+    extract = functools.partial(extractRecord, reverse=reverse, cache=cache)
+
+    # Read all existing files up front in parallel, or one by one as they are
+    # checked below
+    isfile = [os.path.isfile(filename) for filename in filenames]
+    existing = [filename for filename, exists in zip(filenames, isfile) if exists]
+    if verbosity >= 2 and jobs > 1:
+        print("Reading from {} file(s) with {} processes now.".format(sum(isfile), jobs))
+    if jobs > 1:
+        parsed = iter(parseFiles(existing, extract, verbosity, jobs))
+    else:
+        parsed = (extract(filename, verbosity=verbosity) for filename in existing)
+
+    for i in range(0, len(filenames)):
+        record = None
+        if isfile[i]:
+            if verbosity >= 2:
+                print("Reading from file {} now.".format(filenames[i]))
+            band, f, energy, ecd, program = next(parsed)
+            if band == [] or f == [] or ecd == []:
+                ProgramWarning("No spectral data found in {}".format(filenames[i]))
+            elif energy == []:
+                ProgramWarning("No thermodynamic data (Gibbs free energy) found in this file!")
+            elif len(band) != len(f) or len(band) != len(ecd):
+                ProgramWarning("Inconsistency with # of bands and # of osc strengths/ecd in this file!")
+            else:
+                record = (band, f, ecd, energy, program)
+        else:
+            ProgramWarning("The file {} doesn't exist or is not a file".format(filenames[i]))
+        yield filenames[i], record
+    if cache is not None:
+        cache.evict()
+
+
+def readEnsemble(filenames, verbosity=1, jobs=1, reverse=False, cache=None):
+    "Return the names, bands, oscillator and rotatory strengths and energies of the files with data, as lists"
+    names = []
+    bands = []
+    strengths = []
+    ecds = []
+    energies = []
+    for filename, record in ensembleRecords(filenames, verbosity, jobs, reverse, cache):
+        if record is not None:
+            names.append(filename)
+            bands.append(record[0])
+            strengths.append(record[1])
+            ecds.append(record[2])
+            energies.append(record[3])
+    return names, bands, strengths, ecds, energies
+
+
+class Ensemble(object):
+    """
+    Columnar store of the parsed data of an ensemble. The bands (nm),
+    oscillator strengths and rotatory strengths of all structures are
+    RaggedArrays sharing one offsets array; names, programs and energies
+    (Gibbs free energies in Hartree) have one entry per structure.
+
+    Rows and slices of structures are views of the same arrays. save()
+    writes every column as a .npy file, which loadEnsemble() memory-maps.
+    """
+
+    def __init__(self, names, bands, strengths, ecds, energies, programs=None):
+        self.bands = ragged(bands)
+        offsets = self.bands.offsets
+        self.strengths = RaggedArray(ragged(strengths).values, offsets)
+        self.ecds = RaggedArray(ragged(ecds).values, offsets)
+        if not len(self.bands.values) == len(self.strengths.values) == len(self.ecds.values):
+            raise ValueError("bands, strengths and ECD strengths differ in length")
+        self.names = np.asarray(names, dtype=str)
+        self.energies = np.asarray(energies, dtype=float)
+        if programs is None:
+            programs = ["N/A"] * len(self.names)
+        self.programs = np.asarray(programs, dtype=str)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        """
+        Structure index as (name, program, energy, bands, strengths, ecds), or
+        an Ensemble of a slice of structures sharing the arrays
+        """
+        if not isinstance(index, slice):
+            return (self.names[index], self.programs[index], self.energies[index], self.bands[index],
+                    self.strengths[index], self.ecds[index])
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            return self.take(np.arange(start, stop, step))
+        stop = max(start, stop)
+        first, last = self.bands.offsets[start], self.bands.offsets[stop]
+        offsets = self.bands.offsets[start:stop + 1] - first
+        columns = [RaggedArray(column.values[first:last], offsets)
+                   for column in (self.bands, self.strengths, self.ecds)]
+        return Ensemble(self.names[start:stop], columns[0], columns[1], columns[2], self.energies[start:stop],
+                        self.programs[start:stop])
+
+    def take(self, indices):
+        "The structures indices (in this order) as a new Ensemble"
+        indices = np.asarray(indices, dtype=np.int64)
+        return Ensemble(self.names[indices], self.bands.take(indices), self.strengths.take(indices),
+                        self.ecds.take(indices), self.energies[indices], self.programs[indices])
+
+    def select(self, keep):
+        "The structures where the boolean array keep is set, e.g. ensemble.weights() > 1e-3"
+        return self.take(np.nonzero(keep)[0])
+
+    def strongBands(self, minstrength):
+        "All structures with only the bands of an oscillator strength of at least minstrength"
+        keep = self.strengths.values >= minstrength
+        return Ensemble(self.names, self.bands.mask(keep), self.strengths.mask(keep), self.ecds.mask(keep),
+                        self.energies, self.programs)
+
+    def weights(self, temperature=298.15):
+        "Normalised Boltzmann weights of the structures, see ensembleWeights"
+        return ensembleWeights(self.energies, temperature)
+
+    def lists(self):
+        "The names, bands, strengths, ECD strengths and energies as lists, as readEnsemble returns them"
+        return (self.names.tolist(), self.bands.tolist(), self.strengths.tolist(), self.ecds.tolist(),
+                self.energies.tolist())
+
+    def save(self, directory):
+        "Write the columns as .npy files into directory"
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        columns = {"names": self.names, "programs": self.programs, "energies": self.energies,
+                   "offsets": self.bands.offsets, "bands": self.bands.values, "strengths": self.strengths.values,
+                   "ecds": self.ecds.values}
+        for name, values in columns.items():
+            np.save(os.path.join(directory, name + ".npy"), values)
+
+
+def isEnsemble(path):
+    "Whether path is a directory written by Ensemble.save()"
+    return os.path.isfile(os.path.join(path, "offsets.npy"))
+
+
+def loadEnsemble(directory, mmap=True):
+    "Read an Ensemble written by Ensemble.save(), memory-mapped unless mmap=False"
+    columns = {}
+    for name in ("names", "programs", "energies", "offsets", "bands", "strengths", "ecds"):
+        columns[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode='r' if mmap else None)
+    offsets = columns["offsets"]
+    return Ensemble(columns["names"], RaggedArray(columns["bands"], offsets), RaggedArray(columns["strengths"], offsets),
+                    RaggedArray(columns["ecds"], offsets), columns["energies"], columns["programs"])
+
+
+def readColumns(filenames, verbosity=1, jobs=1, reverse=False, cache=None):
+    """
+    Same as readEnsemble, but returns an Ensemble. The values of every file
+    are stored as arrays right away. Directories written by Ensemble.save()
+    can be given instead of files; a single one is memory-mapped as is.
+    """
+    saved = [os.path.isdir(filename) and isEnsemble(filename) for filename in filenames]
+    if len(filenames) == 1 and saved[0]:
+        return loadEnsemble(filenames[0])
+    records = ensembleRecords([filename for filename, known in zip(filenames, saved) if not known], verbosity, jobs,
+                              reverse, cache)
+    names = []
+    programs = []
+    energies = []
+    lengths = []
+    columns = ([], [], [])
+    for filename, known in zip(filenames, saved):
+        if known:
+            # Whole columns of a saved ensemble
+            part = loadEnsemble(filename)
+            names.extend(part.names.tolist())
+            programs.extend(part.programs.tolist())
+            energies.extend(part.energies.tolist())
+            lengths.extend(part.bands.lengths().tolist())
+            for column, values in zip(columns, (part.bands, part.strengths, part.ecds)):
+                column.append(values.values)
+            continue
+        record = next(records)[1]
+        if record is None:
+            continue
+        band, f, ecd, energy, program = record
+        names.append(filename)
+        programs.append(program)
+        energies.append(energy)
+        lengths.append(len(band))
+        for column, values in zip(columns, (band, f, ecd)):
+            column.append(np.asarray(values, dtype=float))
+    # Exhaust the records, which evicts from the cache at the end
+    for _ in records:
+        pass
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    bands, strengths, ecds = [RaggedArray(np.concatenate(column + [np.empty(0)]), offsets) for column in columns]
+    return Ensemble(names, bands, strengths, ecds, energies, programs)
+
+
+def boltzmannWeights(energies, temperature=298.15):
+    "Relative Gibbs energies (kcal/mol) and Boltzmann factors, (temperatures x structures) for several temperatures"
+    energies = np.asarray(energies, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+    if len(energies) > 1:
+        energies = (energies - np.min(energies)) * 627.5095
+        boltzmann = np.exp((-1.0 * energies / (temperature[..., np.newaxis] * 0.0019872041)))
+    else:
+        boltzmann = np.ones(temperature.shape + (len(energies),))
+    return energies, boltzmann
+
+
+def ensembleWeights(energies, temperature=298.15):
+    """
+    Normalised Boltzmann weights of the Gibbs energies (Hartree) as
+    exp(x - logsumexp(x)) of the exponents x = -G / RT, so that they can
+    neither overflow nor all underflow. For an array of temperatures (K)
+    the weights are (temperatures x structures).
+    """
+    energies = np.asarray(energies, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)[..., np.newaxis]
+    if len(energies) == 0:
+        return np.zeros(temperature.shape[:-1] + (0,))
+    # Shifting by the lowest energy makes the largest exponent zero, which is
+    # the log-sum-exp shift
+    exponents = -1.0 * ((energies - np.min(energies)) * 627.5095) / (temperature * 0.0019872041)
+    weights = np.exp(exponents)
+    return weights / np.sum(weights, axis=-1, keepdims=True)
+
+
+def temperatureSweep(x, bands, strengths, ecds, energies, temperatures, broadening=3099.6, hwhm=7.5,
+                     function="gaussian", maxmemory=None, tolerance=None, engine="direct"):
+    """
+    Ensemble spectra for a list of temperatures (K). Every structure is
+    broadened once; the spectra are the (temperatures x structures) weights
+    times the (structures x points) curves.
+
+    Returns the weights and the UV-Vis and ECD spectra (temperatures x points).
+    """
+    weights = ensembleWeights(energies, np.asarray(temperatures, dtype=float))
+    _, (curves, curves_ecd) = ensembleSpectra(x, bands, strengths, ecds, np.ones(len(bands)), broadening, hwhm,
+                                              function, maxmemory, tolerance, engine)
+    return weights, np.dot(weights, curves), np.dot(weights, curves_ecd)
+
+
+def flipECD(ecds):
+    """Invert the handedness of the ECD data (to show the "other" enantiomer)."""
+    if isinstance(ecds, RaggedArray):
+        return RaggedArray(-1.0 * ecds.values, ecds.offsets)
+    return [[-1.0 * r for r in ecd] for ecd in ecds]
+
+
+def significantStructures(weights, ecds, cutoff=0.01):
+    """Number of structures above the cutoff for the UV-Vis and for the ECD plots."""
+    weights = np.asarray(weights)
+    if len(weights) > 1:
+        sigstruct = int(np.sum(weights > cutoff))
+    else:
+        sigstruct = 1
+    ecd_sigstruct = 0
+    for i in range(0, len(ecds)):
+        if weights[i] > cutoff and max(np.absolute(ecds[i])) > 0.0:
+            ecd_sigstruct += 1
+    return sigstruct, ecd_sigstruct
+
+
+def plotGrid(bands, lower=None, upper=None, points=None):
+    "Return a wavelength grid (nm) covering all bands with a margin of 50 nm, its start, end and points"
+    if lower == None:
+        start = np.trunc(max(findmin(bands) - 50.0, 0.0))
+    else:
+        start = lower
+    if upper == None:
+        finish = np.trunc(findmax(bands) + 50.0)
+    else:
+        finish = upper
+    if points == None:
+        points = int((finish - start) * 2.5)
+    else:
+        points = int(points)
+    return np.linspace(start, finish, points), start, finish, points
+
+
+def ensembleSpectra(x, bands, strengths, ecds, weights, broadening=3099.6, hwhm=7.5, function="gaussian",
+                    maxmemory=None, tolerance=None, engine="direct"):
+    "Broaden the UV-Vis and ECD spectra of an ensemble on the grid x, returns the composite and individual curves"
+    # Band positions of all structures, without padding
+    bandarray = ragged(bands)
+
+    # A sqrt(2) * standard deviation of 0.4 eV is 3099.6 nm. 0.1 eV is 12398.4 nm. 0.2 eV is 6199.2 nm.
+    stdevs = broadening if isinstance(broadening, RaggedArray) else bandarray.like(broadening)
+
+    # For Lorentzians, gamma is half bandwidth at half peak height (nm)
+    gammas = hwhm if isinstance(hwhm, RaggedArray) else bandarray.like(hwhm)
+
+    return broaden(x, bandarray, [ragged(strengths), ragged(ecds)], stdevs, gammas, weights, function, maxmemory,
+                   tolerance, engine)
+
+
+def readWidths(filename):
+    """
+    Read per-band widths from a JSON file of the form
+    {"file.out": {"broadening": [...], "hwhm": [...]}, ...} with one value
+    per band of the output file (either list may be left out). Raises
+    IOError if it can't be read and ValueError if it isn't valid JSON.
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError) as error:
+        raise IOError("Can't read the band widths from {}: {}".format(filename, error))
+    except ValueError as error:
+        raise ValueError("Can't read the band widths from {}: {}".format(filename, error))
+
+
+def bandWidths(bands, strengths, broadening=3099.6, hwhm=7.5, rule="constant", table=None, names=None):
+    """
+    Per-band Gaussian widths (like broadening) and Lorentzian HWHMs (nm) as
+    RaggedArrays with the layout of bands.
+
+    rule="strength" makes strong bands narrower with the factor
+    1 - 0.23 f of the smear in plot_uvvis.spectra. Widths for single files
+    in table (from readWidths, looked up by the names or their base names)
+    replace the ones of the rule.
+    """
+    bandarray = ragged(bands)
+    stdevs = bandarray.like(broadening)
+    gammas = bandarray.like(hwhm)
+    if rule == "strength":
+        # The smear (-0.046 f + 0.20) relative to a band of zero strength, kept positive
+        factor = np.maximum(1.0 - 0.23 * ragged(strengths).values, 0.05)
+        stdevs.values /= factor
+        gammas.values *= factor
+    for i, name in enumerate(names if table else []):
+        entry = table.get(name, table.get(os.path.basename(name)))
+        if entry == None:
+            continue
+        for key, widths in (("broadening", stdevs), ("hwhm", gammas)):
+            if key not in entry:
+                continue
+            if len(entry[key]) != len(widths[i]):
+                ProgramWarning("{} has {} {} values for {} bands, ignoring them".format(name, len(entry[key]), key,
+                                                                                      len(widths[i])))
+                continue
+            widths[i][:] = entry[key]
+    return stdevs, gammas
+
+
+def adaptiveGrid(bands, strengths, ecds, weights, start, finish, points=None, tolerance=1e-3, broadening=3099.6,
+                 hwhm=7.5, function="gaussian", resolution=0.01, engine="direct"):
+    """
+    Non-uniform wavelength grid (nm) from start to finish on which linear
+    interpolation reproduces the composite and individual UV-Vis and ECD
+    spectra to within tolerance times their largest absolute value.
+
+    Starts from points uniform points (default: one per width of the
+    narrowest band, so that no band falls between two points unnoticed) and
+    halves every interval whose midpoint is off by more than that, down to a
+    spacing of resolution (nm). Flat regions stay coarse.
+    """
+    if points == None:
+        if function == "lorentzian":
+            width = np.min(hwhm.values) if isinstance(hwhm, RaggedArray) else hwhm
+        else:
+            # The width of the Gaussians in nm grows with the square of the wavelength
+            width = max(findmin(bands), start, 1.0) ** 2 / (
+                np.max(broadening.values) if isinstance(broadening, RaggedArray) else broadening)
+        points = int((finish - start) / max(width, resolution)) + 1
+    x = np.linspace(start, finish, max(int(points), 2))
+
+    def evaluate(x):
+        # (kinds x composite and structures x points)
+        (composite, composite_ecd), (individual, individual_ecd) = ensembleSpectra(
+            x, bands, strengths, ecds, weights, broadening, hwhm, function, engine=engine)
+        return np.stack([np.vstack([composite, individual]), np.vstack([composite_ecd, individual_ecd])])
+
+    values = evaluate(x)
+    scale = np.max(np.abs(values), axis=(1, 2))
+    # Intervals (by their left point) that are still to be checked
+    active = np.ones(len(x) - 1, dtype=bool)
+    while True:
+        active &= np.diff(x) >= 2.0 * resolution
+        left = np.nonzero(active)[0]
+        if len(left) == 0:
+            break
+        middle = 0.5 * (x[left] + x[left + 1])
+        found = evaluate(middle)
+        scale = np.maximum(scale, np.max(np.abs(found), axis=(1, 2)))
+        error = np.abs(found - 0.5 * (values[..., left] + values[..., left + 1]))
+        split = np.any(error > tolerance * scale[:, np.newaxis, np.newaxis], axis=(0, 1))
+        # Both halves of a split interval are checked again, the others are done
+        x = np.concatenate([x, middle[split]])
+        values = np.concatenate([values, found[..., split]], axis=-1)
+        check = np.zeros(len(x), dtype=bool)
+        check[left[split]] = True
+        check[len(x) - np.sum(split):] = True
+        order = np.argsort(x, kind='stable')
+        x = x[order]
+        values = values[..., order]
+        active = check[order][:-1]
+    return x
+
+
+def pruneEnsemble(bands, strengths, ecds, weights, broadening=3099.6, minweight=0.0, minstrength=0.0):
+    """
+    Drop the structures with a weight below minweight (except the one with
+    the highest weight) and the bands with an oscillator strength below
+    minstrength before broadening.
+
+    Returns the indices of the remaining structures, their bands, strengths
+    and ECD strengths, and the upper bound of the absolute error this causes
+    in the composite UV-Vis and ECD spectra, i.e. the summed heights of the
+    dropped bands. broadening may be per band (see bandWidths).
+    """
+    keep = []
+    pruned = ([], [], [])
+    error = np.zeros(2)
+    strongest = int(np.argmax(weights))
+    for i in range(0, len(bands)):
+        f = np.asarray(strengths[i], dtype=float)
+        r = np.asarray(ecds[i], dtype=float)
+        # Height of a band of unit strength (Gaussians and Lorentzians alike)
+        height = np.broadcast_to(1.3062974e8 / (1e7 / np.asarray(broadening[i] if isinstance(
+            broadening, RaggedArray) else broadening)) * weights[i], f.shape)
+        if weights[i] < minweight and i != strongest:
+            error += np.array([np.sum(height * np.abs(f)), np.sum(height * np.abs(r))])
+            continue
+        kept = f >= minstrength
+        error += np.array([np.sum((height * np.abs(f))[~kept]), np.sum((height * np.abs(r))[~kept])])
+        keep.append(i)
+        pruned[0].append(np.asarray(bands[i], dtype=float)[kept].tolist())
+        pruned[1].append(f[kept].tolist())
+        pruned[2].append(r[kept].tolist())
+    return keep, pruned[0], pruned[1], pruned[2], error
+
+
+csvrows = 4096
+
+
+def writeBlock(f, rowformat, columns):
+    "Write the columns (points x columns) formatted with rowformat, csvrows rows per format call"
+    for start in range(0, len(columns), csvrows):
+        block = columns[start:start + csvrows]
+        f.write((rowformat * len(block)) % tuple(block.ravel().tolist()))
+
+
+def writeCSV(filename, x, names, composite, individual, composite_ecd=None, individual_ecd=None):
+    """Write the UV-Vis and (if given) ECD spectra in csv format."""
+    try:
+        f = open(filename, 'wt')
+    except (IOError, OSError):
+        ProgramWarning("Can't open file {} for writing csv data.".format(filename))
+        return
+
+    # top row with the names, then one row per point for the whole (points x structures) matrix
+    header = "wavelength, composite" + "".join(", {}".format(name) for name in names) + "\n"
+
+    f.write("UV-Vis Data\n")
+    f.write(header)
+    writeBlock(f, "%3.2f, %4.2f" + ", %4.2f" * len(names) + "\n",
+               np.column_stack([x, composite, np.transpose(individual[:len(names)])]))
+
+    # If there is ECD Data, print it
+    if composite_ecd is not None:
+        # print empty row to separate UV-Vis from ECD data
+        f.write("\n")
+        f.write("ECD Data\n")
+        f.write(header)
+        writeBlock(f, "%3.2f, % 4.2f" + ", % 4.2f" * len(names) + "\n",
+                   np.column_stack([x, composite_ecd, np.transpose(individual_ecd[:len(names)])]))
+    f.close()
+
+
+def writeSweepCSV(filename, x, temperatures, sweep, sweep_ecd=None):
+    """Write the composite UV-Vis and (if given) ECD spectra of a temperature sweep in csv format."""
+    try:
+        f = open(filename, 'wt')
+    except (IOError, OSError):
+        ProgramWarning("Can't open file {} for writing csv data.".format(filename))
+        return
+
+    header = "wavelength" + "".join(", {} K".format(temperature) for temperature in temperatures) + "\n"
+    f.write("UV-Vis Data\n")
+    f.write(header)
+    writeBlock(f, "%3.2f" + ", %4.2f" * len(temperatures) + "\n", np.column_stack([x, np.transpose(sweep)]))
+    if sweep_ecd is not None:
+        f.write("\n")
+        f.write("ECD Data\n")
+        f.write(header)
+        writeBlock(f, "%3.2f" + ", % 4.2f" * len(temperatures) + "\n", np.column_stack([x, np.transpose(sweep_ecd)]))
+    f.close()
+
+
+def writeSpectra(filename, x, names, composite, individual, composite_ecd=None, individual_ecd=None, weights=None,
+                 energies=None, metadata=None, sweep=None):
+    """
+    Save the spectra in a binary format chosen by the extension of filename:
+    .npz (numpy), .parquet (needs pyarrow) or .h5/.hdf5 (needs h5py).
+
+    The .npz and HDF5 files hold the arrays wavelength, composite and
+    individual (structures x points), their ECD counterparts, weights,
+    energies and names, plus the metadata dict as JSON. The Parquet file has
+    one row per point with the columns wavelength, composite,
+    composite_ecd, "uvvis:<name>" and "ecd:<name>"; weights, energies and
+    metadata are stored in its schema metadata.
+
+    sweep is an optional temperature sweep (temperatures, spectra,
+    spectra_ecd) from temperatureSweep. It is stored as the arrays
+    temperatures, sweep and sweep_ecd (temperatures x points), or as the
+    Parquet columns "uvvis@<T>K" and "ecd@<T>K".
+    """
+    arrays = {"wavelength": np.asarray(x, dtype=float),
+              "composite": np.asarray(composite, dtype=float),
+              "individual": np.asarray(individual, dtype=float)}
+    if composite_ecd is not None:
+        arrays["composite_ecd"] = np.asarray(composite_ecd, dtype=float)
+        arrays["individual_ecd"] = np.asarray(individual_ecd, dtype=float)
+    if weights is not None:
+        arrays["weights"] = np.asarray(weights, dtype=float)
+    if energies is not None:
+        arrays["energies"] = np.asarray(energies, dtype=float)
+    if sweep is not None:
+        arrays["temperatures"] = np.asarray(sweep[0], dtype=float)
+        arrays["sweep"] = np.asarray(sweep[1], dtype=float)
+        if composite_ecd is not None:
+            arrays["sweep_ecd"] = np.asarray(sweep[2], dtype=float)
+    info = json.dumps(metadata if metadata is not None else {})
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".npz":
+        np.savez(filename, names=np.array(names, dtype=str), metadata=np.array(info), **arrays)
+    elif extension == ".parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            ProgramWarning("Module pyarrow is required for saving {}".format(filename))
+            return
+        columns = {"wavelength": arrays["wavelength"], "composite": arrays["composite"]}
+        if composite_ecd is not None:
+            columns["composite_ecd"] = arrays["composite_ecd"]
+        for i, name in enumerate(names):
+            columns["uvvis:" + name] = arrays["individual"][i]
+            if composite_ecd is not None:
+                columns["ecd:" + name] = arrays["individual_ecd"][i]
+        if sweep is not None:
+            for i, temperature in enumerate(arrays["temperatures"]):
+                columns["uvvis@{}K".format(temperature)] = arrays["sweep"][i]
+                if composite_ecd is not None:
+                    columns["ecd@{}K".format(temperature)] = arrays["sweep_ecd"][i]
+        schema = {"names": json.dumps(list(names)), "metadata": info}
+        for key in ("weights", "energies"):
+            if key in arrays:
+                schema[key] = json.dumps(arrays[key].tolist())
+        table = pyarrow.table(columns).replace_schema_metadata(schema)
+        pyarrow.parquet.write_table(table, filename)
+    elif extension in (".h5", ".hdf5"):
+        try:
+            import h5py
+        except ImportError:
+            ProgramWarning("Module h5py is required for saving {}".format(filename))
+            return
+        with h5py.File(filename, "w") as f:
+            for key, value in arrays.items():
+                f.create_dataset(key, data=value)
+            f.create_dataset("names", data=np.array(names, dtype=object), dtype=h5py.string_dtype())
+            f.attrs["metadata"] = info
+    else:
+        ProgramWarning("Unsupported filetype requested for {} (.npz, .parquet, .h5)".format(filename))
+
+
+def colourMap(n, colourmap=0):
+    """n colours from one of the colour maps selectable with --colourmap."""
+    plt = pyplot()
+    maps = {0: plt.cm.gnuplot, 1: plt.cm.Spectral, 2: plt.cm.rainbow, 3: plt.cm.seismic}
+    return maps.get(colourmap, plt.cm.gnuplot)(np.linspace(0, 1, n))
+
+
+def stickHeights(strengths, ylim, scale=0.9, signed=False):
+    """
+    Heights of the lines of a line spectrum, scaled so that the strongest
+    line reaches scale times the top of the y-axis (ylim). With signed,
+    negative lines are scaled to the bottom of the y-axis instead (for ECD).
+    """
+    strengths = np.asarray(strengths, dtype=float)
+    peak = np.max(strengths)
+    stretchfactor = 1 / peak if peak != 0.0 else 0.0
+    if signed == True:
+        limit = np.where(strengths > 0.0, ylim[1], -ylim[0])
+    else:
+        limit = ylim[1]
+    return scale * limit * stretchfactor * strengths
+
+
+def plotUVVis(x, composite, individual, names, bands, strengths, energies, weights, sigstruct, cutoff=0.01,
+              colours=None, totalonly=False, nolines=False, nonames=False, nocontr=False):
+    """Plot the UV-Vis spectrum and its significant contributions, returns the figure."""
+    plt = pyplot()
+    if colours is None:
+        colours = colourMap(len(bands))
+
+    if sigstruct == 1:
+        # Setup for one individual plot if there is only one
+        fig, ax = plt.subplots(nrows=1, sharex=True, sharey=False)
         ax.plot(x, composite)
         ax.set_title("UV-Vis")
-        stretchfactor = 1 / max(strengths[0])
-        if args.nolines != True:
-            for j in range(0, len(bands[0])):
-                ax.vlines(bands[0][j], 0.0, ax.get_ylim()[1] * stretchfactor * strengths[0][j])
-        if args.nonames != True:
+        if nolines != True:
+            ax.vlines(bands[0], 0.0, stickHeights(strengths[0], ax.get_ylim(), 1.0))
+        if nonames != True:
             ax.text(0.8, 0.8,
                     '{}'.format(names[0]),
                     horizontalalignment='center', verticalalignment='center', transform=ax.transAxes)
         plt.xlabel('$\lambda$ / nm')
         plt.ylabel('$\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
-    elif args.totalonly == True:
+    elif totalonly == True:
         # Setup for one individual plot if especially requested
         fig, ax = plt.subplots(nrows=1, sharex=True, sharey=False)
         ax.plot(x, composite)
         ax.set_title("UV-Vis")
         # add individual contributing plots underneath
         for count, i in enumerate(np.argsort(energies)):
-            ax.plot(x, individual[i], color=colourmap[i], linestyle='--')
+            ax.plot(x, individual[i], color=colours[i], linestyle='--')
         plt.xlabel('$\lambda$ / nm')
         plt.ylabel('$\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
     else:
@@ -534,89 +1988,93 @@ if __name__ == '__main__':
         # Go through all energies in order, but index in variable "count" for UV-Vis
         ax[0].set_title("UV-Vis")
         for count, i in enumerate(np.argsort(energies)):
-            if (boltzmann[i] / np.sum(boltzmann)) > args.cutoff:
-                ax[count + 1].plot(x, individual[i], color=colourmap[i])
+            if weights[i] > cutoff:
+                ax[count + 1].plot(x, individual[i], color=colours[i])
                 # Ensure that the y-axis starts at zero
                 ax[count + 1].axis(ymin=0.0)
-                if args.nonames == False and args.nocontr == False:
+                if nonames == False and nocontr == False:
                     ax[count + 1].text(0.8, 0.5,
                                        '{}\n Contribution: {:.1f}%'.format(names[i],
-                                                                           (boltzmann[i] / np.sum(boltzmann)) * 100),
+                                                                           weights[i] * 100),
                                        horizontalalignment='center', verticalalignment='center',
                                        transform=ax[count + 1].transAxes)
-                elif args.nonames == True and args.nocontr == False:
+                elif nonames == True and nocontr == False:
                     ax[count + 1].text(0.8, 0.5,
-                                       'Contribution: {:.1f}%'.format((boltzmann[i] / np.sum(boltzmann)) * 100),
+                                       'Contribution: {:.1f}%'.format(weights[i] * 100),
                                        horizontalalignment='center', verticalalignment='center',
                                        transform=ax[count + 1].transAxes)
-                elif args.nonames == False and args.nocontr == True:
+                elif nonames == False and nocontr == True:
                     ax[count + 1].text(0.8, 0.5,
                                        '{}'.format(names[i]),
                                        horizontalalignment='center', verticalalignment='center',
                                        transform=ax[count + 1].transAxes)
-                # print("Strongest transition in structure {}: {}".format(i,max(strengths[i])))
-                stretchfactor = 1 / max(strengths[i])
-                if args.nolines != True:
-                    for j in range(0, len(bands[0])):
-                        # Print vertical line spectrum scaled to 90% of the size of the y-axis (ax[count+1].get_ylim()[1])
-                        ax[count + 1].vlines(bands[i][j], 0.0,
-                                             0.9 * ax[count + 1].get_ylim()[1] * stretchfactor * strengths[i][j])
-                        # print("Plotting band of molecule {} at: {}".format(i,bands[i][j]))
-            ax[0].plot(x, individual[i], color=colourmap[i], linestyle='--')
-        if args.nocontr == False:
+                if nolines != True:
+                    # Print vertical line spectrum scaled to 90% of the size of the y-axis (ax[count+1].get_ylim()[1])
+                    ax[count + 1].vlines(bands[i], 0.0, stickHeights(strengths[i], ax[count + 1].get_ylim()))
+            ax[0].plot(x, individual[i], color=colours[i], linestyle='--')
+        if nocontr == False:
             ax[0].text(0.8, 0.5, 'All contributions', horizontalalignment='center', verticalalignment='center',
                        transform=ax[0].transAxes)
         plt.xlabel('$\lambda$ / nm')
         plt.ylabel('$\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
 
-    if args.outfile != None:
-        plt.savefig("UV-" + args.outfile, bbox_inches='tight')
+    return fig
+
+
+def plotECD(x, composite_ecd, individual_ecd, names, bands, ecds, energies, weights, sigstruct, ecd_sigstruct,
+            cutoff=0.01, colours=None, totalonly=False, nolines=False, nonames=False, nocontr=False):
+    """Plot the ECD spectrum and its significant contributions.
+
+    Returns the figure, or None if there is nothing to plot.
+    """
+    plt = pyplot()
+    if colours is None:
+        colours = colourMap(len(bands))
+    fig = None
 
     # Setup for composite plot and each significantly contr. structure for ECD
     if ecd_sigstruct == 1:
         # find out which structure it is that is contributing
         for count, i in enumerate(np.argsort(energies)):
-            if (boltzmann[i] / np.sum(boltzmann)) > args.cutoff and max(np.absolute(ecds[i])) > 0.0:
+            if weights[i] > cutoff and max(np.absolute(ecds[i])) > 0.0:
                 ecd_struct = i
         fig, ay = plt.subplots(nrows=1, sharex=True, sharey=False)
         ay.plot(x, composite_ecd)
         ay.axhline()
         if sigstruct > 1:
-            if args.nonames == False and args.nocontr == False:
+            if nonames == False and nocontr == False:
                 ay.text(0.8, 0.8,
                         '{}\n Contribution: {:.1f}%'.format(names[ecd_struct],
-                                                            (boltzmann[ecd_struct] / np.sum(boltzmann)) * 100),
+                                                            weights[ecd_struct] * 100),
                         horizontalalignment='center', verticalalignment='center', transform=ay.transAxes)
-            elif args.nonames == True and args.nocontr == False:
+            elif nonames == True and nocontr == False:
                 ay.text(0.8, 0.8,
                         'Contribution: {:.1f}%'.format(
-                            (boltzmann[ecd_struct] / np.sum(boltzmann)) * 100),
+                            weights[ecd_struct] * 100),
                         horizontalalignment='center', verticalalignment='center', transform=ay.transAxes)
-            elif args.nonames == False and args.nocontr == True:
+            elif nonames == False and nocontr == True:
                 ay.text(0.8, 0.8,
                         '{}'.format(names[ecd_struct]),
                         horizontalalignment='center', verticalalignment='center', transform=ay.transAxes)
             else:
-                if args.nonames == False:
+                if nonames == False:
                     ay.text(0.8, 0.8,
                             '{}'.format(names[ecd_struct]),
                             horizontalalignment='center', verticalalignment='center', transform=ay.transAxes)
-            stretchfactor = 1 / max(ecds[ecd_struct])
-            if args.nolines != True:
-                for j in range(0, len(bands[ecd_struct])):
-                    ay.vlines(bands[ecd_struct][j], 0.0, ay.get_ylim()[1] * stretchfactor * ecds[ecd_struct][j])
+            if nolines != True:
+                ay.vlines(bands[ecd_struct], 0.0, stickHeights(ecds[ecd_struct], ay.get_ylim(), 1.0))
             ay.set_title("ECD")
             plt.xlabel('$\lambda$ / nm')
             plt.ylabel('$\Delta\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
-    elif args.totalonly == True:
+    elif totalonly == True:
         # setup plot
         fig, ay = plt.subplots(nrows=1, sharex=True, sharey=False)
         ay.plot(x, composite_ecd)
         ay.axhline()
         # find out which structure it is that is contributing
         for count, i in enumerate(np.argsort(energies)):
-            if (boltzmann[i] / np.sum(boltzmann)) > args.cutoff and max(np.absolute(ecds[i])) > 0.0:
-                ay.plot(x, individual_ecd[i], color=colourmap[i], linestyle='--')
+            if weights[i] > cutoff and max(np.absolute(ecds[i])) > 0.0:
+                ay.plot(x, individual_ecd[i], color=colours[i], linestyle='--')
         ay.set_title("ECD")
         plt.xlabel('$\lambda$ / nm')
         plt.ylabel('$\Delta\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
@@ -627,45 +2085,829 @@ if __name__ == '__main__':
         ay[0].axhline()
         countpanels = 1
         for count, i in enumerate(np.argsort(energies)):
-            if (boltzmann[i] / np.sum(boltzmann)) > args.cutoff and max(np.absolute(ecds[i])) > 0.0:
-                ay[countpanels].plot(x, individual_ecd[i], color=colourmap[i])
+            if weights[i] > cutoff and max(np.absolute(ecds[i])) > 0.0:
+                ay[countpanels].plot(x, individual_ecd[i], color=colours[i])
                 ay[countpanels].axhline()
-                if args.nonames == False and args.nocontr == False:
-                    ay[countpanels].text(0.8, 0.8, '{}\n Contribution: {:.1f}%'.format(names[i], (
-                        boltzmann[i] / np.sum(boltzmann)) * 100), horizontalalignment='center', verticalalignment='center',
+                if nonames == False and nocontr == False:
+                    ay[countpanels].text(0.8, 0.8, '{}\n Contribution: {:.1f}%'.format(names[i], weights[i] * 100), horizontalalignment='center', verticalalignment='center',
                                          transform=ay[countpanels].transAxes)
-                elif args.nonames == True and args.nocontr == False:
-                    ay[countpanels].text(0.8, 0.8, 'Contribution: {:.1f}%'.format((
-                        boltzmann[i] / np.sum(boltzmann)) * 100),
+                elif nonames == True and nocontr == False:
+                    ay[countpanels].text(0.8, 0.8, 'Contribution: {:.1f}%'.format(weights[i] * 100),
                                          horizontalalignment='center', verticalalignment='center',
                                          transform=ay[countpanels].transAxes)
-                elif args.nonames == False and args.nocontr == True:
+                elif nonames == False and nocontr == True:
                     ay[countpanels].text(0.8, 0.8, '{}'.format(names[i]), horizontalalignment='center',
                                          verticalalignment='center',
                                          transform=ay[countpanels].transAxes)
-                if args.nolines != True:
-                    stretchfactor = 1 / max(ecds[i])
-                    for j in range(0, len(bands[0])):
-                        # Print vertical line spectrum scaled to 90% of the size of the y-axis (ax[count+1].get_ylim()[1])
-                        if ecds[i][j] > 0.0:
-                            ay[countpanels].vlines(bands[i][j], 0.0,
-                                                   0.9 * ay[countpanels].get_ylim()[1] * stretchfactor * ecds[i][j])
-                        if ecds[i][j] < 0.0:
-                            ay[countpanels].vlines(bands[i][j], 0.0,
-                                                   -0.9 * ay[countpanels].get_ylim()[0] * stretchfactor * ecds[i][j])
-                            # print("Plotting band of molecule {} at: {}".format(i,bands[i][j]))
+                if nolines != True:
+                    # Print vertical line spectrum scaled to 90% of the size of the y-axis, the negative
+                    # lines to the bottom of the y-axis
+                    nonzero = np.asarray(ecds[i]) != 0.0
+                    ay[countpanels].vlines(np.asarray(bands[i])[nonzero], 0.0,
+                                           stickHeights(ecds[i], ay[countpanels].get_ylim(), signed=True)[nonzero])
                 countpanels += 1
-            ay[0].plot(x, individual_ecd[i], color=colourmap[i], linestyle='--')
-        if args.nocontr == False:
+            ay[0].plot(x, individual_ecd[i], color=colours[i], linestyle='--')
+        if nocontr == False:
             ay[0].text(0.8, 0.8, 'All contributions', horizontalalignment='center', verticalalignment='center',
                        transform=ay[0].transAxes)
             ay[0].set_title("ECD")
             plt.xlabel('$\lambda$ / nm')
             plt.ylabel('$\Delta\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
 
-    if args.outfile != None and ecd_sigstruct >= 1:
-        plt.savefig("ECD-" + args.outfile, bbox_inches='tight')
-    # elif args.outfile == None:
+    return fig
+
+
+class BatchRenderer(object):
+    """
+    Renders many single-structure UV-Vis or ECD spectra into one reused
+    figure. The axes, labels and artists are built once; every spectrum
+    only updates the curve (set_data), the line spectrum and the name. The
+    layout is fixed after the first spectrum, so saving skips the tight
+    bounding box. Use savefig's formats, e.g. .png or .pdf.
+    """
+
+    def __init__(self, kind="uvvis", nolines=False, nonames=False):
+        plt = pyplot()
+        from matplotlib.collections import LineCollection
+        self.kind = kind
+        self.nolines = nolines
+        self.nonames = nonames
+        self.fig, self.ax = plt.subplots(nrows=1)
+        self.curve, = self.ax.plot([], [])
+        self.sticks = LineCollection([], colors='k')
+        self.ax.add_collection(self.sticks, autolim=False)
+        self.label = self.ax.text(0.8, 0.8, '', horizontalalignment='center', verticalalignment='center',
+                                  transform=self.ax.transAxes)
+        self.ax.set_xlabel('$\lambda$ / nm')
+        if kind == "ecd":
+            self.ax.axhline()
+            self.ax.set_title("ECD")
+            self.ax.set_ylabel('$\Delta\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
+        else:
+            self.ax.set_title("UV-Vis")
+            self.ax.set_ylabel('$\epsilon$ / L mol$^{-1}$ cm$^{-1}$')
+        self.layout = False
+        # Number of figures saved and the time spent on them
+        self.count = 0
+        self.elapsed = 0.0
+
+    def draw(self, x, curve, bands, sticks, name=''):
+        "Update the figure with one spectrum (and its line spectrum bands/sticks)"
+        self.curve.set_data(x, curve)
+        self.ax.relim()
+        # The line spectrum starts at zero
+        self.ax.update_datalim([(x[0], 0.0)])
+        self.ax.autoscale_view()
+        if self.nolines != True:
+            heights = stickHeights(sticks, self.ax.get_ylim(), signed=self.kind == "ecd")
+            self.sticks.set_segments(np.stack([np.column_stack([bands, np.zeros(len(heights))]),
+                                               np.column_stack([bands, heights])], axis=1))
+        if self.nonames != True:
+            self.label.set_text('{}'.format(name))
+
+    def fixLayout(self, x, curve, bands, sticks, name=''):
+        "Fix the layout for all following spectra with tight_layout on this one"
+        self.draw(x, curve, bands, sticks, name)
+        self.fig.tight_layout()
+        self.layout = True
+
+    def render(self, filename, x, curve, bands, sticks, name=''):
+        "Draw one spectrum and save it to filename"
+        begin = time.perf_counter()
+        if self.layout == False:
+            self.fixLayout(x, curve, bands, sticks, name)
+        else:
+            self.draw(x, curve, bands, sticks, name)
+        self.fig.savefig(filename, **saveOptions(filename))
+        self.count += 1
+        self.elapsed += time.perf_counter() - begin
+
+    def close(self):
+        pyplot().close(self.fig)
+
+
+def saveOptions(filename):
+    "Extra savefig arguments; PDFs get no creation date so the same plot always gives the same file"
+    if filename.lower().endswith('.pdf'):
+        return {"metadata": {"CreationDate": None}}
+    return {}
+
+
+def unpad(padded, lengths):
+    "Lists of the first lengths[i] values of every row of padded (the inverse of padLists)"
+    return [row[:int(n)].tolist() for row, n in zip(padded, lengths)]
+
+
+def saveUVVis(filename, arrays, options):
+    "Plot the UV-Vis spectra of the arrays from uvvisJob and save them to filename"
+    fig = plotUVVis(arrays["x"], arrays["composite"], arrays["individual"], options["names"],
+                    unpad(arrays["bands"], arrays["lengths"]), unpad(arrays["strengths"], arrays["lengths"]),
+                    arrays["energies"], arrays["weights"], options["sigstruct"], **options["plot"])
+    fig.savefig(filename, bbox_inches='tight', **saveOptions(filename))
+    pyplot().close(fig)
+
+
+def saveECD(filename, arrays, options):
+    "Plot the ECD spectra of the arrays from ecdJob and save them to filename"
+    fig = plotECD(arrays["x"], arrays["composite"], arrays["individual"], options["names"],
+                  unpad(arrays["bands"], arrays["lengths"]), unpad(arrays["ecds"], arrays["lengths"]),
+                  arrays["energies"], arrays["weights"], options["sigstruct"], options["ecd_sigstruct"],
+                  **options["plot"])
+    fig.savefig(filename, bbox_inches='tight', **saveOptions(filename))
+    pyplot().close(fig)
+
+
+def uvvisJob(filename, x, composite, individual, names, bands, strengths, energies, weights, sigstruct, **plot):
+    "Rendering job for renderJobs that saves plotUVVis(...) to filename"
+    arrays = {"x": x, "composite": composite, "individual": individual, "bands": padLists(bands),
+              "lengths": [len(band) for band in bands], "strengths": padLists(strengths, 0.0),
+              "energies": energies, "weights": weights}
+    return saveUVVis, filename, arrays, {"names": names, "sigstruct": sigstruct, "plot": plot}
+
+
+def ecdJob(filename, x, composite_ecd, individual_ecd, names, bands, ecds, energies, weights, sigstruct, ecd_sigstruct,
+           **plot):
+    "Rendering job for renderJobs that saves plotECD(...) to filename"
+    arrays = {"x": x, "composite": composite_ecd, "individual": individual_ecd, "bands": padLists(bands),
+              "lengths": [len(band) for band in bands], "ecds": padLists(ecds, 0.0), "energies": energies,
+              "weights": weights}
+    return saveECD, filename, arrays, {"names": names, "sigstruct": sigstruct, "ecd_sigstruct": ecd_sigstruct,
+                                       "plot": plot}
+
+
+def saveBatch(filename, arrays, options):
+    """
+    Render a chunk of batchJobs spectra with one BatchRenderer per kind. The
+    layout of each kind is fixed on the first spectrum of that kind in the
+    whole batch, so every chunk gives the same files as one serial run.
+    """
+    renderers = {}
+    for kind, first in options["layout"].items():
+        renderers[kind] = BatchRenderer(kind, options["nolines"], options["nonames"])
+        renderers[kind].fixLayout(arrays["x{}".format(first)], arrays["curve{}".format(first)],
+                                  arrays["bands{}".format(first)], arrays["sticks{}".format(first)],
+                                  options["names"][first])
+    for i in options["chunk"]:
+        renderers[options["kinds"][i]].render(options["filenames"][i], arrays["x{}".format(i)],
+                                              arrays["curve{}".format(i)], arrays["bands{}".format(i)],
+                                              arrays["sticks{}".format(i)], options["names"][i])
+    for renderer in renderers.values():
+        renderer.close()
+
+
+def batchJobs(tasks, chunks=1, nolines=False, nonames=False):
+    """
+    Rendering jobs for renderJobs that draw the (kind, filename, x, curve,
+    bands, sticks, name) tasks, kind being "uvvis" or "ecd", in the given
+    number of chunks of consecutive tasks.
+    """
+    layout = {}
+    for i, task in enumerate(tasks):
+        layout.setdefault(task[0], i)
+    options = {"kinds": [task[0] for task in tasks], "filenames": [task[1] for task in tasks],
+               "names": [task[6] for task in tasks], "layout": layout, "nolines": nolines, "nonames": nonames}
+    jobs = []
+    for chunk in np.array_split(np.arange(len(tasks)), max(1, min(chunks, len(tasks)))):
+        # Only the arrays of this chunk and of the layout spectra
+        arrays = {}
+        for i in set(chunk.tolist()) | set(layout.values()):
+            for key, value in zip(("x", "curve", "bands", "sticks"), tasks[i][2:6]):
+                arrays["{}{}".format(key, i)] = value
+        jobs.append((saveBatch, None, arrays, dict(options, chunk=chunk.tolist())))
+    return jobs
+
+
+def shareArrays(arrays):
+    """
+    Copy a dict of float arrays into one block of shared memory. Returns the
+    block (close and unlink it when done) and the description attachArrays
+    needs to map the arrays in another process.
+    """
+    from multiprocessing import shared_memory
+    arrays = {key: np.ascontiguousarray(value, dtype=float) for key, value in arrays.items()}
+    layout = {}
+    size = 0
+    for key, value in arrays.items():
+        layout[key] = (size, value.shape)
+        size += value.size
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1) * 8)
+    buffer = np.ndarray((size,), dtype=float, buffer=block.buf)
+    for key, value in arrays.items():
+        buffer[layout[key][0]:layout[key][0] + value.size] = value.ravel()
+    return block, (block.name, layout)
+
+
+def attachArrays(description):
+    "Map the arrays of a shareArrays block (read-only), returns the block and the arrays"
+    from multiprocessing import shared_memory
+    name, layout = description
+    block = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for key, (offset, shape) in layout.items():
+        arrays[key] = np.ndarray(shape, dtype=float, buffer=block.buf, offset=8 * offset)
+        arrays[key].flags.writeable = False
+    return block, arrays
+
+
+# Shared arrays of a rendering worker process, see renderJobs
+workerArrays = {}
+
+
+def renderWorker(description):
+    "Pool initializer: attach the shared arrays of renderJobs"
+    pyplot()
+    workerArrays["block"], workerArrays["arrays"] = attachArrays(description)
+
+
+def renderSharedJob(job):
+    "Run one job of renderJobs in a worker, with its arrays taken from shared memory"
+    index, function, filename, keys, options = job
+    arrays = workerArrays["arrays"]
+    function(filename, {key: arrays["{}/{}".format(index, key)] for key in keys}, options)
+
+
+def renderJobs(jobs, workers=1):
+    """
+    Run (function, filename, arrays, options) rendering jobs, i.e. call
+    function(filename, arrays, options) for each. With more than one worker
+    the jobs are rendered by a pool of processes; their arrays are passed
+    through shared memory instead of being pickled. Every job makes the
+    same files as in a serial run.
+    """
+    if workers < 1:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        for function, filename, arrays, options in jobs:
+            function(filename, arrays, options)
+        return
+
+    shared = {}
+    for index, (function, filename, arrays, options) in enumerate(jobs):
+        for key, value in arrays.items():
+            shared["{}/{}".format(index, key)] = value
+    block, description = shareArrays(shared)
+    try:
+        pool = multiprocessing.Pool(workers, initializer=renderWorker, initargs=(description,))
+        try:
+            pool.map(renderSharedJob, [(index, function, filename, list(arrays), options)
+                                       for index, (function, filename, arrays, options) in enumerate(jobs)],
+                     chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def batchName(prefix, filename, outfile):
+    "Output name for the spectrum of filename in batch mode, e.g. UV-<stem>-<outfile>"
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(os.path.dirname(outfile), "{}-{}-{}".format(prefix, stem, os.path.basename(outfile)))
+
+
+class IncrementalEnsemble(object):
+    """
+    Boltzmann-weighted ensemble spectra on a fixed grid x that are updated
+    one structure at a time. The UV-Vis and ECD curves of every structure
+    are broadened once. The composite spectra are kept as sums of the
+    curves times exp(-(G - Gref) / RT) for a reference energy Gref, so adding
+    or removing a structure only adds or subtracts its own contribution.
+    """
+
+    def __init__(self, x, broadening=3099.6, hwhm=7.5, function="gaussian", temperature=298.15, engine="direct",
+                 rule="constant", table=None):
+        self.x = x
+        self.broadening = broadening
+        self.hwhm = hwhm
+        self.function = function
+        self.temperature = temperature
+        self.engine = engine
+        # How the widths of the bands are chosen, see bandWidths
+        self.rule = rule
+        self.table = table
+        # name: (bands, strengths, ecds, energy, curves), in the order they were added
+        self.structures = {}
+        self.reference = None
+        self.total = np.zeros((2, len(x)))
+        self.partition = 0.0
+
+    def factor(self, energy):
+        "Boltzmann factor of energy (Hartree) relative to the reference energy"
+        return np.exp(-(energy - self.reference) * 627.5095 / (self.temperature * 0.0019872041))
+
+    def curves(self, name, bands, strengths, ecds):
+        "Unweighted UV-Vis and ECD curves (2 x points) of the structure name"
+        stdevs, gammas = bandWidths([bands], [strengths], self.broadening, self.hwhm, self.rule, self.table, [name])
+        composite, _ = broaden(self.x, ragged([bands]), [ragged([strengths]), ragged([ecds])], stdevs, gammas, [1.0],
+                               self.function, engine=self.engine)
+        return composite
+
+    def add(self, name, bands, strengths, ecds, energy):
+        "Add (or replace) the structure name, returns False if it is already there with the same data"
+        if name in self.structures:
+            old = self.structures[name]
+            if old[3] == energy and all(np.array_equal(a, b) for a, b in zip(old[:3], (bands, strengths, ecds))):
+                return False
+            self.remove(name)
+        if self.reference is None or energy < self.reference:
+            # Rebase to the lowest energy, the other factors can only get smaller
+            if self.reference is not None:
+                scale = self.factor(self.reference) / self.factor(energy)
+                self.total *= scale
+                self.partition *= scale
+            self.reference = energy
+        curves = self.curves(name, bands, strengths, ecds)
+        factor = self.factor(energy)
+        self.total += factor * curves
+        self.partition += factor
+        self.structures[name] = (bands, strengths, ecds, energy, curves)
+        return True
+
+    def remove(self, name):
+        "Remove the structure name (if it is part of the ensemble)"
+        if name not in self.structures:
+            return
+        energy, curves = self.structures.pop(name)[3:]
+        factor = self.factor(energy)
+        if len(self.structures) == 0:
+            self.reference = None
+            self.total[:] = 0.0
+            self.partition = 0.0
+        elif self.partition - factor < 1e-6 * self.partition:
+            # The rest is lost in the rounding errors of the removed contribution, sum it up again
+            self.resum()
+        else:
+            # The composite spectra are total / partition, so this renormalises them as well
+            self.total -= factor * curves
+            self.partition -= factor
+
+    def resum(self):
+        "Recompute the sums from the curves of all structures"
+        self.reference = min(structure[3] for structure in self.structures.values())
+        factors = np.array([self.factor(structure[3]) for structure in self.structures.values()])
+        self.total = np.tensordot(factors, [structure[4] for structure in self.structures.values()], axes=1)
+        self.partition = np.sum(factors)
+
+    def regrid(self, x):
+        "Move to a new grid, which broadens every structure again"
+        self.x = x
+        for name, (bands, strengths, ecds, energy, curves) in list(self.structures.items()):
+            self.structures[name] = (bands, strengths, ecds, energy, self.curves(name, bands, strengths, ecds))
+        if self.structures:
+            self.resum()
+        else:
+            self.total = np.zeros((2, len(x)))
+
+    def ensemble(self):
+        "Names, bands, strengths, ECD strengths and relative energies (kcal/mol) of the structures"
+        structures = list(self.structures.values())
+        return (list(self.structures), [s[0] for s in structures], [s[1] for s in structures],
+                [s[2] for s in structures], [(s[3] - self.reference) * 627.5095 for s in structures])
+
+    def spectra(self):
+        """
+        The weights and spectra as returned by broaden(), i.e. weights,
+        (composite, composite_ecd), (individual, individual_ecd).
+        """
+        factors = np.array([self.factor(structure[3]) for structure in self.structures.values()])
+        weights = factors / self.partition
+        curves = np.array([structure[4] for structure in self.structures.values()]).reshape((-1, 2, len(self.x)))
+        individual = weights[:, np.newaxis, np.newaxis] * curves
+        composite = self.total / self.partition
+        return weights, (composite[0], composite[1]), (individual[:, 0], individual[:, 1])
+
+    def sweep(self, temperatures):
+        "Composite UV-Vis and ECD spectra (temperatures x points) from the stored curves"
+        structures = list(self.structures.values())
+        weights = ensembleWeights([structure[3] for structure in structures], np.asarray(temperatures, dtype=float))
+        curves = np.array([structure[4] for structure in structures]).reshape((-1, 2, len(self.x)))
+        return np.dot(weights, curves[:, 0]), np.dot(weights, curves[:, 1])
+
+
+def pollFiles(patterns, known):
+    """
+    Check the files matching the (glob) patterns against known, a dict of
+    filename: (size, mtime) that is updated. Returns the new or changed and
+    the vanished files.
+    """
+    current = {}
+    for pattern in patterns:
+        for filename in (glob.glob(pattern) if glob.has_magic(pattern) else [pattern]):
+            try:
+                info = os.stat(filename)
+            except OSError:
+                continue
+            current[filename] = (info.st_size, info.st_mtime_ns)
+    changed = [filename for filename in current if known.get(filename) != current[filename]]
+    vanished = [filename for filename in known if filename not in current]
+    known.clear()
+    known.update(current)
+    return changed, vanished
+
+
+def writeOutputs(args, x, names, bands, strengths, ecds, energies, weights, sigstruct, ecd_sigstruct, composite,
+                 individual, composite_ecd, individual_ecd, sweep=None, widthtable=None):
+    """
+    Write the csv files, binary file and plots that the parsed command line
+    options args ask for. sweep is the optional (temperatures, spectra,
+    spectra_ecd) of --sweep, widthtable the per-band widths of --widths.
+    """
+    # Write .csv file with UV-Vis and (if available) ECD data.
+    if args.csv != None:
+        if ecd_sigstruct > 0:
+            writeCSV(args.csv, x, names, composite, individual, composite_ecd, individual_ecd)
+        else:
+            writeCSV(args.csv, x, names, composite, individual)
+        if sweep is not None:
+            csvname = os.path.join(os.path.dirname(args.csv), "sweep-" + os.path.basename(args.csv))
+            writeSweepCSV(csvname, x, sweep[0], sweep[1], sweep[2] if ecd_sigstruct > 0 else None)
+
+    # Save the spectra for other programs to load directly
+    if args.save != None:
+        settings = {"function": args.function, "broadening": args.broadening, "hwhm": args.hwhm,
+                    "temperature": args.temperature, "cutoff": args.cutoff, "flipecd": args.flipecd, "engine": args.engine,
+                    "adaptive": args.adaptive, "width_rule": args.width_rule, "widths": args.widths,
+                    "width_table": widthtable}
+        if ecd_sigstruct > 0:
+            writeSpectra(args.save, x, names, composite, individual, composite_ecd, individual_ecd, weights, energies,
+                         settings, sweep)
+        else:
+            writeSpectra(args.save, x, names, composite, individual, weights=weights, energies=energies,
+                         metadata=settings, sweep=sweep)
+
+    # The plots are only drawn (and matplotlib only imported) if they are saved
+    if args.outfile != None:
+        colours = colourMap(len(bands), args.colourmap)
+        options = dict(cutoff=args.cutoff, colours=colours, totalonly=args.totalonly, nolines=args.nolines,
+                       nonames=args.nonames, nocontr=args.nocontr)
+
+        jobs = [uvvisJob("UV-" + args.outfile, x, composite, individual, names, bands, strengths, energies, weights,
+                         sigstruct, **options)]
+        if ecd_sigstruct >= 1:
+            jobs.append(ecdJob("ECD-" + args.outfile, x, composite_ecd, individual_ecd, names, bands, ecds, energies,
+                               weights, sigstruct, ecd_sigstruct, **options))
+        renderJobs(jobs, args.render_jobs)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="WellFAReSpecPlot: Wellington Fast Assessment of Reactions - Spectral Data Plot",
+        epilog="recognised filetypes: {}".format(", ".join(f.name for f in formats)))
+    parser.add_argument("files", metavar='file', help="input file(s) with spectroscopic data, or directories "
+                                                      "written by --save-ensemble", nargs='+',
+                        default="reactant.log")
+    parser.add_argument("-o", "--outfile", help="save plot to file instead of displaying in gui")
+    parser.add_argument("--csv", help="save to file in csv format")
+    parser.add_argument("--save", help="save the spectra, weights and settings in binary format (.npz, .parquet "
+                                       "with pyarrow or .h5 with h5py)")
+    parser.add_argument("-c", "--cutoff", help="cutoff value for inclusion into plots",
+                        default=0.01,
+                        type=float)
+    parser.add_argument("-u", "--upper", help="highest frequency (in nm) for the plot", type=float)
+    parser.add_argument("-l", "--lower", help="lowest frequency (in nm) for the plot", type=float)
+    parser.add_argument("-b", "--broadening", help="line broadening (in nm)", type=float, default=3099.6)
+    parser.add_argument("--hwhm", help="half width at half peak height (only for Lorentzians; in nm)", type=float,
+                        default=7.5)
+    parser.add_argument("--width-rule", help="same width for all bands (-b, --hwhm) or narrower for stronger bands "
+                                             "(by 1 - 0.23 f, as the smear of plot_uvvis)",
+                        choices=["constant", "strength"], default="constant")
+    parser.add_argument("--widths", help="JSON file with the widths of single bands, {\"file\": {\"broadening\": "
+                                         "[...], \"hwhm\": [...]}}, replacing those of --width-rule")
+    parser.add_argument("--nolines", help="prevent printing of line spectra underneath plots", action='store_true')
+    parser.add_argument("--nonames", help="prevent printing of file names in plots", action='store_true', default=False)
+    parser.add_argument("--nocontr", help="prevent printing of contributions in plots", action='store_true', default=False)
+    parser.add_argument("-t", "--totalonly", help="only print the total plot, not individual subplots", action='store_true')
+    parser.add_argument("--flipecd", help="invert the handedness of the ECD data", action='store_true')
+    parser.add_argument("-f", "--function", help="type of function to fit spectrum", choices=["gaussian", "lorentzian"],
+                        default="gaussian")
+    parser.add_argument("-p", "--points", help="number of points to plot (with --adaptive: of the initial grid)",
+                        type=float)
+    parser.add_argument("--adaptive", help="sample the spectra densely only where they are curved, until linear "
+                                           "interpolation is within this fraction of their maximum, e.g. 1e-3",
+                        type=float, metavar="TOLERANCE")
+    parser.add_argument("--colourmap", help="choose colour map for the plot", type=int, choices=[0, 1, 2, 3], default=0)
+    parser.add_argument("-v", "--verbosity", help="increase output verbosity", type=int, choices=[0, 1, 2, 3], default=1)
+    parser.add_argument("--reverse", help="search the files backwards from the end for the last spectra and energy "
+                                          "(faster for long outputs)", action='store_true')
+    parser.add_argument("-j", "--jobs", help="number of processes for reading the files (0: all CPUs)", type=int,
+                        default=1)
+    parser.add_argument("--no-cache", help="don't use the cache of parsed files", action='store_true')
+    parser.add_argument("--save-ensemble", help="save the parsed data of all files into this directory (one .npy "
+                                                "file per column), which can be given instead of the files later",
+                        metavar="DIRECTORY")
+    parser.add_argument("--clear-cache", help="empty the cache of parsed files before reading", action='store_true')
+    parser.add_argument("--cache-hash", help="identify cached files by their contents instead of path, size and "
+                                             "modification time", action='store_true')
+    parser.add_argument("--cache-size", help="maximum size of the cache of parsed files (in MB)", type=float,
+                        default=64.0)
+    parser.add_argument("--max-memory", help="memory budget for the temporary arrays of the broadening, e.g. 512M "
+                                             "(default: no limit)", type=parseSize)
+    parser.add_argument("--tolerance", help="only evaluate bands where they are above this fraction of their height, "
+                                            "e.g. 1e-6 (default: on the whole grid)", type=float)
+    parser.add_argument("--prune-weight", help="don't broaden structures with a Boltzmann weight below this, e.g. "
+                                               "0.001 (the maximum error is reported)", type=float)
+    parser.add_argument("--prune-strength", help="don't broaden bands with an oscillator strength below this, e.g. "
+                                                 "1e-4 (the maximum error is reported)", type=float)
+    parser.add_argument("--engine", help="sum up the bands directly or convolve the line spectra via FFT (faster for "
+                                         "thousands of lines, ~0.1%% error)", choices=["direct", "fft"],
+                        default="direct")
+    parser.add_argument("--batch", help="plot every file as a spectrum of its own (UV-<file>-<outfile>, "
+                                        "ECD-<file>-<outfile>) reusing one figure layout", action='store_true')
+    parser.add_argument("-T", "--temperature", help="temperature (in K) for the Boltzmann weights", type=float,
+                        default=298.15)
+    parser.add_argument("--sweep", help="also compute the composite spectra at these temperatures (in K), saved "
+                                        "with --save and as sweep-<csv> with --csv", type=float, nargs='+')
+    parser.add_argument("--watch", help="keep watching the files (or quoted glob patterns) and update the outputs "
+                                        "whenever one of them is added, changed or removed", action='store_true')
+    parser.add_argument("--interval", help="seconds between checks for changed files in watch mode", type=float,
+                        default=2.0)
+    parser.add_argument("--render-jobs", help="number of processes for drawing the figures (0: all CPUs; default 1, "
+                                              "in batch mode the number of --jobs)", type=int)
+
+    args = parser.parse_args()
+
+    if args.render_jobs == None:
+        args.render_jobs = args.jobs if args.batch == True else 1
+
+    if args.outfile != None:
+        if args.outfile.lower().endswith(('.png', '.ps', '.eps', '.pdf')) == False:
+            ProgramError("Unsupported filetype requested")
+            ProgramAbort()
+        # Fail early if matplotlib is missing
+        pyplot()
+
+    if args.verbosity >= 2:
+        ProgramHeader()
+
+    cache = ExcitationCache(maxsize=int(args.cache_size * (1 << 20)), content=args.cache_hash)
+    if args.clear_cache == True:
+        cache.clear()
+    if args.no_cache == True:
+        cache = None
+
+    widthtable = None
+    if args.widths != None:
+        try:
+            widthtable = readWidths(args.widths)
+        except (IOError, ValueError) as error:
+            ProgramError(str(error))
+            ProgramAbort()
+
+    if args.batch == True:
+        if args.outfile == None:
+            ProgramError("Batch mode needs an output file (-o)")
+            ProgramAbort()
+        # Read (with --jobs processes) and broaden the spectra of all files first, then draw them
+        tasks = []
+        for filename, record in ensembleRecords(args.files, args.verbosity, args.jobs, args.reverse, cache):
+            if record is None:
+                continue
+            names, bands, strengths, ecds = [filename], [record[0]], [record[1]], [record[2]]
+            if args.flipecd == True:
+                ecds = flipECD(ecds)
+            stdevs, gammas = bandWidths(bands, strengths, args.broadening, args.hwhm, args.width_rule, widthtable,
+                                        names)
+            x, start, finish, points = plotGrid(bands, args.lower, args.upper, args.points)
+            if args.adaptive != None:
+                x = adaptiveGrid(bands, strengths, ecds, [1.0], start, finish, args.points, args.adaptive, stdevs,
+                                 gammas, args.function, engine=args.engine)
+            (composite, composite_ecd), _ = ensembleSpectra(x, bands, strengths, ecds, [1.0], stdevs, gammas,
+                                                            args.function, args.max_memory, args.tolerance,
+                                                            args.engine)
+            tasks.append(("uvvis", batchName("UV", filename, args.outfile), x, composite, bands[0], strengths[0],
+                          filename))
+            if max(np.absolute(ecds[0])) > 0.0:
+                tasks.append(("ecd", batchName("ECD", filename, args.outfile), x, composite_ecd, bands[0], ecds[0],
+                              filename))
+        begin = time.perf_counter()
+        renderJobs(batchJobs(tasks, args.render_jobs if args.render_jobs >= 1 else multiprocessing.cpu_count(),
+                             args.nolines, args.nonames), args.render_jobs)
+        elapsed = time.perf_counter() - begin
+        if args.verbosity >= 1:
+            print("Rendered {} figure(s) in {:.2f} s ({:.1f} figures/s)".format(len(tasks), elapsed,
+                                                                               len(tasks) / max(elapsed, 1e-9)))
+        if args.verbosity >= 2:
+            ProgramFooter()
+        sys.exit()
+
+    if args.watch == True:
+        # Only new or changed files are parsed and broadened; the ensemble is
+        # updated one structure at a time until interrupted
+        if args.adaptive != None:
+            # An adaptive grid would change (and need everything broadened again) with every update
+            ProgramWarning("--adaptive is not used in watch mode, the grid is uniform")
+        ensemble = None
+        known = {}
+        followers = {}
+        if args.verbosity >= 1:
+            print("Watching {} for changes, stop with Ctrl-C".format(", ".join(args.files)))
+        try:
+            while True:
+                changed, vanished = pollFiles(args.files, known)
+                if changed or vanished:
+                    begin = time.perf_counter()
+                    data = {}
+                    unfinished = []
+                    for filename in vanished:
+                        followers.pop(filename, None)
+                    for filename in changed:
+                        # Only the bytes appended since the last check are read
+                        follower = followers.setdefault(filename, ExcitationFollower(filename))
+                        if follower.poll() and args.verbosity >= 2:
+                            if follower.finished():
+                                print("Complete spectrum in {}".format(filename))
+                            else:
+                                print("Block {} complete in {}".format(follower.parser.blocks, filename))
+                        band, f, energy, ecd = follower.result()
+                        # Unfinished outputs without (consistent) data are skipped quietly for now
+                        if band != [] and f != [] and ecd != [] and len(band) == len(f) == len(ecd):
+                            data[filename] = (band, f, flipECD([ecd])[0] if args.flipecd == True else ecd, energy)
+                        else:
+                            unfinished.append(filename)
+                    if ensemble is None and data:
+                        x = plotGrid([values[0] for values in data.values()], args.lower, args.upper, args.points)[0]
+                        ensemble = IncrementalEnsemble(x, args.broadening, args.hwhm, args.function,
+                                                       args.temperature, args.engine, args.width_rule, widthtable)
+                    if ensemble is not None:
+                        for filename in vanished + unfinished:
+                            ensemble.remove(filename)
+                        for filename, (band, f, ecd, energy) in list(data.items()):
+                            # Files that changed without a newly completed block keep their curves
+                            if not ensemble.add(filename, band, f, ecd, energy):
+                                del data[filename]
+                    if ensemble is not None and ensemble.structures:
+                        names, bands, strengths, ecds, energies = ensemble.ensemble()
+                        # Follow the bands unless the range is fixed
+                        x = plotGrid(bands, args.lower, args.upper, args.points)[0]
+                        if len(x) != len(ensemble.x) or np.any(x != ensemble.x):
+                            ensemble.regrid(x)
+                        weights, (composite, composite_ecd), (individual, individual_ecd) = ensemble.spectra()
+                        sigstruct, ecd_sigstruct = significantStructures(weights, ecds, args.cutoff)
+                        sweep = None
+                        if args.sweep != None:
+                            sweep = (args.sweep,) + ensemble.sweep(args.sweep)
+                        writeOutputs(args, ensemble.x, names, bands, strengths, ecds, energies, weights, sigstruct,
+                                     ecd_sigstruct, composite, individual, composite_ecd, individual_ecd, sweep,
+                                     widthtable)
+                        if args.verbosity >= 1:
+                            print("{}: {} structure(s), {} new or changed, {} removed, updated in {:.1f} ms".format(
+                                time.strftime("%X"), len(names), len(data), len(vanished),
+                                (time.perf_counter() - begin) * 1e3))
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            pass
+        if args.verbosity >= 2:
+            ProgramFooter()
+        sys.exit()
+
+    # Excitation energies in nm
+    # Oscillator strengths (dimensionless)
+    # All of them in one array per kind (see Ensemble), the structures are views
+    ensemble = readColumns(args.files, args.verbosity, args.jobs, args.reverse, cache)
+    if args.save_ensemble != None:
+        ensemble.save(args.save_ensemble)
+    names, bands, strengths, ecds, energies = (ensemble.names.tolist(), ensemble.bands, ensemble.strengths,
+                                               ensemble.ecds, ensemble.energies)
+    if len(energies) == 0:
+        ProgramError("No spectral data for plotting")
+        ProgramAbort()
+
+    # Relative energies, Boltzmann factors and normalised weights for all components
+    gibbs = energies
+    energies, boltzmann = boltzmannWeights(gibbs, args.temperature)
+    weights = ensembleWeights(gibbs, args.temperature)
+
+    # Flip the ECD spectrum (to show the "other" enantiomer)
+    if args.flipecd == True:
+        ecds = flipECD(ecds)
+
+    # Find out how many structures actually contribute significantly to the UV-Vis and ECD
+    sigstruct, ecd_sigstruct = significantStructures(weights, ecds, args.cutoff)
+
+    # Widths of every band (nm), from the rule and the widths file
+    stdevs, gammas = bandWidths(bands, strengths, args.broadening, args.hwhm, args.width_rule, widthtable, names)
+    if args.engine == "fft":
+        distinct = distinctWidths(stdevs, gammas, args.function)
+        if distinct > fftwidths:
+            ProgramWarning("{} distinct band widths are too many for the FFT, summing up the bands directly".format(
+                distinct))
+            args.engine = "direct"
+
+    # Now that we know the bands, setup plot
+    x, start, finish, points = plotGrid(bands, args.lower, args.upper, args.points)
+    if args.adaptive != None:
+        x = adaptiveGrid(bands, strengths, ecds, weights, start, finish, args.points, args.adaptive, stdevs, gammas,
+                         args.function, engine=args.engine)
+        points = len(x)
+
+    if args.verbosity >= 2:
+        print("")
+        for i in range(1, len(bands) + 1):
+            print("Data from file no {}: {}".format(i, names[i - 1]))
+            print("Relative Gibbs energy: {:.3f}".format(energies[i - 1]))
+            print("Boltzmann factor: {:.3f}".format(boltzmann[i - 1]))
+            print("Contribution: {:.1f}%".format(weights[i - 1] * 100))
+            if args.verbosity >= 3:
+                print("  nm     UV-Vis     ECD")
+                for j in range(0, len(bands[i - 1])):
+                    print(" {:.1f}  {:7.5f} {:-10.5f}".format(bands[i - 1][j], strengths[i - 1][j], ecds[i - 1][j]))
+            print("")
+    if args.verbosity >= 1:
+        print("Examined {} file(s)".format(len(args.files)))
+        print("Found spectral data in {} file(s)".format(len(bands)))
+    if args.verbosity >= 2:
+        if args.function == "lorentzian":
+            print("Using Lorentzians with a line broadening of {:.1f} nm and a HWHM of {:.1f} nm for plotting".format(
+                args.broadening, args.hwhm))
+        else:
+            print("Using Gaussians with a line broadening of {:.1f} nm for plotting".format(args.broadening))
+        if args.width_rule == "strength":
+            print("Stronger bands are narrower (by 1 - 0.23 f)")
+        if args.widths != None:
+            print("Widths of single bands from {}".format(args.widths))
+        if args.totalonly == True:
+            print("Only plotting overall UV-Vis plot")
+        else:
+            print("Plotting {} structure(s) that contribute to >{:.1f}% to the UV-Vis spectrum".format(sigstruct,
+                                                                                                       args.cutoff * 100))
+        if ecd_sigstruct > 0 and args.totalonly == False:
+            print("Plotting {} contributing structure(s) with ECD data".format(ecd_sigstruct))
+        elif ecd_sigstruct > 0 and args.totalonly == True:
+            print("Only plotting overall ECD plot. {} structures with significant ECD data.".format(ecd_sigstruct))
+        else:
+            if args.verbosity >= 3:
+                print("No ECD spectra available or no significant contribution to the spectrum")
+        if ecd_sigstruct > 0 and args.flipecd == True:
+            print("The ECD data has been inverted (to show the other enantiomer)")
+
+        if args.verbosity >= 3 and sigstruct > 1:
+            print("Note that the overall UV-Vis and ECD spectra *always* contain *all* contributions.")
+        print("Plotting data from {} nm to {} nm ({} points)".format(start, finish, points))
+        print("")
+
+    # Calculate composite spectra and individual spectra for all UV-Vis and ECD data in one go. For a
+    # temperature sweep the curves are broadened once with unit weights and then weighted for every temperature
+    broadenweights = weights if args.sweep == None else np.ones(len(weights))
+    if args.max_memory != None:
+        tracemalloc.start()
+    if args.prune_weight == None and args.prune_strength == None:
+        (composite, composite_ecd), (individual, individual_ecd) = ensembleSpectra(
+            x, bands, strengths, ecds, broadenweights, stdevs, gammas, args.function, args.max_memory,
+            args.tolerance, args.engine)
+    else:
+        # Only broaden the structures and bands above the thresholds, the others keep zero curves
+        keep, keptbands, keptstrengths, keptecds, pruneerror = pruneEnsemble(
+            bands, strengths, ecds, weights, stdevs, args.prune_weight or 0.0, args.prune_strength or 0.0)
+        # The same bands of the widths
+        keptwidths = ragged(strengths).take(keep).values >= (args.prune_strength or 0.0)
+        begin = time.perf_counter()
+        (composite, composite_ecd), (kept, kept_ecd) = ensembleSpectra(
+            x, keptbands, keptstrengths, keptecds, broadenweights[keep], stdevs.take(keep).mask(keptwidths),
+            gammas.take(keep).mask(keptwidths), args.function, args.max_memory, args.tolerance, args.engine)
+        elapsed = time.perf_counter() - begin
+        individual = np.zeros((len(bands), len(x)))
+        individual_ecd = np.zeros((len(bands), len(x)))
+        individual[keep] = kept
+        individual_ecd[keep] = kept_ecd
+        if args.verbosity >= 1:
+            nbands = sum(len(band) for band in bands)
+            nkept = sum(len(band) for band in keptbands)
+            print("Pruned {} of {} structure(s) and {} of {} band(s) before broadening".format(
+                len(bands) - len(keep), len(bands), nbands - nkept, nbands))
+            print("Maximum absolute error from pruning: {:.2e} (UV-Vis), {:.2e} (ECD)".format(pruneerror[0],
+                                                                                           pruneerror[1]))
+            if nkept == 0:
+                print("No bands left to broaden")
+            else:
+                print("Broadened {:.0f}% of the bands in {:.1f} ms".format(100.0 * nkept / nbands, elapsed * 1e3))
+    if args.max_memory != None:
+        peakmemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if args.verbosity >= 2:
+            print("Peak memory used for broadening: {:.2f} MB ({:.2f} MB of it for the spectra)".format(
+                peakmemory / 2.0 ** 20, (individual.nbytes + composite.nbytes) * 2 / 2.0 ** 20))
+    if args.tolerance != None and args.verbosity >= 2:
+        error, error_ecd = windowError([padLists(strengths, 0.0), padLists(ecds, 0.0)], stdevs.padded(1.0), weights,
+                                       args.tolerance)
+        print("Bands truncated below {:.1e} of their height, maximum absolute error: {:.2e} (UV-Vis), "
+              "{:.2e} (ECD)".format(args.tolerance, error, error_ecd))
+
+    # Spectra for a range of temperatures from the unweighted curves (pruned structures have zero curves), then
+    # the spectra at --temperature the same way
+    sweep = None
+    if args.sweep != None:
+        sweepweights = ensembleWeights(gibbs, np.asarray(args.sweep, dtype=float))
+        sweep = (args.sweep, np.dot(sweepweights, individual), np.dot(sweepweights, individual_ecd))
+        composite, composite_ecd = np.dot(weights, individual), np.dot(weights, individual_ecd)
+        individual *= weights[:, np.newaxis]
+        individual_ecd *= weights[:, np.newaxis]
+
+    writeOutputs(args, x, names, bands, strengths, ecds, energies, weights, sigstruct, ecd_sigstruct, composite,
+                 individual, composite_ecd, individual_ecd, sweep, widthtable)
+    # else:
     #     plt.show()
 
     if args.verbosity >= 2: